@@ -0,0 +1,274 @@
+"""
+Offline benchmarks of the collection -> cut -> load pipeline, on synthetic
+tiles and annotations written to a temporary directory.
+
+Each benchmark runs in its own process, so peak RSS is that benchmark's
+alone. Results are appended to a history file (one JSON record per line),
+and a run is flagged as a regression when its items/sec falls more than
+--tolerance below the median of the previous --window runs of the same
+benchmark.
+
+example usage:
+python run_benchmarks.py
+python run_benchmarks.py -b spiral_100k -b setup_calls --no-save
+"""
+import argparse
+import imp
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(BENCH_DIR, os.pardir, 'image_prep'))
+#appended after site-packages, so neural_nets/nolearn.py doesn't shadow nolearn
+sys.path.append(os.path.join(BENCH_DIR, os.pardir, 'neural_nets'))
+
+#synthetic data sizes
+NUM_TILES = 8
+TILE_DIM = 1280
+POINTS_PER_TILE = 40
+ROI_SIDE = 48
+
+
+def bench_spiral_10k(data_dir):
+    from utils import spiral_stepper
+    return len(spiral_stepper(max_steps = 10000))
+
+
+def bench_spiral_100k(data_dir):
+    from utils import spiral_stepper
+    return len(spiral_stepper(max_steps = 100000))
+
+
+def bench_setup_calls(data_dir):
+    from google_satellite_images import SatImageCollector
+    collector = SatImageCollector(37.7792, -122.3957, max_tiles = 100000)
+    collector.setup_calls()
+    return len(collector.image_info)
+
+
+def bench_pix2latlng(data_dir):
+    from google_satellite_images import SatImageCollector
+    collector = SatImageCollector(37.7792, -122.3957)
+    rng = np.random.RandomState(0)
+    pix = rng.uniform(0, 1280, size = (20000, 2))
+    for pix_x, pix_y in pix.tolist():
+        collector._pix2latlng(pix_x, pix_y)
+    return len(pix)
+
+
+def bench_posneg_dict2roi_images(data_dir):
+    from cut_and_save_rois import posneg_dict2roi_images
+    tiles_dir, annotations = _load_annotations(data_dir)
+    num_rois = 0
+    for posneg_d in annotations:
+        posneg_d = posneg_dict2roi_images(posneg_d, [ROI_SIDE, ROI_SIDE],
+                                            in_path = tiles_dir)
+        num_rois += sum(len(posneg_d.get(key, {})) for key in
+                        ['positive_roi_arrs', 'negative_roi_arrs'])
+    return num_rois
+
+
+def bench_batch_roi_writer(data_dir):
+    from cut_and_save_rois import batch_roi_writer
+    tiles_dir, annotations = _load_annotations(data_dir)
+    out_path = tempfile.mkdtemp(dir = data_dir)
+    batch_roi_writer(annotations, imgs_path = tiles_dir, out_path = out_path,
+                        roi_dims = [ROI_SIDE, ROI_SIDE])
+    return sum(len(os.listdir(os.path.join(out_path, out_dir))) for out_dir in
+                ['positive_samples', 'negative_samples'])
+
+
+def bench_load_roi_images(data_dir):
+    #load by path, the neural_nets directory would shadow the nolearn package
+    nolearn_py = imp.load_source('satclass_nolearn',
+                        os.path.join(BENCH_DIR, os.pardir, 'neural_nets', 'nolearn.py'))
+    X, y = nolearn_py.load_roi_images(os.path.join(data_dir, 'rois'))
+    return len(X)
+
+
+def bench_augment(data_dir):
+    from augment import BatchAugmenter
+    augmenter = BatchAugmenter()
+    Xb = np.random.RandomState(0).randint(0, 256, size = (128, 3, ROI_SIDE, ROI_SIDE)
+                                            ).astype(np.float32)
+    num_batches = 200
+    for _ in xrange(num_batches):
+        augmenter(Xb)
+    return num_batches * len(Xb)
+
+
+def _load_annotations(data_dir):
+    with open(os.path.join(data_dir, 'annotations.json')) as fin:
+        return os.path.join(data_dir, 'tiles'), json.load(fin)
+
+
+BENCHMARKS = [('spiral_10k', bench_spiral_10k),
+              ('spiral_100k', bench_spiral_100k),
+              ('setup_calls', bench_setup_calls),
+              ('pix2latlng', bench_pix2latlng),
+              ('posneg_dict2roi_images', bench_posneg_dict2roi_images),
+              ('batch_roi_writer', bench_batch_roi_writer),
+              ('load_roi_images', bench_load_roi_images),
+              ('augment', bench_augment)]
+
+
+def make_synthetic_data(data_dir, seed = 0):
+    """
+    Write NUM_TILES random tiles named in the SatImageCollector convention,
+    annotations.json of random points on them, and a rois/ directory of
+    positive_samples/negative_samples cut from them.
+    """
+    from matplotlib.image import imsave
+    from cut_and_save_rois import batch_roi_writer
+
+    rng = np.random.RandomState(seed)
+    tiles_dir = os.path.join(data_dir, 'tiles')
+    os.mkdir(tiles_dir)
+    annotations = []
+    for i in xrange(NUM_TILES):
+        fname = 'img{0}_0_37.7792471625_-122.395741018_zoom18.png'.format(i)
+        imsave(os.path.join(tiles_dir, fname),
+                rng.randint(0, 256, size = (TILE_DIM, TILE_DIM, 3)).astype(np.uint8))
+        points = rng.randint(ROI_SIDE, TILE_DIM - ROI_SIDE,
+                                size = (POINTS_PER_TILE, 2)).tolist()
+        half = POINTS_PER_TILE // 2
+        annotations.append({'img_file': fname, 'positive_points': points[:half],
+                            'negative_points': points[half:]})
+
+    with open(os.path.join(data_dir, 'annotations.json'), 'w') as fout:
+        json.dump(annotations, fout)
+    rois_dir = os.path.join(data_dir, 'rois')
+    os.mkdir(rois_dir)
+    batch_roi_writer(annotations, imgs_path = tiles_dir, out_path = rois_dir,
+                        roi_dims = [ROI_SIDE, ROI_SIDE])
+
+
+def run_benchmark(name, data_dir):
+    """
+    Run one benchmark in a fresh process.
+
+    OUTPUT:
+    (dict) 'name', 'seconds', 'items', 'items_per_sec', 'peak_rss_mb', or
+           'name', 'skipped' with the reason (e.g. lasagne isn't installed).
+    """
+    proc = subprocess.Popen([sys.executable, os.path.abspath(__file__),
+                                '--child', name, '--data', data_dir],
+                            stdout = subprocess.PIPE)
+    out = proc.communicate()[0]
+    if proc.returncode != 0:
+        raise Exception("Benchmark {0} failed with exit code {1}".format(
+                            name, proc.returncode))
+    return json.loads(out.strip().splitlines()[-1])
+
+
+def _child(name, data_dir):
+    bench_fn = dict(BENCHMARKS)[name]
+    start_time = time.time()
+    try:
+        items = bench_fn(data_dir)
+    except ImportError as e:
+        return {'name': name, 'skipped': str(e)}
+    seconds = time.time() - start_time
+
+    #ru_maxrss is in kilobytes on linux, bytes on OS X
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak_rss_mb = peak_rss / (1024.0 ** 2 if sys.platform == 'darwin' else 1024.0)
+    return {'name': name, 'seconds': seconds, 'items': items,
+            'items_per_sec': items / seconds if seconds > 0 else 0.0,
+            'peak_rss_mb': peak_rss_mb}
+
+
+def load_history(history_path):
+    """(list of dicts) previous benchmark results, oldest first."""
+    if not os.path.exists(history_path):
+        return []
+    with open(history_path) as fin:
+        return [json.loads(line) for line in fin if line.strip()]
+
+
+def find_regression(result, history, tolerance = 0.2, window = 5):
+    """
+    Compare a result to the median items/sec of the last window results of
+    the same benchmark in history.
+
+    OUTPUT:
+    (float or None) the baseline items/sec if result is more than tolerance
+    slower than it, else None.
+    """
+    previous = [r['items_per_sec'] for r in history
+                if (r['name'] == result['name']) and ('items_per_sec' in r)]
+    if not previous:
+        return None
+    baseline = float(np.median(previous[-window:]))
+    if result['items_per_sec'] < (1.0 - tolerance) * baseline:
+        return baseline
+    return None
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                        cwd = BENCH_DIR).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    names = [name for name, _ in BENCHMARKS]
+    ap.add_argument('-b', '--bench', action='append', choices=names,
+                    help="Benchmark to run (repeatable). Default: all.")
+    ap.add_argument('--history', default=os.path.join(BENCH_DIR, 'history.jsonl'),
+                    help="JSON lines file of previous results to compare to and append to.")
+    ap.add_argument('-t', '--tolerance', type=float, default=0.2,
+                    help="Flag runs this fraction slower than the baseline.")
+    ap.add_argument('-w', '--window', type=int, default=5,
+                    help="Number of previous runs the baseline is the median of.")
+    ap.add_argument('--no-save', action='store_true', help="Don't append to the history.")
+    ap.add_argument('--child', help=argparse.SUPPRESS)
+    ap.add_argument('--data', help=argparse.SUPPRESS)
+
+    args = ap.parse_args()
+    if args.child:
+        print json.dumps(_child(args.child, args.data))
+        sys.exit(0)
+
+    history = load_history(args.history)
+    run_info = {'run_time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'commit': _git_commit()}
+    data_dir = tempfile.mkdtemp()
+    results = []
+    try:
+        make_synthetic_data(data_dir)
+        for name in (args.bench or names):
+            result = run_benchmark(name, data_dir)
+            if 'skipped' in result:
+                print "{0:<24} skipped: {1}".format(name, result['skipped'])
+                continue
+            result.update(run_info)
+            baseline = find_regression(result, history, args.tolerance, args.window)
+            flag = ''
+            if baseline is not None:
+                flag = "  REGRESSION (baseline {0:.1f}/s)".format(baseline)
+            print "{0:<24} {1:8.3f}s {2:12.1f} items/s {3:8.1f} MB peak{4}".format(
+                    name, result['seconds'], result['items_per_sec'],
+                    result['peak_rss_mb'], flag)
+            result['regression'] = baseline is not None
+            results.append(result)
+    finally:
+        shutil.rmtree(data_dir)
+
+    if not args.no_save:
+        with open(args.history, 'a') as fout:
+            for result in results:
+                fout.write(json.dumps(result) + '\n')
+
+    if any(result['regression'] for result in results):
+        sys.exit(1)
@@ -0,0 +1,165 @@
+"""
+Line delimited journal of image annotations, so a crash in the middle of an
+annotation session loses at most the image being annotated.
+
+Each line is one finished image, in the format of the dicts returned by
+save_image_annotation.batch_image_roi_collector. An image is only annotated
+once: if it shows up again (in a later line, or after the canonical file when
+merging), the later record is ignored.
+
+example usage (merge a journal into the canonical annotation file):
+python annotation_journal.py annotations.jsonl -m image_annotation.json
+"""
+import argparse
+import json
+import os
+
+
+class AnnotationJournal(object):
+    """
+    Append only journal of annotation records. Every append is flushed and
+    fsynced before returning. A partial last line left by a crash is cut off
+    when the journal is opened.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._truncate_partial_line()
+        self._seen = set(record['img_file'] for record in iter_journal(path))
+        self._fout = open(path, 'a')
+
+
+    def append(self, record):
+        """Write one annotation record (dict with an 'img_file') to disk."""
+        self._fout.write(json.dumps(record) + '\n')
+        self._fout.flush()
+        os.fsync(self._fout.fileno())
+        self._seen.add(record['img_file'])
+
+
+    def seen_files(self):
+        """(set) image file names already in the journal."""
+        return set(self._seen)
+
+
+    def close(self):
+        self._fout.close()
+
+
+    def _truncate_partial_line(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb+') as fio:
+            fio.seek(0, os.SEEK_END)
+            size = fio.tell()
+            if size == 0:
+                return
+            fio.seek(-1, os.SEEK_END)
+            if fio.read(1) == '\n':
+                return
+            #scan back in blocks for the last complete line
+            end = size
+            while end > 0:
+                start = max(end - 65536, 0)
+                fio.seek(start)
+                newline = fio.read(end - start).rfind('\n')
+                if newline >= 0:
+                    fio.truncate(start + newline + 1)
+                    return
+                end = start
+            fio.truncate(0)
+
+
+def iter_journal(path):
+    """
+    (generator) of the annotation records of a journal, one line at a time,
+    skipping images seen earlier in the journal. An unparsable last line
+    (from a crash mid write) is skipped.
+    """
+    if not os.path.exists(path):
+        return
+    seen = set()
+    with open(path) as fin:
+        pending = None
+        for line in fin:
+            if pending is not None:
+                raise Exception("Corrupt line in journal {0}: {1}".format(path, pending))
+            if not line.strip():
+                continue
+            try:
+                record = json.loads(line)
+            except ValueError:
+                pending = line[:80]
+                continue
+            if record['img_file'] not in seen:
+                seen.add(record['img_file'])
+                yield record
+
+
+def iter_annotations(path):
+    """
+    (generator) of the annotation records in a journal (.jsonl), streamed
+    line by line, or in a JSON list written by save_image_annotation.py.
+    """
+    if path.endswith('.jsonl'):
+        for record in iter_journal(path):
+            yield record
+    else:
+        with open(path) as fin:
+            for record in json.load(fin):
+                yield record
+
+
+def seen_files(*paths):
+    """(set) image file names annotated in any of paths (journals or JSON lists)."""
+    seen = set()
+    for path in paths:
+        if path and os.path.exists(path):
+            seen.update(record['img_file'] for record in iter_annotations(path))
+    return seen
+
+
+def compact(journal_path, merged_path):
+    """
+    Merge a journal into the canonical JSON list of annotations. Records
+    already in merged_path are kept first; journal records of images not in it
+    are appended. The merged file is replaced atomically, then the journal is
+    emptied.
+
+    OUTPUT:
+    (int) number of journal records added to merged_path.
+    """
+    records = []
+    if os.path.exists(merged_path):
+        with open(merged_path) as fin:
+            records = json.load(fin)
+    seen = set(record['img_file'] for record in records)
+
+    num_added = 0
+    for record in iter_journal(journal_path):
+        if record['img_file'] not in seen:
+            seen.add(record['img_file'])
+            records.append(record)
+            num_added += 1
+
+    tmp_path = merged_path + '.tmp'
+    with open(tmp_path, 'w') as fout:
+        json.dump(records, fout)
+        fout.flush()
+        os.fsync(fout.fileno())
+    os.rename(tmp_path, merged_path)
+    if os.path.exists(journal_path):
+        open(journal_path, 'w').close()
+
+    return num_added
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument('journal', help="Annotation journal (.jsonl) to merge.")
+    ap.add_argument('-m', '--merged', required=True,
+                    help="Canonical JSON annotation file to merge into (created if missing).")
+
+    args = ap.parse_args()
+    num_added = compact(args.journal, args.merged)
+    print "Merged {0} annotations into {1}".format(num_added, args.merged)
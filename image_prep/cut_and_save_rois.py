@@ -1,10 +1,148 @@
 import argparse
+from ast import literal_eval
+from image_io import read_rgb, write_rgb
+import itertools
 import json
-from matplotlib.image import imread, imsave
-from numpy import shape
+import metrics
+import multiprocessing
+import numpy as np
 import os
+from annotation_journal import iter_annotations
+import phash
+from roi_store import RoiStore
+from tile_catalog import TileCatalog
+from web_mercator import latlng2worldpix
 
-def posneg_dict2roi_images(posneg_d, roi_dims, in_path = ''):
+EDGE_MODES = ['drop', 'reflect', 'constant', 'neighbors']
+
+
+def extract_rois(img_arr, points, roi_dims, edge_mode = 'drop', 
+                    fill_value = 0, neighbors = None):
+    """
+    Cut the regions of interest centered on a batch of points out of an image 
+    in one vectorized gather over a strided view of all the image's windows.
+
+    INPUT:
+    img_arr: (array) image of shape (rows, cols, channels) or (rows, cols).
+    points: (list or array) of N [col, row] pixel centers.
+    roi_dims: (pair of ints) [cols, rows] size of the cutouts, or a list of 
+              such pairs to cut several window sizes around the same points.
+    edge_mode: (str) How to treat windows running off the image:
+               'drop': leave those points out.
+               'reflect': mirror the image at its edges.
+               'constant': pad with fill_value.
+               'neighbors': pull the missing pixels from the adjacent tiles 
+                            in neighbors, fill_value where there is none.
+    fill_value: (number) pad value for 'constant' and 'neighbors'.
+    neighbors: (dict) for 'neighbors' mode, maps a (dx, dy) tile step 
+               (x east, y south) to (neighbor image, (col offset, row offset)),
+               where the offsets are the pixel position of the neighbor's 
+               center relative to this image's center. E.g. with 
+               SatImageCollector defaults the east neighbor's offset is 
+               (1152, 0).
+
+    OUTPUT:
+    rois: (array) (N', rows, cols, channels) cutouts, or a list of them, one 
+          per entry in roi_dims if several were given.
+    kept: (bool array) of length N, False for points left out, either for 
+          being off the image, or (in 'drop' mode) for any window not 
+          fitting in it.
+    """
+    if edge_mode not in EDGE_MODES:
+        raise Exception("Unknown edge_mode: {0}".format(edge_mode))
+
+    multi_scale = not np.isscalar(roi_dims[0])
+    dims_l = [tuple(dims) for dims in roi_dims] if multi_scale else [tuple(roi_dims)]
+
+    squeeze = (img_arr.ndim == 2)
+    if squeeze:
+        img_arr = img_arr[:, :, np.newaxis]
+    row_totdim, col_totdim = img_arr.shape[:2]
+
+    points = np.asarray(points, dtype=np.intp).reshape(-1, 2)
+    col_nums, row_nums = points[:, 0], points[:, 1]
+    kept = ((col_nums >= 0) & (col_nums < col_totdim) & 
+            (row_nums >= 0) & (row_nums < row_totdim))
+
+    if edge_mode == 'drop':
+        row_pad = col_pad = 0
+        for col_dim, row_dim in dims_l:
+            row_starts = row_nums - row_dim // 2
+            col_starts = col_nums - col_dim // 2
+            kept &= ((row_starts >= 0) & (row_starts + row_dim <= row_totdim) &
+                     (col_starts >= 0) & (col_starts + col_dim <= col_totdim))
+        padded = img_arr
+    else:
+        #padding by a full window covers any window centered on the image
+        row_pad = max(dims[1] for dims in dims_l)
+        col_pad = max(dims[0] for dims in dims_l)
+        pad_width = ((row_pad, row_pad), (col_pad, col_pad), (0, 0))
+        if edge_mode == 'reflect':
+            padded = np.pad(img_arr, pad_width, mode = 'reflect')
+        elif edge_mode == 'constant':
+            padded = np.pad(img_arr, pad_width, mode = 'constant', 
+                            constant_values = fill_value)
+        else:
+            padded = _pad_from_neighbors(img_arr, row_pad, col_pad, 
+                                            neighbors or {}, fill_value)
+
+    rois_l = []
+    for col_dim, row_dim in dims_l:
+        #view of every (row_dim, col_dim) window, indexed by its upper left corner
+        stride_r, stride_c, stride_ch = padded.strides
+        win_shape = (padded.shape[0] - row_dim + 1, padded.shape[1] - col_dim + 1,
+                     row_dim, col_dim, padded.shape[2])
+        windows = np.lib.stride_tricks.as_strided(padded, shape = win_shape, 
+                    strides = (stride_r, stride_c, stride_r, stride_c, stride_ch))
+
+        rois = windows[row_nums[kept] - row_dim // 2 + row_pad, 
+                       col_nums[kept] - col_dim // 2 + col_pad]
+        rois_l.append(rois[..., 0] if squeeze else rois)
+
+    return (rois_l if multi_scale else rois_l[0]), kept
+
+
+def _pad_from_neighbors(img_arr, row_pad, col_pad, neighbors, fill_value):
+    """
+    Helper for extract_rois. Pad img_arr by row_pad/col_pad pixels, filling 
+    the border with pixels from the neighboring tiles where they are given.
+    """
+    row_totdim, col_totdim, channels = img_arr.shape
+    padded = np.empty((row_totdim + 2 * row_pad, col_totdim + 2 * col_pad, 
+                        channels), dtype = img_arr.dtype)
+    padded.fill(fill_value)
+    padded[row_pad:row_pad + row_totdim, col_pad:col_pad + col_totdim] = img_arr
+
+    #range of this tile's pixel coordinates covered by each side of the border
+    row_ranges = {-1: (-row_pad, 0), 0: (0, row_totdim), 
+                  1: (row_totdim, row_totdim + row_pad)}
+    col_ranges = {-1: (-col_pad, 0), 0: (0, col_totdim), 
+                  1: (col_totdim, col_totdim + col_pad)}
+
+    for (dx, dy), (nb_arr, (col_off, row_off)) in neighbors.items():
+        if (dx, dy) == (0, 0) or nb_arr is None:
+            continue
+        if nb_arr.ndim == 2:
+            nb_arr = nb_arr[:, :, np.newaxis]
+        nb_arr = nb_arr[:, :, :channels]
+
+        #clip to the pixels the neighbor actually has
+        row0 = max(row_ranges[dy][0], int(row_off))
+        row1 = min(row_ranges[dy][1], int(row_off) + nb_arr.shape[0])
+        col0 = max(col_ranges[dx][0], int(col_off))
+        col1 = min(col_ranges[dx][1], int(col_off) + nb_arr.shape[1])
+        if (row0 >= row1) or (col0 >= col1):
+            continue
+
+        padded[row0 + row_pad:row1 + row_pad, col0 + col_pad:col1 + col_pad] = \
+            nb_arr[row0 - int(row_off):row1 - int(row_off), 
+                   col0 - int(col_off):col1 - int(col_off)]
+
+    return padded
+
+
+def posneg_dict2roi_images(posneg_d, roi_dims, in_path = '', 
+                            edge_mode = 'drop', neighbors = None):
     """
     Load image listed in posneg_d, cut out regions of interest based
     on center points in posneg_d and roi_dims (dimensions).  Return 
@@ -17,122 +155,361 @@ def posneg_dict2roi_images(posneg_d, roi_dims, in_path = ''):
                  'positive_points': [[535, 670], [535, 301], [1056, 664]]}
 
     in_path: (str) dir path to parent of image 'img_file'
-    roi_dims: (pair of ints) pixel dimension of image to cut from image
+    roi_dims: (pair of ints) pixel dimension of image to cut from image. A 
+              single pair only: cut several sizes with extract_rois.
+    edge_mode/neighbors: see extract_rois. With the default 'drop', points 
+                         too close to the image edge are left out.
 
     OUTPUT
-    (dict) A modified posneg_d that includes numpy arrays of the ROIS.
+    (dict) A modified posneg_d that includes numpy arrays of the ROIS, uint8 
+    RGB, as decoded by image_io.read_rgb.
     """
     if (in_path != '') and (not os.path.isdir(in_path)):
         raise Exception("Can't find directory: {0}".format(in_path))
 
-    img_arr = imread(os.path.join(in_path, posneg_d['img_file']))
-    col_centdim = roi_dims[0] // 2
-    row_centdim = roi_dims[1] // 2
-    row_totdim, col_totdim, _ = shape(img_arr)
+    with metrics.timer('png_decode'):
+        img_arr = read_rgb(os.path.join(in_path, posneg_d['img_file']))
+
+    return cut_posneg_rois(posneg_d, img_arr, roi_dims, edge_mode = edge_mode,
+                            neighbors = neighbors)
 
+
+def cut_posneg_rois(posneg_d, img_arr, roi_dims, edge_mode = 'drop', 
+                    neighbors = None):
+    """
+    posneg_dict2roi_images for an image already in memory (img_arr), e.g. 
+    decoded straight from a download.
+    """
+    if not np.isscalar(roi_dims[0]):
+        raise Exception("Several roi_dims are only supported by extract_rois, got: {0}".format(roi_dims))
     for point_key in ['positive_points', 'negative_points']:
-        if point_key in posneg_d:
-            for col_num, row_num in posneg_d[point_key]:
-                
-                #check if roi is too close to edge:
-                edgechecks = 0
-                edgechecks += (row_num < row_centdim)
-                edgechecks += (col_num < col_centdim)
-                edgechecks += ((row_num + row_centdim) > row_totdim)
-                edgechecks += ((col_num + col_centdim) > col_totdim)
-                if edgechecks > 0:
-                    continue
-
- 
-                roi_img = img_arr[(row_num-row_centdim):(row_num+row_centdim), 
-                                  (col_num-col_centdim):(col_num+col_centdim), 
-                                  :]
-
-                roi_key = point_key.split('_')[0] + "_roi_arrs"
-                if roi_key in posneg_d:
-                    posneg_d[roi_key][str((col_num,row_num))] = roi_img
-                else:
-                    posneg_d[roi_key] = {str((col_num,row_num)): roi_img}
+        if not posneg_d.get(point_key):
+            continue
+        rois, kept = extract_rois(img_arr, posneg_d[point_key], roi_dims, 
+                                    edge_mode = edge_mode, 
+                                    neighbors = neighbors)
+        kept_points = [point for point, keep in 
+                        zip(posneg_d[point_key], kept) if keep]
+        metrics.incr('rois_cut', len(kept_points))
+        metrics.incr('rois_dropped_at_edge', len(kept) - len(kept_points))
+        if not kept_points:
+            continue
+
+        roi_key = point_key.split('_')[0] + "_roi_arrs"
+        if roi_key not in posneg_d:
+            posneg_d[roi_key] = {}
+        for (col_num, row_num), roi_img in zip(kept_points, rois):
+            posneg_d[roi_key][str((col_num,row_num))] = roi_img
 
     return posneg_d
 
 
 def batch_roi_writer(posneg_d_l,imgs_path = '', out_path = '', 
-                            roi_dims = [48, 48], file_num = 0):
+                            roi_dims = [48, 48], file_num = 0, catalog = None,
+                            out_format = 'png', processes = 1, 
+                            edge_mode = 'drop', dedup_distance = None):
     """
     Given a list of dicts (see posneg_dict2roi_images for dict specifications)
     load images and write region of interest cutout images into 'positive_sample'
     and 'negative_sample' directories.  Use a simple numbering system for the 
     image writes, so add a lookup to posneg_d and return that.
+    With out_format = 'store', the cutouts are instead appended to a single 
+    RoiStore (see roi_store.py) at out_path, and the lookup holds store indices.
+
+    Each image gets a block of file numbers, one per listed point (positive 
+    points first, then negative), so numbering doesn't depend on which process
+    cuts which image. Numbers of points dropped for being too close to the 
+    image edge are skipped.
 
     INPUT:
-    posneg_d_l: (list) of posneg_dict2roi_images
+    posneg_d_l: (list or iterable) of posneg_dict2roi_images dicts. It is 
+                consumed lazily, e.g. streamed from an annotation journal.
     roi_dims: (pair of ints) dimensions of image to cut from image
     imgs_path/out_path: (str) dir path to parent of image 'img_file'/where to 
                         write the sample directories with ROI images. 
     file_num: (int) Initial number to increment to name the sample images.
+    catalog: (TileCatalog) If given, images are located through the tile 
+             catalog (falling back to imgs_path for images not in it) and 
+             each returned dict gets a 'tile' entry with the tile's step, 
+             lat/lng and zoom.
+    out_format: (str) 'png' to write an image file per ROI, or 'store' to 
+                append the ROIs to a memory mappable RoiStore.
+    processes: (int) Number of processes to cut (and write) images with.
+    edge_mode: (str) How to cut ROIs running off the image, see extract_rois.
+               'neighbors' looks the adjacent tiles up in the catalog.
+    dedup_distance: (int) If given, ROIs within this Hamming distance of the
+                    perceptual hash (see phash.py) of an ROI with the same
+                    label, written before (in this run or already at 
+                    out_path), are left out. Their points are listed under
+                    'duplicate_rois' in the returned dicts.
     
     OUTPUT:
     writes: image cutouts of regions of interest
-    returns: (dict) modified posneg_ds
+    returns: (list of dicts) modified posneg_ds, one per input image, in order
     """ 
 
+    if not np.isscalar(roi_dims[0]):
+        raise Exception("Several roi_dims are only supported by extract_rois, got: {0}".format(roi_dims))
     out_dirnames = ['positive_samples', 'negative_samples']
-    for out_dir in out_dirnames:
-        if (out_path == '') or os.path.isdir(out_path):
-            writepath = os.path.join(out_path, out_dir)
-            if not os.path.isdir(writepath):
-                os.mkdir(writepath)
-        else:
-            raise Exception("Can't find directory: {0}".format(out_path))
+    if out_format == 'store':
+        roi_store = RoiStore(out_path)
+    elif out_format == 'png':
+        for out_dir in out_dirnames:
+            if (out_path == '') or os.path.isdir(out_path):
+                writepath = os.path.join(out_path, out_dir)
+                if not os.path.isdir(writepath):
+                    os.mkdir(writepath)
+            else:
+                raise Exception("Can't find directory: {0}".format(out_path))
+    else:
+        raise Exception("Unknown out_format: {0}".format(out_format))
+    if (edge_mode == 'neighbors') and (catalog is None):
+        raise Exception("edge_mode 'neighbors' needs a tile catalog.")
+    hash_index = None
+    if dedup_distance is not None:
+        hash_index = (phash.index_from_store(roi_store, dedup_distance) 
+                        if out_format == 'store' else 
+                        phash.index_from_pngs(out_path, dedup_distance))
+
+    def _jobs(file_num):
+        #catalog lookups and file number blocks are done here, in order, so
+        #workers get everything they need in their job
+        for pn_d in posneg_d_l:
+            pn_dcopy = pn_d.copy()
+            in_path = imgs_path
+            tile = catalog.get(pn_d['img_file']) if catalog is not None else None
+            neighbor_tiles = {}
+            if tile is not None:
+                in_path = os.path.dirname(tile['path'])
+                pn_dcopy['tile'] = dict((k, tile[k]) for k in 
+                                        ['xstep', 'ystep', 'lat', 'lng', 'zoom'])
+                if edge_mode == 'neighbors':
+                    neighbor_tiles = _find_neighbor_tiles(catalog, tile)
+
+            yield (pn_dcopy, in_path, out_path, roi_dims, file_num, 
+                    out_format == 'png', edge_mode, neighbor_tiles, 
+                    hash_index is not None)
+            file_num += sum(len(pn_d.get(key, [])) for key in 
+                            ['positive_points', 'negative_points'])
+
+    if processes > 1:
+        #forked workers start from empty metrics, so nothing is counted twice
+        pool = multiprocessing.Pool(processes, initializer = metrics.reset)
+        results = pool.imap(_cut_one_image, _jobs(file_num), chunksize = 4)
+    else:
+        pool = None
+        results = itertools.imap(_cut_one_image, _jobs(file_num))
 
     posneg_d_lredo = []
-    new_keys = ['positive_roi_arrs', 'negative_roi_arrs']
-    for pn_d in posneg_d_l:
-        pn_dcopy = pn_d.copy()
-        pn_dcopy = posneg_dict2roi_images(pn_dcopy, roi_dims, 
-                                            in_path = imgs_path)
-        
-        for key, subpath in zip(new_keys, out_dirnames):
-            if key in pn_dcopy:
-                for tup in pn_dcopy[key]:
-                    img_arr = pn_dcopy[key][tup]
-                    fname = str(file_num) + '.png'
-                    fpath_out = os.path.join(out_path, subpath, fname)
-
-                    imsave(fpath_out, img_arr)
-                    pn_dcopy[key][tup] = fpath_out
-                    file_num += 1
-                    posneg_d_lredo.append(pn_dcopy)
+    try:
+        for pn_dcopy, worker_metrics in results:
+            #metrics recorded in worker processes are sent back with results
+            metrics.merge_raw(worker_metrics)
+            if hash_index is not None:
+                drop_duplicate_rois(pn_dcopy, hash_index, 
+                                        remove_files = out_format == 'png')
+            if out_format == 'store':
+                with metrics.timer('store_append'):
+                    append_rois_to_store(roi_store, pn_dcopy)
+            metrics.incr('images_cut')
+            posneg_d_lredo.append(pn_dcopy)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
 
     return posneg_d_lredo
 
 
-if __name__ == '__main__':
+def _cut_one_image(job):
     """
-    example usage:
-    python cut_and_save_rois.py image_metadata/roi_pixel_info.json \
-     -p input/image/dir \
-     -o output/rois/dir \
-     > output_metadata.json
+    Helper for batch_roi_writer, run in the worker processes. Cut the ROIs of
+    one image, and if write_pngs, write them numbered from first_num and 
+    replace the arrays in the dict with the written file paths.
+    Returns the dict and the metrics recorded meanwhile (see metrics.pop_raw).
     """
-    ap = argparse.ArgumentParser()
-    jsonin_help = "Path to json file of results of running save_image_annotation."
+    (pn_d, in_path, out_path, roi_dims, first_num, write_pngs, edge_mode, 
+        neighbor_tiles, hash_rois) = job
+    neighbors = None
+    if neighbor_tiles:
+        tile = pn_d['tile']
+        tile_x, tile_y = latlng2worldpix(tile['lat'], tile['lng'], tile['zoom'])
+        neighbors = {}
+        for step, (nb_path, nb_lat, nb_lng) in neighbor_tiles.items():
+            nb_x, nb_y = latlng2worldpix(nb_lat, nb_lng, tile['zoom'])
+            offset = (int(round(nb_x - tile_x)), int(round(nb_y - tile_y)))
+            with metrics.timer('png_decode'):
+                neighbors[step] = (read_rgb(nb_path), offset)
+
+    pn_d = posneg_dict2roi_images(pn_d, roi_dims, in_path = in_path, 
+                                    edge_mode = edge_mode, 
+                                    neighbors = neighbors)
+    if hash_rois:
+        #hashed here, in the worker, so the parent only looks up
+        hash_posneg_rois(pn_d)
+    if not write_pngs:
+        return pn_d, metrics.pop_raw()
+
+    file_num = first_num
+    for point_key, subpath in [('positive_points', 'positive_samples'), 
+                               ('negative_points', 'negative_samples')]:
+        roi_key = point_key.split('_')[0] + "_roi_arrs"
+        written = set()
+        for col_num, row_num in pn_d.get(point_key, []):
+            tup = str((col_num, row_num))
+            #points dropped at the edge have no array, repeated points are
+            #only written once
+            if (tup in pn_d.get(roi_key, {})) and (tup not in written):
+                written.add(tup)
+                fname = str(file_num) + '.png'
+                fpath_out = os.path.join(out_path, subpath, fname)
+
+                with metrics.timer('png_write'):
+                    write_rgb(fpath_out, pn_d[roi_key][tup])
+                pn_d[roi_key][tup] = fpath_out
+            file_num += 1
+
+    return pn_d, metrics.pop_raw()
+
+
+def hash_posneg_rois(pn_d):
+    """
+    Perceptual hashes (see phash.py) of the ROI arrays of one image, as cut 
+    by posneg_dict2roi_images, in one batch per label. They are kept in 
+    pn_d['roi_phashes'] for drop_duplicate_rois.
+    """
+    pn_d['roi_phashes'] = {}
+    for roi_key in ['positive_roi_arrs', 'negative_roi_arrs']:
+        tups = sorted(pn_d.get(roi_key, {}))
+        if tups:
+            hashes = phash.phash_batch(np.array([pn_d[roi_key][tup][:, :, :3]
+                                                 for tup in tups]))
+            pn_d['roi_phashes'][roi_key] = dict(zip(tups, hashes.tolist()))
+    return pn_d
+
+
+def drop_duplicate_rois(pn_d, hash_index, remove_files = False):
+    """
+    Take the ROIs of one image (hashed by hash_posneg_rois) that 
+    near-duplicate an ROI already in hash_index (a phash.PHashIndex) out of
+    pn_d, deleting their PNGs if remove_files, and add the others to the 
+    index. The points taken out are listed under pn_d['duplicate_rois'].
+    """
+    duplicates = []
+    for roi_key, label in [('positive_roi_arrs', 1), ('negative_roi_arrs', 0)]:
+        hashes = pn_d.get('roi_phashes', {}).get(roi_key, {})
+        for tup in sorted(hashes):
+            item = (pn_d['img_file'], tup)
+            if hash_index.add_if_new(hashes[tup], item, label) is None:
+                continue
+            roi = pn_d[roi_key].pop(tup)
+            if remove_files:
+                os.remove(roi)
+            duplicates.append(list(literal_eval(tup)))
+    pn_d.pop('roi_phashes', None)
+    if duplicates:
+        pn_d['duplicate_rois'] = duplicates
+    metrics.incr('rois_deduplicated', len(duplicates))
+
+
+def _find_neighbor_tiles(catalog, tile):
+    """
+    Helper for batch_roi_writer. Paths and centers of the saved tiles 
+    adjacent to tile, as {(dx, dy): (path, lat, lng)}.
+    """
+    neighbor_tiles = {}
+    for dx in [-1, 0, 1]:
+        for dy in [-1, 0, 1]:
+            if (dx, dy) == (0, 0):
+                continue
+            nb = catalog.get_step(tile['xstep'] + dx, tile['ystep'] + dy, 
+                                    zoom = tile['zoom'])
+            if (nb is not None) and (nb['status'] == 'done'):
+                neighbor_tiles[(dx, dy)] = (nb['path'], nb['lat'], nb['lng'])
+    return neighbor_tiles
+
+
+def append_rois_to_store(roi_store, pn_d):
+    """
+    Append the ROI arrays of one image (as cut by posneg_dict2roi_images) to 
+    roi_store (dropping any alpha channel) and replace them in pn_d with 
+    their store indices. All of an image's ROIs go in one append, so an image
+    is either fully in the store or not at all.
+    """
+    keys, tups, rois, labels = [], [], [], []
+    for key, label in [('positive_roi_arrs', 1), ('negative_roi_arrs', 0)]:
+        for tup in sorted(pn_d.get(key, {})):
+            keys.append(key)
+            tups.append(tup)
+            rois.append(pn_d[key][tup][:, :, :3])
+            labels.append(label)
+    if not rois:
+        return
+
+    centers = [list(literal_eval(tup)) for tup in tups]
+    store_idxs = roi_store.append(np.array(rois), labels, 
+                                    img_file = pn_d['img_file'], 
+                                    centers = centers)
+    for key, tup, store_idx in zip(keys, tups, store_idxs):
+        pn_d[key][tup] = store_idx
+
+
+def add_arguments(ap):
+    """Add the command line arguments of this script to an ArgumentParser."""
+    jsonin_help = "Path to json file (or .jsonl journal, read as a stream) of results of running save_image_annotation."
     ap.add_argument('jsonin', help = jsonin_help)
     ap.add_argument('-p', '--path', help="Path to images listed in textfile")
     outpath_help = "Path where positive_samples/negative_samples dirs will be created/added to."
     ap.add_argument('-o', '--outpath', help = outpath_help)
     ap.add_argument('-d', '--dims', help="Side length of cutout (assumed to be square).")
     ap.add_argument('-n', '--number', help="File number to start with.")
+    ap.add_argument('-c', '--catalog', help="Tile catalog to locate images with.")
+    store_help = "Append ROIs to a single memory mappable ROI store at outpath, instead of writing PNGs."
+    ap.add_argument('-s', '--store', action='store_true', help=store_help)
+    ap.add_argument('-j', '--processes', type=int, default=1, 
+                    help="Number of processes to cut images with.")
+    edge_help = "How to cut ROIs that run off the image: {0}. 'neighbors' requires a catalog."
+    ap.add_argument('-e', '--edge', default='drop', choices=EDGE_MODES, 
+                    help=edge_help.format(', '.join(EDGE_MODES)))
+    metrics_help = "Write run metrics to this file: Prometheus textfile if it ends in .prom, else JSON."
+    ap.add_argument('-m', '--metrics', help=metrics_help)
+    ap.add_argument('--dedup', type=int, metavar='DISTANCE', 
+                    help="Leave out ROIs within this perceptual hash distance (e.g. 4) of one already written.")
 
 
-    args = ap.parse_args()
-    posneg_d_in = json.load(open(args.jsonin))
+def main(args):
+    """Run batch_roi_writer with parsed command line arguments, see add_arguments."""
+    if args.metrics:
+        metrics.enable()
+    posneg_d_in = iter_annotations(args.jsonin)
 
     in_path = args.path if args.path else ''
     out_path = args.outpath if args.outpath else ''
     roi_dims = [int(args.dims), int(args.dims)] if args.dims else [48, 48]
     file_num = int(args.number) if args.number else 0
+    catalog = TileCatalog(args.catalog) if args.catalog else None
 
     posneg_d_out = batch_roi_writer(posneg_d_in, imgs_path=in_path, out_path=out_path,
-                                    roi_dims=roi_dims, file_num=file_num)    
\ No newline at end of file
+                                    roi_dims=roi_dims, file_num=file_num, 
+                                    catalog=catalog, 
+                                    out_format='store' if args.store else 'png',
+                                    processes=args.processes, 
+                                    edge_mode=args.edge, 
+                                    dedup_distance=args.dedup)
+    if args.metrics:
+        metrics.export(args.metrics)
+    print json.dumps(posneg_d_out)
+
+
+if __name__ == '__main__':
+    """
+    example usage:
+    python cut_and_save_rois.py image_metadata/roi_pixel_info.json \
+     -p input/image/dir \
+     -o output/rois/dir \
+     > output_metadata.json
+    (or: python pipeline.py cut ...)
+    """
+    ap = argparse.ArgumentParser()
+    add_arguments(ap)
+    main(ap.parse_args())
@@ -1,7 +1,18 @@
+import argparse
+import hashlib
+import itertools
 import math
+import metrics
+import numpy as np
 import os
+import Queue
 import requests
-from utils import spiral_stepper
+import sharding
+import threading
+import time
+from tile_catalog import TileCatalog
+from utils import RateLimiter, SpiralSteps
+from web_mercator import pix2latlng, steps2latlng
 
 class SatImageCollector(object):
     """
@@ -11,7 +22,9 @@ class SatImageCollector(object):
     """
 
     def __init__(self, latitude, longitude, max_tiles = 2500, zoom = 17, 
-                    image_size = 640, scale = 2, save_dir = None, step_coords = None):
+                    image_size = 640, scale = 2, save_dir = None, step_coords = None,
+                    api_url = 'http://maps.googleapis.com/maps/api/staticmap?',
+                    step_range = None):
         """
         INPUT:
         latitude, longitude: (float) location on earth in decimal degrees.
@@ -26,7 +39,13 @@ class SatImageCollector(object):
                      from initial lat/lng. e.g.:
                      step_coords = [(0, 0), (1, 0), (0, 1), (-1, 0), (0, -1)]
                      would get images in a cross pattern.
-                     If None, use spiral_stepper from utils.py.
+                     If None, use SpiralSteps from utils.py, which is lazy.
+                     Any iterable of pairs works, and is read in chunks.
+        api_url: (str) Base url of the static maps API. Can be pointed at a 
+                 local server for testing.
+        step_range: (pair of ints) [first, last) Only collect these steps of 
+                    the plan, e.g. one shard of it (see sharding.py). Tiles
+                    keep their step index in the whole plan.
 
 
 
@@ -41,12 +60,30 @@ class SatImageCollector(object):
         self.image_size = image_size
         self.scale = scale
         self.save_dir = save_dir #if None, save in local directory
+        self.api_url = api_url
 
         #Google uses powers of 2 to define zoom, thus a scale of 2 represents zoom += 1 
         self.effective_zoom = self.zoom + math.log(self.scale, 2)
+        self.step_range = step_range
+        self.first_step = step_range[0] if step_range is not None else 0
+        self.spiral = step_coords is None
         if step_coords is None:
-            self.step_coords = spiral_stepper(max_steps = self.max_tiles, 
-                                    step_size = 1)
+            #SpiralSteps indexes directly into the spiral, no need to walk it
+            last_step = (min(step_range[1], self.max_tiles) 
+                            if step_range is not None else self.max_tiles)
+            self.step_coords = SpiralSteps(max_steps = last_step, 
+                                    step_size = 1, start = self.first_step)
+        elif step_range is not None:
+            self.step_coords = itertools.islice(step_coords, step_range[0], 
+                                                step_range[1])
+        else:
+            self.step_coords = step_coords
+        self.image_overlap = None
+        self.region = None #set by region_plan.py
+        #catalog meta key prefix and step indices of the tiles, set by 
+        #quadtree.py for its refinement levels
+        self.meta_prefix = ''
+        self.step_idxs = None
 
         self.image_info = None
 
@@ -54,12 +91,13 @@ class SatImageCollector(object):
 
 
 
-    def setup_calls(self, image_overlap = 0.1):
+    def setup_calls(self, image_overlap = 0.1, chunk_size = 10000):
         """
         Build a list for making calls to Google Maps API to get satellite coverage
         of an area around the initial lat/lng in a spiral pattern.
         INPUT:
         image_overlap: (float) Fraction of image to be repeated on the adjacent image.
+        chunk_size: (int) Number of step coordinates projected per batch.
 
         OUTPUT:
         (list of pairs) of the form [(file name, Google Maps url)], with form:
@@ -71,34 +109,81 @@ class SatImageCollector(object):
         """
         #how many pixels to move for adjacent image. should be 1152 with defaults set.
         pixel_step = math.floor((1.0 - image_overlap) * self.scale * self.image_size)
-        center_pix = (self.scale * self.image_size) / 2.0
-        lat0 = self.init_lat
-        lng0 = self.init_lng
+        dim = self.scale * self.image_size
 
+        self.image_overlap = image_overlap
         fnames_urls = []
         fname_template = 'img{0}_{1}_{2}_{3}_zoom{4}.png'  
-        maps_url1 = 'http://maps.googleapis.com/maps/api/staticmap?'
-        maps_url2 = 'zoom={0}&size={1}x{1}&scale={2}&maptype=satellite&center={3},{4}'
-        for x_trans, y_trans in self.step_coords:
-            pix_x = center_pix + x_trans * pixel_step
-            pix_y = center_pix + y_trans * pixel_step
 
+        #project the steps in fixed size chunks, so the step coordinates can
+        #be streamed without building the full list in memory
+        step_iter = iter(self.step_coords)
+        while True:
+            chunk = list(itertools.islice(step_iter, chunk_size))
+            if not chunk:
+                break
+            steps = np.array(chunk, dtype=np.int64).reshape(-1, 2)
             #requires square images
-            lat1, lng1 = self._pix2latlng(pix_x, pix_y)
-
-            fname = fname_template.format(x_trans, y_trans, 
-                            lat1, lng1, int(self.effective_zoom))
-            url_params = maps_url2.format(self.zoom, self.image_size, 
-                            self.scale, lat1, lng1)
-            fnames_urls.append( [fname, maps_url1 + url_params] )
+            lats, lngs = steps2latlng(steps[:, 0], steps[:, 1], self.init_lat, 
+                                        self.init_lng, self.effective_zoom, dim, 
+                                        pixel_step)
+
+            #tolist gives python ints/floats, so file names format as before
+            for (x_trans, y_trans), lat1, lng1 in zip(steps.tolist(), 
+                                                        lats.tolist(), 
+                                                        lngs.tolist()):
+                fname = fname_template.format(x_trans, y_trans, 
+                                lat1, lng1, int(self.effective_zoom))
+                fnames_urls.append( [fname, self.tile_url(lat1, lng1)] )
 
         self.image_info = fnames_urls
 
 
-    def get_images(self, api_key = None, verbose = True):
+    def plan(self):
+        """
+        (dict) Parameters that determine the planned tiles, saved to the 
+        catalog so shards of one plan can be checked against each other.
+        """
+        return {'latitude': self.init_lat, 'longitude': self.init_lng, 
+                'max_tiles': self.max_tiles, 'zoom': self.zoom, 
+                'image_size': self.image_size, 'scale': self.scale, 
+                'image_overlap': self.image_overlap, 'spiral': self.spiral, 
+                'region': self.region}
+
+
+    def tile_url(self, lat, lng):
+        """(str) API url (without key) of the tile centered on lat, lng."""
+        maps_url2 = 'zoom={0}&size={1}x{1}&scale={2}&maptype=satellite&center={3},{4}'
+        return self.api_url + maps_url2.format(self.zoom, self.image_size, 
+                                                self.scale, lat, lng)
+
+
+    def get_images(self, api_key = None, verbose = True, workers = 1, 
+                    max_rps = None, retries = 3, backoff = 1.0, timeout = 30,
+                    catalog = None):
         """
         Make repeated calls to the Google Maps API to download a series
-        of satellite images. 
+        of satellite images. Calls are spread over a pool of worker threads
+        that share one pooled HTTP session, so connections are reused.
+
+        INPUT:
+        api_key: (str) Google Maps API key, appended to each url.
+        verbose: (bool) Print progress and a tiles/sec summary.
+        workers: (int) Number of concurrent download threads.
+        max_rps: (float) Cap on requests per second across all workers. 
+                 None for no cap.
+        retries: (int) Number of extra attempts for a tile after a failed call.
+        backoff: (float) Seconds to wait before the first retry, doubled on 
+                 each following retry.
+        timeout: (float) Seconds to wait on each request.
+        catalog: (TileCatalog) If given, the planned tiles are recorded in it,
+                 tiles it lists as done are skipped without checking the disk,
+                 and each download's status, size and checksum are saved to it.
+
+        OUTPUT:
+        (dict) Summary of the run: counts of tiles 'requested', 'skipped' 
+               (already saved) and 'downloaded', a list of 'failed' 
+               [(file name, reason)], 'seconds' and 'tiles_per_sec'.
         """
 
         if self.image_info is None:
@@ -110,24 +195,155 @@ class SatImageCollector(object):
 
             self.setup_calls(image_overlap = 0.1)
 
+        save_dir = self.save_dir if self.save_dir is not None else ''
+        if catalog is not None:
+            catalog.add_planned(self.image_info, save_dir = save_dir, 
+                                step_offset = self.first_step, 
+                                step_idxs = self.step_idxs)
+            catalog.set_meta(self.meta_prefix + 'plan', self.plan())
+            last_step = (max(self.step_idxs) + 1 if self.step_idxs 
+                            else self.first_step + len(self.image_info))
+            catalog.set_meta(self.meta_prefix + 'step_range', 
+                             [self.first_step, last_step])
+            done_fnames = catalog.done_fnames()
+
+        to_fetch = []
         for img_fname, img_url in self.image_info:
             #first check if file is saved.
-            fpath = os.path.join(self.save_dir, img_fname)
-            if os.path.exists(fpath): 
+            fpath = os.path.join(save_dir, img_fname)
+            if catalog is not None:
+                if img_fname in done_fnames:
+                    continue
+            elif os.path.exists(fpath): 
                 continue
-            else:
-                if api_key is not None:
-                    img_url += '&key=' + api_key
-                map_req = requests.get(img_url)
+            if api_key is not None:
+                img_url += '&key=' + api_key
+            to_fetch.append((img_fname, img_url, fpath))
+
+        stats = {'requested': len(self.image_info), 
+                 'skipped': len(self.image_info) - len(to_fetch),
+                 'downloaded': 0, 'failed': []}
+        metrics.incr('tiles_requested', stats['requested'])
+        metrics.incr('tiles_skipped', stats['skipped'])
+
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections = 1, 
+                                                pool_maxsize = max(workers, 1))
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        limiter = RateLimiter(max_rps)
+        stats_lock = threading.Lock()
+        tile_queue = Queue.Queue()
+        for item in to_fetch:
+            tile_queue.put(item)
+
+        def _worker():
+            while True:
+                try:
+                    img_fname, img_url, fpath = tile_queue.get_nowait()
+                except Queue.Empty:
+                    return
+                with metrics.timer('tile_download'):
+                    err, saved_info = self._fetch_tile(session, limiter, img_url, 
+                                                        fpath, retries, backoff, 
+                                                        timeout)
+                if err is None:
+                    metrics.incr('tiles_downloaded')
+                    metrics.incr('bytes_downloaded', saved_info[0])
+                else:
+                    metrics.incr('tiles_failed')
+                if catalog is not None:
+                    if err is None:
+                        catalog.mark_done(img_fname, *saved_info)
+                    else:
+                        catalog.mark_failed(img_fname, err)
+                with stats_lock:
+                    if err is None:
+                        stats['downloaded'] += 1
+                    else:
+                        stats['failed'].append((img_fname, err))
+                        if verbose:
+                            print "Failed to get {0}: {1}".format(img_fname, err)
+
+        start_time = time.time()
+        threads = [threading.Thread(target = _worker) 
+                    for _ in range(max(workers, 1))]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            thread.join()
+        session.close()
+
+        stats['seconds'] = time.time() - start_time
+        stats['tiles_per_sec'] = (stats['downloaded'] / stats['seconds'] 
+                                    if stats['seconds'] > 0 else 0.0)
+        if verbose:
+            p_str = "Downloaded {0} tiles ({1} skipped, {2} failed) in {3:.1f}s: {4:.2f} tiles/sec"
+            print p_str.format(stats['downloaded'], stats['skipped'], 
+                                len(stats['failed']), stats['seconds'], 
+                                stats['tiles_per_sec'])
+
+        return stats
+
+
+    def _fetch_tile(self, session, limiter, img_url, fpath, retries, backoff, 
+                    timeout):
+        """
+        Helper for get_images. Download one image and write it to fpath, 
+        retrying failed calls with exponential backoff.
+
+        Returns (error, saved_info) where error is None on success, otherwise 
+        a string describing the last error, and saved_info is None on failure,
+        otherwise the (byte size, md5 hex digest) of the saved image.
+        """
+        err, content = self.download(session, limiter, img_url, retries, 
+                                        backoff, timeout)
+        if err is not None:
+            return err, None
 
-                if map_req.status_code != 200:
-                    except_s = "Received a {0} error when requesting img: {1}"
-                    raise Exception(except_s.format(map_req.status_code, fname))
+        #write to a temp name so an interrupted run never leaves a partial tile
+        tmp_path = fpath + '.part'
+        with open(tmp_path, 'wb') as fout:
+            fout.write(content)
+        os.rename(tmp_path, fpath)
+        return None, (len(content), hashlib.md5(content).hexdigest())
+
+
+    def download(self, session, limiter, img_url, retries = 3, backoff = 1.0, 
+                    timeout = 30):
+        """
+        Download one image into memory, retrying failed calls with exponential
+        backoff.
+
+        INPUT:
+        session: (requests.Session) shared, pooled HTTP session.
+        limiter: (utils.RateLimiter) shared requests per second cap.
+        img_url: (str) API url, with key.
+        Other args: see get_images.
 
-                with open(fpath, 'wb') as fout:
-                    fout.write(map_req.content)
+        OUTPUT:
+        (pair) (error, content): error is None on success, else a string 
+               describing the last error, content is the image bytes or None.
+        """
+        err = None
+        for attempt in range(retries + 1):
+            if attempt > 0:
+                metrics.incr('tile_retries')
+                time.sleep(backoff * (2 ** (attempt - 1)))
+            limiter.wait()
+            try:
+                map_req = session.get(img_url, timeout = timeout)
+            except requests.exceptions.RequestException as e:
+                err = str(e)
+                continue
 
+            if map_req.status_code != 200:
+                err = "Received a {0} error".format(map_req.status_code)
+                continue
+            return None, map_req.content
 
+        return err, None
 
 
 
@@ -135,63 +351,87 @@ class SatImageCollector(object):
         """
         Given an x,y pixel location on a Google Map image (with known center lat/lng
         and zoom level) return the latitude and longitude of the pixel.
-        Uses "Web Mercator" projection.
+        Uses "Web Mercator" projection, see web_mercator.py for the batched
+        versions of this and of the inverse transform.
 
         pix_x, pix_y: pixel coordinate values (float)
-        zoom:  (int)
-        dim_x, dim_y: pixel dimensions of image
 
 
         Returns (lat, lng) tuple as floats.
         """
 
-        imcenterlat = self.init_lat
-        imcenterlng = self.init_lng
         dim = self.scale * self.image_size
-        #Google uses powers of 2 to define zoom, thus a scale of 2 represents zoom += 1 
-        zoom = self.effective_zoom
-        
-
-
-        ## Assumes pixel coordinates are centered so center of image 
-        ## (with even-numbered dimensions) is 0.5 pix from dim / 2
-        ## with zero-indexing subtract this factor
-        center = (dim // 2.0) - 0.5
-
-        scalefact = 128.0 * math.pow(2, zoom) / math.pi
-
-        center_abs_x = scalefact * math.pi * ((imcenterlng / 180.) + 1.)
-        y_term = (math.pi - math.log(math.tan(math.pi * (0.25 + imcenterlat/360.0))))
-        center_abs_y = scalefact * y_term
-
-        abs_pix_x = center_abs_x + (pix_x - center)
-        abs_pix_y = center_abs_y + (pix_y - center)
-        
-        exp_term = math.exp(math.pi - (abs_pix_y/scalefact))
-        lat = 180./math.pi * (2. * math.atan(exp_term) - (math.pi/2.0))
-        lng = 180./math.pi * ((abs_pix_x/scalefact) - math.pi)
-
-        return lat, lng
-
-
-
-
-
-
+        lat, lng = pix2latlng(pix_x, pix_y, self.init_lat, self.init_lng, 
+                                self.effective_zoom, dim)
+
+        return float(lat), float(lng)
+
+
+
+
+
+
+
+
+def add_arguments(ap):
+    """Add the command line arguments of this script to an ArgumentParser."""
+    ap.add_argument('latitude', type=float, help="Latitude of the center tile.")
+    ap.add_argument('longitude', type=float, help="Longitude of the center tile.")
+    ap.add_argument('-n', '--max_tiles', type=int, default=2500, 
+                    help="Number of tiles to collect.")
+    ap.add_argument('-z', '--zoom', type=int, default=17, help="API zoom level.")
+    ap.add_argument('-o', '--outpath', help="Directory to save images in.")
+    ap.add_argument('-k', '--key', help="Google Maps API key.")
+    ap.add_argument('-w', '--workers', type=int, default=1, 
+                    help="Number of concurrent downloads.")
+    ap.add_argument('-r', '--rps', type=float, 
+                    help="Maximum requests per second.")
+    ap.add_argument('--retries', type=int, default=3, 
+                    help="Retries per tile after a failed call.")
+    ap.add_argument('-c', '--catalog', 
+                    help="SQLite tile catalog to record and resume the run with.")
+    metrics_help = "Write run metrics to this file: Prometheus textfile if it ends in .prom, else JSON."
+    ap.add_argument('-m', '--metrics', help=metrics_help)
+    shard_group = ap.add_mutually_exclusive_group()
+    shard_group.add_argument('--shard', type=sharding.parse_shard, 
+                    help="Only collect shard INDEX/COUNT of the tiles, e.g. 0/4 (see sharding.py).")
+    shard_group.add_argument('--steps', type=sharding.parse_step_range, 
+                    help="Only collect spiral steps FIRST:LAST, e.g. 0:25000.")
+    ap.add_argument('--api-url', default='http://maps.googleapis.com/maps/api/staticmap?',
+                    help="Base url of the static maps API, e.g. a local server for testing.")
+
+
+def main(args):
+    """Collect tiles with parsed command line arguments, see add_arguments."""
+    if args.metrics:
+        metrics.enable()
+    step_range = args.steps
+    if args.shard is not None:
+        step_range = sharding.shard_range(args.max_tiles, *args.shard)
+    imgs_obj = SatImageCollector(args.latitude, args.longitude, 
+                                    max_tiles = args.max_tiles, zoom = args.zoom, 
+                                    save_dir = args.outpath, api_url = args.api_url,
+                                    step_range = step_range)
+    catalog_path = args.catalog
+    if (catalog_path is None) and (step_range is not None):
+        #a shard always records its tiles, for sharding.py to merge
+        catalog_path = os.path.join(args.outpath or '', 
+                                    'shard_{0}_{1}.db'.format(*step_range))
+    catalog = TileCatalog(catalog_path) if catalog_path else None
+    imgs_obj.get_images(api_key = args.key, workers = args.workers, 
+                        max_rps = args.rps, retries = args.retries, 
+                        catalog = catalog)
+    if args.metrics:
+        metrics.export(args.metrics)
 
 
 if __name__ == '__main__':
-    # testing
-    # #imgs_obj = SatImageCollector(36.1699390347, -115.139826918, max_tiles = 2500)
-    # imgs_obj = SatImageCollector(29.7604243716,-95.3698001178, max_tiles = 2500)
-    
-    # for imgfile in [x[0] for x in imgs_obj.setup_calls()][-10:]:
-    #     print imgfile
-
-    # imgs_obj = SatImageCollector(29.7604243716,-95.3698001178, max_tiles = 5, save_dir = 'tmp')
-    # import datetime
-    # print datetime.datetime.now()
-    # imgs_obj.get_images()
-    # print datetime.datetime.now()
-
-
+    """
+    example usage:
+    python google_satellite_images.py 36.1699390347 -115.139826918 \
+     -n 2500 -o output/tiles/dir -w 8 -r 10 -k YOUR_API_KEY
+    (or: python pipeline.py collect ...)
+    """
+    ap = argparse.ArgumentParser()
+    add_arguments(ap)
+    main(ap.parse_args())
@@ -0,0 +1,65 @@
+"""
+uint8 RGB image reading and writing with PIL.
+
+matplotlib's imread gives float32 RGBA arrays for PNGs, 16 bytes a pixel
+against 3 for uint8 RGB. Here pixels stay uint8 from disk through ROI
+cutting and storage, any alpha channel is dropped at read time, and
+conversion to float is left to the mini-batches fed to a net.
+"""
+from multiprocessing.pool import ThreadPool
+import numpy as np
+from PIL import Image
+
+
+def read_rgb(path):
+    """(array) uint8 image of shape (rows, cols, 3). Alpha, palettes and gray are converted."""
+    img = Image.open(path)
+    if img.mode != 'RGB':
+        img = img.convert('RGB')
+    return np.asarray(img, dtype = np.uint8)
+
+
+def read_gray(path):
+    """(array) uint8 luminance image of shape (rows, cols)."""
+    return np.asarray(Image.open(path).convert('L'), dtype = np.uint8)
+
+
+def write_rgb(path, img_arr):
+    """Write an RGB(A) image, uint8 or float in [0, 1], as an RGB PNG (or the format of path's extension)."""
+    img_arr = to_uint8(np.asarray(img_arr))
+    if (img_arr.ndim == 3) and (img_arr.shape[2] == 4):
+        img_arr = img_arr[:, :, :3]
+    Image.fromarray(np.ascontiguousarray(img_arr)).save(path)
+
+
+def to_uint8(img_arr):
+    """uint8 copy of a float image in [0, 1] (as from matplotlib's imread), uint8 images unchanged."""
+    if img_arr.dtype == np.uint8:
+        return img_arr
+    return np.round(np.clip(img_arr, 0, 1) * 255).astype(np.uint8)
+
+
+def read_many(paths, workers = 4, reader = read_rgb):
+    """
+    Decode images in a pool of threads (PIL releases the GIL while it decodes).
+
+    INPUT:
+    paths: (list of str) image files.
+    workers: (int) Number of decoding threads. 1 decodes in this thread.
+    reader: (function) path -> array, read_rgb or read_gray.
+
+    OUTPUT:
+    (iterator) of the decoded arrays, in the order of paths.
+    """
+    if workers <= 1:
+        return (reader(path) for path in paths)
+    return _imap_pool(reader, paths, workers)
+
+
+def _imap_pool(reader, paths, workers):
+    pool = ThreadPool(workers)
+    try:
+        for img_arr in pool.imap(reader, paths, chunksize = 8):
+            yield img_arr
+    finally:
+        pool.terminate()
@@ -0,0 +1,209 @@
+"""
+Merge detections from many overlapping tiles into one deduplicated list of
+georeferenced points.
+
+Detection pixel locations are converted to lat/lng with the tile center and
+zoom from the tile file name, then greedily non-max suppressed across all
+tiles with a grid hash spatial index, so the same object seen in two
+overlapping tiles is reported once.
+
+example usage (heatmaps written by neural_nets/detect_tiles.py):
+python merge_detections.py heatmaps/dir -t 0.9 -r 10 -o detections.geojson
+"""
+import argparse
+import csv
+import glob
+import json
+import math
+import numpy as np
+import os
+from utils import parse_tile_fname
+from web_mercator import pix2latlng
+
+EARTH_RADIUS_M = 6371008.8
+
+
+def heatmap_detections(heatmap, threshold, window = 48, stride = 16):
+    """
+    Window centers of a detect_tiles heatmap scoring at least threshold.
+
+    OUTPUT:
+    (tuple of arrays) cols, rows (pixel centers in the tile) and scores.
+    """
+    grid_rows, grid_cols = np.nonzero(heatmap >= threshold)
+    return (grid_cols * stride + window // 2, grid_rows * stride + window // 2,
+            heatmap[grid_rows, grid_cols])
+
+
+def detections_to_latlng(img_files, cols, rows, dim = 1280):
+    """
+    Convert detection pixel locations to lat/lng in one vectorized pass.
+
+    INPUT:
+    img_files: (list or array of str) tile file name of each detection, in
+               the naming convention of SatImageCollector.
+    cols, rows: (arrays) pixel location of each detection in its tile.
+    dim: (int) pixel side length of the tiles (scale * image_size).
+
+    OUTPUT:
+    (pair of arrays) lat, lng.
+    """
+    img_files = np.asarray(img_files)
+    unique_files, file_idx = np.unique(img_files, return_inverse = True)
+    tiles = [parse_tile_fname(fname) for fname in unique_files]
+    center_lats = np.array([tile['lat'] for tile in tiles])[file_idx]
+    center_lngs = np.array([tile['lng'] for tile in tiles])[file_idx]
+    zooms = np.array([tile['zoom'] for tile in tiles], dtype = np.float64)[file_idx]
+
+    return pix2latlng(cols, rows, center_lats, center_lngs, zooms, dim)
+
+
+def nms_merge(lats, lngs, scores, radius_m = 10.0):
+    """
+    Greedy non-max suppression: going from the highest score down, keep a
+    detection unless a kept detection lies within radius_m meters. Kept
+    detections are found through a grid hash with radius_m sized cells, so
+    each detection only checks the 9 cells around it.
+
+    Distances use a local equirectangular projection around the mean
+    latitude, which is accurate at city scale.
+
+    OUTPUT:
+    (pair of arrays) indices of the kept detections, in descending score
+    order, and the number of detections each one absorbed (itself included).
+    """
+    lats = np.asarray(lats, dtype = np.float64)
+    lngs = np.asarray(lngs, dtype = np.float64)
+    if len(lats) == 0:
+        return np.array([], dtype = np.int64), np.array([], dtype = np.int64)
+
+    lat_ref = math.radians(lats.mean())
+    x_m = np.radians(lngs) * math.cos(lat_ref) * EARTH_RADIUS_M
+    y_m = np.radians(lats) * EARTH_RADIUS_M
+    cell_x = np.floor(x_m / radius_m).astype(np.int64)
+    cell_y = np.floor(y_m / radius_m).astype(np.int64)
+    radius_sq = radius_m ** 2
+
+    order = np.argsort(-np.asarray(scores), kind = 'mergesort')
+    #plain python lists are much faster than numpy scalars in the loop
+    x_m, y_m = x_m.tolist(), y_m.tolist()
+    cell_x, cell_y = cell_x.tolist(), cell_y.tolist()
+    grid = {}
+    kept = []
+    support = []
+    for i in order.tolist():
+        cx, cy = cell_x[i], cell_y[i]
+        xi, yi = x_m[i], y_m[i]
+        absorbed_by = None
+        for nx in (cx - 1, cx, cx + 1):
+            for ny in (cy - 1, cy, cy + 1):
+                for k in grid.get((nx, ny), ()):
+                    j = kept[k]
+                    if (x_m[j] - xi) ** 2 + (y_m[j] - yi) ** 2 <= radius_sq:
+                        absorbed_by = k
+                        break
+                if absorbed_by is not None:
+                    break
+            if absorbed_by is not None:
+                break
+
+        if absorbed_by is None:
+            grid.setdefault((cx, cy), []).append(len(kept))
+            kept.append(i)
+            support.append(1)
+        else:
+            support[absorbed_by] += 1
+
+    return np.array(kept, dtype = np.int64), np.array(support, dtype = np.int64)
+
+
+def load_heatmap_detections(heatmap_dir, threshold, window = 48, stride = 16):
+    """
+    Thresholded detections of all the .npy heatmaps in heatmap_dir, named
+    after their tiles as written by detect_tiles.py.
+
+    OUTPUT:
+    (tuple of arrays) img_files, cols, rows, scores.
+    """
+    files_l, cols_l, rows_l, scores_l = [], [], [], []
+    for heatmap_path in sorted(glob.glob(os.path.join(heatmap_dir, '*.npy'))):
+        cols, rows, scores = heatmap_detections(np.load(heatmap_path),
+                                                threshold, window, stride)
+        img_file = os.path.splitext(os.path.basename(heatmap_path))[0] + '.png'
+        files_l.append(np.repeat(img_file, len(scores)))
+        cols_l.append(cols)
+        rows_l.append(rows)
+        scores_l.append(scores)
+
+    if not files_l:
+        raise Exception("No heatmaps found in: {0}".format(heatmap_dir))
+    return (np.concatenate(files_l), np.concatenate(cols_l),
+            np.concatenate(rows_l), np.concatenate(scores_l))
+
+
+def load_csv_detections(csv_path):
+    """
+    Detections from a CSV with header: img_file,col,row,score
+
+    OUTPUT:
+    (tuple of arrays) img_files, cols, rows, scores.
+    """
+    with open(csv_path) as fin:
+        records = list(csv.DictReader(fin))
+    return (np.array([r['img_file'] for r in records]),
+            np.array([float(r['col']) for r in records]),
+            np.array([float(r['row']) for r in records]),
+            np.array([float(r['score']) for r in records]))
+
+
+def write_geojson(out_path, lats, lngs, scores, support):
+    """Write merged detections as a GeoJSON FeatureCollection of points."""
+    with open(out_path, 'w') as fout:
+        fout.write('{"type": "FeatureCollection", "features": [\n')
+        for i, (lat, lng, score, count) in enumerate(zip(lats.tolist(),
+                                                          lngs.tolist(),
+                                                          scores.tolist(),
+                                                          support.tolist())):
+            feature = {'type': 'Feature',
+                       'geometry': {'type': 'Point', 'coordinates': [lng, lat]},
+                       'properties': {'score': score, 'support': count}}
+            fout.write((',\n' if i else '') + json.dumps(feature))
+        fout.write('\n]}\n')
+
+
+def write_csv(out_path, lats, lngs, scores, support):
+    """Write merged detections as CSV with header: lat,lng,score,support"""
+    with open(out_path, 'wb') as fout:
+        writer = csv.writer(fout)
+        writer.writerow(['lat', 'lng', 'score', 'support'])
+        writer.writerows(zip(lats.tolist(), lngs.tolist(), scores.tolist(),
+                             support.tolist()))
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    in_help = "Directory of detect_tiles.py heatmaps, or a CSV of img_file,col,row,score detections."
+    ap.add_argument('detections', help=in_help)
+    ap.add_argument('-o', '--out', required=True,
+                    help="Output file, .geojson or .csv")
+    ap.add_argument('-t', '--threshold', type=float, default=0.5,
+                    help="Minimum heatmap probability of a detection.")
+    ap.add_argument('-w', '--window', type=int, default=48, help="Heatmap window size.")
+    ap.add_argument('-s', '--stride', type=int, default=16, help="Heatmap stride.")
+    ap.add_argument('-r', '--radius', type=float, default=10.0,
+                    help="Merge detections closer than this many meters.")
+    ap.add_argument('-d', '--dim', type=int, default=1280, help="Tile side length in pixels.")
+
+    args = ap.parse_args()
+    if os.path.isdir(args.detections):
+        img_files, cols, rows, scores = load_heatmap_detections(
+            args.detections, args.threshold, args.window, args.stride)
+    else:
+        img_files, cols, rows, scores = load_csv_detections(args.detections)
+
+    lats, lngs = detections_to_latlng(img_files, cols, rows, dim = args.dim)
+    kept, support = nms_merge(lats, lngs, scores, radius_m = args.radius)
+
+    writer = write_csv if args.out.endswith('.csv') else write_geojson
+    writer(args.out, lats[kept], lngs[kept], scores[kept], support)
+    print "Merged {0} detections into {1}".format(len(scores), len(kept))
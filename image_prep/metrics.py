@@ -0,0 +1,195 @@
+"""
+Process wide counters and timers for finding where a run spends its time
+(network, PNG decode, disk writes, the model).
+
+Metrics are off by default. When they are off, incr is a flag check and
+timer returns a shared do nothing context manager, so the hooks left in the
+pipeline cost next to nothing.
+
+example usage:
+import metrics
+metrics.enable()
+with metrics.timer('png_decode'):
+    img = imread(path)
+metrics.incr('samples_loaded')
+metrics.export('run_metrics.prom')  #or .json
+"""
+import json
+import os
+import threading
+import time
+
+_enabled = False
+_lock = threading.Lock()
+_counters = {}
+#name -> [count, total seconds, max seconds]
+_timers = {}
+_start_time = time.time()
+
+
+def enable():
+    """Start recording, from a clean slate."""
+    global _enabled
+    reset()
+    _enabled = True
+
+
+def disable():
+    global _enabled
+    _enabled = False
+
+
+def is_enabled():
+    return _enabled
+
+
+def reset():
+    global _start_time
+    with _lock:
+        _counters.clear()
+        _timers.clear()
+        _start_time = time.time()
+
+
+def incr(name, value = 1):
+    """Add value to counter name."""
+    if not _enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def add_time(name, seconds, count = 1):
+    """Record count timed events totalling seconds under timer name."""
+    if not _enabled:
+        return
+    with _lock:
+        stats = _timers.get(name)
+        if stats is None:
+            _timers[name] = [count, seconds, seconds]
+        else:
+            stats[0] += count
+            stats[1] += seconds
+            stats[2] = max(stats[2], seconds)
+
+
+class _Timer(object):
+
+    __slots__ = ('name', 'start')
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        add_time(self.name, time.time() - self.start)
+        return False
+
+
+class _NullTimer(object):
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+_NULL_TIMER = _NullTimer()
+
+
+def timer(name):
+    """(context manager) time the block under timer name."""
+    if not _enabled:
+        return _NULL_TIMER
+    return _Timer(name)
+
+
+def snapshot():
+    """
+    OUTPUT:
+    (dict) 'elapsed_seconds' since enable/reset, 'counters' {name: value},
+           'rates' {name: counter value per elapsed second} and 'timers'
+           {name: {'count', 'total_seconds', 'mean_ms', 'max_ms'}}.
+    """
+    with _lock:
+        counters = dict(_counters)
+        timers = dict((name, list(stats)) for name, stats in _timers.items())
+        elapsed = time.time() - _start_time
+
+    timer_d = {}
+    for name, (count, total, longest) in timers.items():
+        timer_d[name] = {'count': count, 'total_seconds': total,
+                         'mean_ms': 1000.0 * total / count if count else 0.0,
+                         'max_ms': 1000.0 * longest}
+    rates = dict((name, value / elapsed if elapsed > 0 else 0.0)
+                 for name, value in counters.items())
+    return {'elapsed_seconds': elapsed, 'counters': counters, 'rates': rates,
+            'timers': timer_d}
+
+
+def pop_raw():
+    """
+    (dict) the raw counters and timers recorded so far, and clear them. Used
+    to send a worker process's metrics back to the parent, see merge_raw.
+    None when metrics are off.
+    """
+    if not _enabled:
+        return None
+    with _lock:
+        raw = {'counters': dict(_counters),
+               'timers': dict((name, list(stats)) for name, stats in _timers.items())}
+        _counters.clear()
+        _timers.clear()
+    return raw
+
+
+def merge_raw(raw):
+    """Add the output of pop_raw (e.g. from a worker process) to this process's metrics."""
+    if (not _enabled) or (raw is None):
+        return
+    with _lock:
+        for name, value in raw['counters'].items():
+            _counters[name] = _counters.get(name, 0) + value
+        for name, (count, total, longest) in raw['timers'].items():
+            stats = _timers.get(name)
+            if stats is None:
+                _timers[name] = [count, total, longest]
+            else:
+                stats[0] += count
+                stats[1] += total
+                stats[2] = max(stats[2], longest)
+
+
+def prometheus_text(prefix = 'satclass_'):
+    """(str) snapshot in the Prometheus text exposition format."""
+    snap = snapshot()
+    lines = []
+    for name in sorted(snap['counters']):
+        metric = prefix + name + '_total'
+        lines.append('# TYPE {0} counter'.format(metric))
+        lines.append('{0} {1}'.format(metric, snap['counters'][name]))
+    for name in sorted(snap['timers']):
+        metric = prefix + name + '_seconds'
+        lines.append('# TYPE {0} summary'.format(metric))
+        lines.append('{0}_count {1}'.format(metric, snap['timers'][name]['count']))
+        lines.append('{0}_sum {1!r}'.format(metric, snap['timers'][name]['total_seconds']))
+    return '\n'.join(lines) + '\n'
+
+
+def export(path, prefix = 'satclass_'):
+    """
+    Write the metrics to path: a Prometheus textfile if path ends in .prom,
+    else a JSON summary. The file is replaced atomically, so a textfile
+    collector never reads a partial file.
+    """
+    if path.endswith('.prom'):
+        text = prometheus_text(prefix)
+    else:
+        text = json.dumps(snapshot(), indent = 2, sort_keys = True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as fout:
+        fout.write(text)
+    os.rename(tmp_path, path)
@@ -0,0 +1,187 @@
+"""
+Stitch collected tiles into one large disk backed raster, so windows that
+straddle tile boundaries can be read without seams or duplicates.
+
+Tiles are placed by their spiral step and the pixel_step used by
+SatImageCollector.setup_calls. Where adjacent tiles overlap, each side keeps
+half of the overlap, so every mosaic pixel comes from exactly one tile.
+
+example usage:
+python mosaic.py path/to/tiles/dir -o mosaic/dir -s 1152
+python mosaic.py -c tiles.db -o mosaic/dir -s 1152
+"""
+import argparse
+import glob
+import json
+import numpy as np
+import os
+from image_io import read_rgb
+from tile_catalog import TileCatalog
+from utils import parse_tile_fname
+from web_mercator import latlng2worldpix, worldpix2latlng
+
+
+class TileMosaic(object):
+    """
+    Memory mapped uint8 RGB mosaic of a collection of tiles. A mosaic is a
+    directory with the raw pixels (mosaic.u8, rows x cols x 3 in C order)
+    and mosaic.json holding its shape and georeferencing.
+    """
+
+    def __init__(self, path, mode = 'r'):
+        """
+        INPUT:
+        path: (str) directory of a mosaic written by TileMosaic.build.
+        mode: (str) memmap mode, 'r' for read only or 'r+' to modify.
+        """
+        self.path = path
+        with open(os.path.join(path, 'mosaic.json')) as fin:
+            self.meta = json.load(fin)
+        self.pixels = np.memmap(os.path.join(path, 'mosaic.u8'),
+                                dtype = np.uint8, mode = mode,
+                                shape = tuple(self.meta['shape']))
+
+
+    @classmethod
+    def build(cls, out_dir, tile_paths, pixel_step, verbose = True):
+        """
+        Write a mosaic of tiles.
+
+        INPUT:
+        out_dir: (str) directory to write the mosaic to.
+        tile_paths: (list of str) tile images, named in the convention of
+                    SatImageCollector. All at the same zoom and size.
+        pixel_step: (int) pixels between adjacent tile centers, 1152 with
+                    the setup_calls defaults.
+
+        OUTPUT:
+        (TileMosaic) the new mosaic, opened read only.
+        """
+        if not tile_paths:
+            raise Exception("No tiles to build a mosaic from.")
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+
+        tiles = [parse_tile_fname(path) for path in tile_paths]
+        zooms = set(tile['zoom'] for tile in tiles)
+        if len(zooms) > 1:
+            raise Exception("Tiles have mixed zoom levels: {0}".format(sorted(zooms)))
+        zoom = zooms.pop()
+        dim = read_rgb(tile_paths[0]).shape[0]
+        steps = set((tile['xstep'], tile['ystep']) for tile in tiles)
+        xmin = min(x for x, _ in steps)
+        ymin = min(y for _, y in steps)
+        xmax = max(x for x, _ in steps)
+        ymax = max(y for _, y in steps)
+
+        #world pixel of the (0, 0) step's center, from the first tile
+        world_x, world_y = latlng2worldpix(tiles[0]['lat'], tiles[0]['lng'], zoom)
+        origin_x = float(world_x) - tiles[0]['xstep'] * pixel_step
+        origin_y = float(world_y) - tiles[0]['ystep'] * pixel_step
+
+        meta = {'shape': [(ymax - ymin) * pixel_step + dim,
+                          (xmax - xmin) * pixel_step + dim, 3],
+                'pixel_step': pixel_step, 'dim': dim, 'zoom': zoom,
+                'xmin': xmin, 'ymin': ymin,
+                'origin_world': [origin_x, origin_y],
+                'tiles': sorted(os.path.basename(path) for path in tile_paths)}
+        pixels = np.memmap(os.path.join(out_dir, 'mosaic.u8'), dtype = np.uint8,
+                           mode = 'w+', shape = tuple(meta['shape']))
+
+        overlap = dim - pixel_step
+        for tile_path, tile in zip(tile_paths, tiles):
+            x, y = tile['xstep'], tile['ystep']
+            #keep half of the overlap on sides with a neighbor, all of it otherwise
+            row0 = overlap // 2 if (x, y - 1) in steps else 0
+            row1 = dim - (overlap - overlap // 2) if (x, y + 1) in steps else dim
+            col0 = overlap // 2 if (x - 1, y) in steps else 0
+            col1 = dim - (overlap - overlap // 2) if (x + 1, y) in steps else dim
+
+            img_arr = read_rgb(tile_path)
+            top = (y - ymin) * pixel_step
+            left = (x - xmin) * pixel_step
+            pixels[top + row0:top + row1, left + col0:left + col1] = \
+                img_arr[row0:row1, col0:col1]
+
+        pixels.flush()
+        del pixels
+        with open(os.path.join(out_dir, 'mosaic.json'), 'w') as fout:
+            json.dump(meta, fout)
+        if verbose:
+            print "Built {0}x{1} mosaic from {2} tiles".format(
+                        meta['shape'][1], meta['shape'][0], len(tile_paths))
+
+        return cls(out_dir)
+
+
+    def tile_to_mosaic(self, xstep, ystep, cols, rows):
+        """(pair) mosaic pixel cols, rows of pixels in the tile at a step."""
+        pixel_step = self.meta['pixel_step']
+        return (np.asarray(cols) + (xstep - self.meta['xmin']) * pixel_step,
+                np.asarray(rows) + (ystep - self.meta['ymin']) * pixel_step)
+
+
+    def latlng2pix(self, lat, lng):
+        """(pair of arrays) mosaic pixel cols, rows (floats) of lat/lng points."""
+        world_x, world_y = latlng2worldpix(lat, lng, self.meta['zoom'])
+        center_x, center_y = self._origin_center()
+        return (world_x - self.meta['origin_world'][0] + center_x,
+                world_y - self.meta['origin_world'][1] + center_y)
+
+
+    def pix2latlng(self, cols, rows):
+        """(pair of arrays) lat, lng of mosaic pixels."""
+        center_x, center_y = self._origin_center()
+        world_x = np.asarray(cols, dtype = np.float64) - center_x + self.meta['origin_world'][0]
+        world_y = np.asarray(rows, dtype = np.float64) - center_y + self.meta['origin_world'][1]
+        return worldpix2latlng(world_x, world_y, self.meta['zoom'])
+
+
+    def read(self, row0, col0, rows, cols):
+        """
+        (array) view of a (rows, cols, 3) window of the mosaic with upper left
+        corner (row0, col0), clipped to the mosaic. Only the pages touched are
+        read from disk.
+        """
+        #the far edges are set before clipping, so a window starting above or
+        #left of the mosaic loses those rows/cols instead of shifting
+        row1, col1 = int(row0) + int(rows), int(col0) + int(cols)
+        return self.pixels[max(int(row0), 0):max(row1, 0),
+                           max(int(col0), 0):max(col1, 0)]
+
+
+    def read_latlng(self, min_lat, min_lng, max_lat, max_lng):
+        """(array) view of the mosaic window covering a lat/lng box."""
+        left, bottom = self.latlng2pix(min_lat, min_lng)
+        right, top = self.latlng2pix(max_lat, max_lng)
+        row0, col0 = int(np.floor(top)), int(np.floor(left))
+        return self.read(row0, col0, int(np.ceil(bottom)) - row0 + 1,
+                         int(np.ceil(right)) - col0 + 1)
+
+
+    def _origin_center(self):
+        #mosaic pixel of the (0, 0) step tile's center, as in web_mercator
+        pixel_step = self.meta['pixel_step']
+        center = (self.meta['dim'] // 2) - 0.5
+        return (center - self.meta['xmin'] * pixel_step,
+                center - self.meta['ymin'] * pixel_step)
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument('tiles', nargs='?', help="Directory of tile images.")
+    ap.add_argument('-c', '--catalog', help="Tile catalog to take the saved tiles from.")
+    ap.add_argument('-o', '--outpath', required=True, help="Directory to write the mosaic to.")
+    ap.add_argument('-s', '--step', type=int, default=1152,
+                    help="Pixels between adjacent tile centers.")
+
+    args = ap.parse_args()
+    if args.catalog:
+        tile_paths = [tile['path'] for tile in
+                      TileCatalog(args.catalog).query(status = 'done')]
+    elif args.tiles:
+        tile_paths = sorted(glob.glob(os.path.join(args.tiles, 'img*.png')))
+    else:
+        ap.error("Either a tiles directory or a catalog is required.")
+
+    TileMosaic.build(args.outpath, tile_paths, args.step)
@@ -0,0 +1,307 @@
+"""
+Perceptual hashes of ROIs, to find near-duplicate samples: the same object
+cut from two overlapping tiles, or clicked twice in one tile.
+
+A hash is the sign pattern (above or below the median) of the 8 x 8 lowest
+frequencies of the 2D DCT of the ROI's luminance, shrunk to 32 x 32. Whole
+batches are hashed at once with matrix products, so hashing costs about as
+much as reading the pixels. Near-duplicates are hashes within a small
+Hamming distance of each other, found through a BK-tree.
+
+Used by cut_and_save_rois.batch_roi_writer and pipeline.run_pipeline
+(dedup_distance) to skip near-duplicates as ROIs are written, and by
+nolearn.py to keep groups of near-duplicates on one side of the
+train/validation split.
+
+example usage:
+python phash.py rois/store -d 4 -o rois_groups.json
+"""
+import argparse
+import glob
+import json
+import numpy as np
+import os
+from image_io import read_many
+from roi_store import RoiStore
+
+HASH_SIZE = 8
+DCT_SIZE = 32
+
+#number of set bits of each byte value
+_POPCOUNT = np.array([bin(byte).count('1') for byte in xrange(256)],
+                     dtype = np.uint8)
+
+
+def _area_matrix(n_in, n_out):
+    """(n_out, n_in) matrix averaging n_in samples down to n_out (box filter)."""
+    edges = np.linspace(0, n_in, n_out + 1)
+    starts = np.maximum(np.minimum(edges[:-1, np.newaxis], np.arange(n_in) + 1) -
+                        np.arange(n_in), 0)
+    ends = np.maximum(np.minimum(edges[1:, np.newaxis], np.arange(n_in) + 1) -
+                      np.arange(n_in), 0)
+    weights = ends - starts
+    return weights / weights.sum(axis = 1, keepdims = True)
+
+
+def _dct_matrix(n):
+    """(n, n) orthonormal DCT-II matrix."""
+    k = np.arange(n)[:, np.newaxis]
+    dct = np.cos(np.pi * (2 * np.arange(n) + 1) * k / (2.0 * n)) * np.sqrt(2.0 / n)
+    dct[0] /= np.sqrt(2.0)
+    return dct
+
+
+def phash_batch(rois):
+    """
+    Perceptual hashes of a batch of ROIs.
+
+    INPUT:
+    rois: (array) of shape (N, rows, cols, channels) or (N, rows, cols),
+          uint8 or float.
+
+    OUTPUT:
+    (array) N uint64 hashes.
+    """
+    rois = np.asarray(rois)
+    if rois.ndim == 4 and rois.shape[3] >= 3:
+        #ITU-R 601 luma, as PIL's convert('L')
+        gray = np.dot(rois[..., :3].astype(np.float32),
+                      np.array([0.299, 0.587, 0.114], dtype = np.float32))
+    elif rois.ndim == 4:
+        gray = rois[..., 0].astype(np.float32)
+    else:
+        gray = rois.astype(np.float32)
+    shrink_rows = _area_matrix(gray.shape[1], DCT_SIZE).astype(np.float32)
+    shrink_cols = _area_matrix(gray.shape[2], DCT_SIZE).astype(np.float32)
+    dct = _dct_matrix(DCT_SIZE)[:HASH_SIZE].astype(np.float32)
+
+    #rows and cols are shrunk and transformed in one product each
+    left = np.dot(dct, shrink_rows)
+    right = np.dot(dct, shrink_cols).T
+    low = np.matmul(np.matmul(left, gray), right).reshape(len(gray), -1)
+    bits = low > np.median(low, axis = 1, keepdims = True)
+    return np.packbits(bits, axis = 1).view('>u8').ravel().astype(np.uint64)
+
+
+def hash_rois(X, batch_size = 1024):
+    """(array) hashes of all ROIs of a (possibly memory mapped) array, batch_size at a time."""
+    if len(X) == 0:
+        return np.zeros(0, dtype = np.uint64)
+    return np.concatenate([phash_batch(X[start:start + batch_size])
+                           for start in xrange(0, len(X), batch_size)])
+
+
+def hamming_distance(hashes_a, hashes_b):
+    """(array) numbers of differing bits between uint64 hashes, broadcasting."""
+    xor = np.bitwise_xor(np.asarray(hashes_a, dtype = np.uint64),
+                         np.asarray(hashes_b, dtype = np.uint64))
+    xor = np.ascontiguousarray(xor)
+    return _POPCOUNT[xor[..., np.newaxis].view(np.uint8)].sum(axis = -1)
+
+
+class BKTree(object):
+    """
+    Burkhard-Keller tree of integer hashes under the Hamming distance. A
+    node's children are keyed by their distance to it, so the triangle
+    inequality prunes all but a few branches of a radius query.
+    """
+
+    def __init__(self):
+        #nodes are [hash, list of items, {distance: child node}]
+        self.root = None
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, hash_val, item):
+        hash_val = int(hash_val)
+        self.size += 1
+        if self.root is None:
+            self.root = [hash_val, [item], {}]
+            return
+        node = self.root
+        while True:
+            dist = bin(hash_val ^ node[0]).count('1')
+            if dist == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(dist)
+            if child is None:
+                node[2][dist] = [hash_val, [item], {}]
+                return
+            node = child
+
+    def query(self, hash_val, max_distance):
+        """(list of pairs) (item, distance) of all items within max_distance of hash_val."""
+        hash_val = int(hash_val)
+        found = []
+        stack = [self.root] if self.root is not None else []
+        while stack:
+            node = stack.pop()
+            dist = bin(hash_val ^ node[0]).count('1')
+            if dist <= max_distance:
+                found.extend((item, dist) for item in node[1])
+            for child_dist, child in node[2].iteritems():
+                if abs(child_dist - dist) <= max_distance:
+                    stack.append(child)
+        return found
+
+
+class PHashIndex(object):
+    """
+    Index of labeled ROI hashes that tells whether a new ROI near-duplicates
+    one already in it with the same label.
+    """
+
+    def __init__(self, max_distance = 4):
+        """
+        INPUT:
+        max_distance: (int) largest Hamming distance (of 64 bits) at which
+                      two ROIs count as near-duplicates.
+        """
+        self.max_distance = max_distance
+        self.tree = BKTree()
+
+    def __len__(self):
+        return len(self.tree)
+
+    def add(self, hash_val, item, label = None):
+        self.tree.add(hash_val, (item, label))
+
+    def find(self, hash_val, label = None):
+        """(list) items with the same label within max_distance of hash_val."""
+        return [item for (item, item_label), _ in
+                self.tree.query(hash_val, self.max_distance)
+                if item_label == label]
+
+    def add_if_new(self, hash_val, item, label = None):
+        """
+        Add an ROI unless it near-duplicates one in the index.
+
+        OUTPUT:
+        (object) the item it duplicates, or None if it was added.
+        """
+        matches = self.find(hash_val, label)
+        if matches:
+            return matches[0]
+        self.add(hash_val, item, label)
+        return None
+
+
+def index_from_store(roi_store, max_distance = 4, batch_size = 1024):
+    """(PHashIndex) of the ROIs in a RoiStore, with store indices as items."""
+    index = PHashIndex(max_distance)
+    if len(roi_store) == 0:
+        return index
+    X, y = roi_store.arrays()
+    for start in xrange(0, len(X), batch_size):
+        hashes = phash_batch(X[start:start + batch_size])
+        for i, (hash_val, label) in enumerate(zip(hashes, y[start:start + batch_size])):
+            index.add(hash_val, start + i, int(label))
+    return index
+
+
+def _sample_pngs(samples_path):
+    """(pair of lists) paths and labels of the ROI PNGs under samples_path."""
+    paths, labels = [], []
+    for subdir, label in [('positive_samples', 1), ('negative_samples', 0)]:
+        subpaths = sorted(glob.glob(os.path.join(samples_path, subdir, '*.png')))
+        paths.extend(subpaths)
+        labels.extend([label] * len(subpaths))
+    return paths, labels
+
+
+def _hash_paths(paths, batch_size = 1024, workers = 4):
+    """Hashes of image files, decoded in threads and hashed in batches."""
+    hashes = []
+    batch = []
+    for img_arr in read_many(paths, workers = workers):
+        batch.append(img_arr)
+        if len(batch) == batch_size:
+            hashes.append(phash_batch(np.array(batch)))
+            batch = []
+    if batch:
+        hashes.append(phash_batch(np.array(batch)))
+    return np.concatenate(hashes) if hashes else np.zeros(0, dtype = np.uint64)
+
+
+def index_from_pngs(samples_path, max_distance = 4):
+    """(PHashIndex) of the ROI PNGs in positive_samples/negative_samples, with paths as items."""
+    index = PHashIndex(max_distance)
+    paths, labels = _sample_pngs(samples_path)
+    for path, label, hash_val in zip(paths, labels, _hash_paths(paths)):
+        index.add(hash_val, path, label)
+    return index
+
+
+def duplicate_groups(hashes, max_distance = 4):
+    """
+    Group ROIs linked by chains of near-duplicates, whatever their labels.
+
+    INPUT:
+    hashes: (array) uint64 hashes, e.g. from hash_rois.
+
+    OUTPUT:
+    (array) int group id of each ROI: the index of the first ROI of its
+            group, so ROIs without duplicates are their own group.
+    """
+    parent = np.arange(len(hashes))
+
+    def _root(i):
+        while parent[i] != i:
+            parent[i] = parent[parent[i]]
+            i = parent[i]
+        return i
+
+    tree = BKTree()
+    for i, hash_val in enumerate(hashes):
+        for j, _ in tree.query(hash_val, max_distance):
+            root_i, root_j = _root(i), _root(j)
+            if root_i != root_j:
+                parent[max(root_i, root_j)] = min(root_i, root_j)
+        tree.add(hash_val, i)
+    return np.array([_root(i) for i in xrange(len(hashes))], dtype = np.int64)
+
+
+def keep_first(groups):
+    """(bool array) True for the first ROI of each group, to drop the other duplicates."""
+    return groups == np.arange(len(groups))
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    samples_help = "Directory of positive_samples/negative_samples, or an ROI store."
+    ap.add_argument('samples', help=samples_help)
+    ap.add_argument('-d', '--distance', type=int, default=4,
+                    help="Largest Hamming distance (of 64 bits) between near-duplicates.")
+    ap.add_argument('-o', '--outpath', help="Write the group of each ROI to this JSON file.")
+    ap.add_argument('--remove', action='store_true',
+                    help="Delete all but the first PNG of each group.")
+
+    args = ap.parse_args()
+    is_store = os.path.exists(os.path.join(args.samples, 'meta.json'))
+    if is_store:
+        X, y = RoiStore(args.samples).arrays()
+        hashes = hash_rois(X)
+        names = None
+    else:
+        names, _ = _sample_pngs(args.samples)
+        hashes = _hash_paths(names)
+    groups = duplicate_groups(hashes, args.distance)
+    keep = keep_first(groups)
+    print json.dumps({'samples': len(groups), 'groups': int(keep.sum()),
+                      'duplicates': int((~keep).sum())})
+
+    if args.outpath:
+        with open(args.outpath, 'w') as fout:
+            if is_store:
+                json.dump({'groups': groups.tolist()}, fout)
+            else:
+                json.dump(dict(zip(names, groups.tolist())), fout)
+    if args.remove:
+        if is_store:
+            raise Exception("Can't remove ROIs from a store, split on the groups instead.")
+        for name, kept in zip(names, keep):
+            if not kept:
+                os.remove(name)
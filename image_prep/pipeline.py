@@ -0,0 +1,313 @@
+"""
+One command line entry point for the image prep pipeline, and a streaming
+runner that goes from annotations straight to an ROI store.
+
+Subcommands:
+collect: download tiles (google_satellite_images.py), or one shard of them.
+cover: download the tiles covering a bounding box or polygon (region_plan.py).
+merge: check and merge the catalogs of collection shards (sharding.py).
+cut: cut ROIs out of saved tiles (cut_and_save_rois.py).
+run: for each annotated tile, read it from disk if it's there, download it
+     if not, decode it in memory, cut its ROIs and append them to an ROI
+     store. Stages are generators linked by bounded queues, so a slow stage
+     holds the others back instead of piling up tiles in memory. Tiles are
+     only written to disk if --save-tiles is given.
+
+example usage:
+python pipeline.py collect 36.1699390347 -115.139826918 -n 2500 -o tiles/dir -w 8 -k YOUR_API_KEY
+python pipeline.py cover --bbox 36.10 -115.20 36.20 -115.10 -o tiles/dir -c tiles.db -k YOUR_API_KEY
+python pipeline.py merge shard0.db shard1.db -o tiles.db
+python pipeline.py cut image_annotation.json -p tiles/dir -o rois/dir
+python pipeline.py run image_annotation.jsonl -o rois/store -p tiles/dir -k YOUR_API_KEY -w 8
+"""
+import argparse
+from collections import deque
+from cStringIO import StringIO
+import json
+import math
+from multiprocessing.pool import ThreadPool
+import numpy as np
+import os
+import requests
+import time
+from PIL import Image
+from annotation_journal import iter_annotations
+import cut_and_save_rois
+from cut_and_save_rois import (append_rois_to_store, cut_posneg_rois,
+                                drop_duplicate_rois, hash_posneg_rois)
+import google_satellite_images
+from google_satellite_images import SatImageCollector
+import metrics
+import phash
+import region_plan
+from roi_store import RoiStore
+import sharding
+from streaming import prefetch
+from tile_catalog import TileCatalog
+from utils import RateLimiter, parse_tile_fname
+
+
+def run_pipeline(annotations, store_path, tiles_dir = '', catalog = None,
+                    api_key = None, roi_dims = [48, 48], edge_mode = 'drop',
+                    workers = 4, max_rps = None, retries = 3, timeout = 30,
+                    queue_size = 8, save_tiles = None, image_size = 640,
+                    scale = 2, api_url = None, dedup_distance = None,
+                    verbose = True):
+    """
+    Stream annotated tiles through fetch -> decode and cut -> ROI store.
+
+    INPUT:
+    annotations: (iterable) of annotation dicts as written by
+                 save_image_annotation.py (e.g. iter_annotations of a journal),
+                 consumed lazily.
+    store_path: (str) RoiStore to append to. Images that already have ROIs
+                in it are skipped, so an interrupted run can be restarted.
+    tiles_dir: (str) directory tiles are read from when saved there.
+    catalog: (TileCatalog) if given, tile paths are looked up in it first.
+    api_key: (str) Google Maps API key, for tiles not on disk.
+    roi_dims, edge_mode: see cut_and_save_rois.extract_rois. 'neighbors' is
+                         not supported, as tiles are not kept around.
+    workers: (int) threads for downloading/reading, and for decoding/cutting.
+    max_rps, retries, timeout: see SatImageCollector.get_images.
+    queue_size: (int) tiles buffered between stages.
+    save_tiles: (str) if given, downloaded tiles are also saved here.
+    image_size, scale: API parameters the tiles were collected with.
+    api_url: (str) base url of the static maps API, if not the default.
+    dedup_distance: (int) if given, ROIs near-duplicating one with the same
+                    label already in the store (or cut before in this run)
+                    are left out, see cut_and_save_rois.batch_roi_writer.
+
+    OUTPUT:
+    (dict) 'images', 'skipped' (already in the store), 'downloaded', 'read'
+           (from disk), 'rois', 'duplicates' (ROIs left out), a list of 
+           'failed' (file name, reason), 'seconds' and 'images_per_sec'.
+    """
+    if edge_mode == 'neighbors':
+        raise Exception("edge_mode 'neighbors' isn't supported when streaming.")
+    if (save_tiles is not None) and (not os.path.isdir(save_tiles)):
+        os.makedirs(save_tiles)
+
+    roi_store = RoiStore(store_path)
+    done_files = (set(entry['img_file'] for entry in roi_store.provenance())
+                    if len(roi_store) else set())
+    stats = {'images': 0, 'skipped': 0, 'downloaded': 0, 'read': 0,
+             'rois': 0, 'duplicates': 0, 'failed': []}
+    hash_index = (phash.index_from_store(roi_store, dedup_distance)
+                    if dedup_distance is not None else None)
+
+    def _todo():
+        for pn_d in annotations:
+            if pn_d['img_file'] in done_files:
+                stats['skipped'] += 1
+                continue
+            yield pn_d
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections = 1,
+                                            pool_maxsize = max(workers, 1))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    fetcher = _TileFetcher(session, RateLimiter(max_rps), tiles_dir, catalog,
+                            api_key, retries, timeout, save_tiles,
+                            image_size, scale, api_url)
+    pool = ThreadPool(max(workers, 1))
+
+    start_time = time.time()
+    try:
+        fetched = prefetch(_bounded_imap(pool, fetcher, _todo(), queue_size),
+                            max_queued = queue_size)
+        cutter = lambda item: _decode_and_cut(item, roi_dims, edge_mode,
+                                              hash_index is not None)
+        cut = prefetch(_bounded_imap(pool, cutter, fetched, queue_size),
+                        max_queued = queue_size)
+
+        for pn_d, source, err in cut:
+            stats['images'] += 1
+            if err is not None:
+                stats['failed'].append((pn_d['img_file'], err))
+                if verbose:
+                    print "Failed on {0}: {1}".format(pn_d['img_file'], err)
+                continue
+            stats[source] += 1
+            if hash_index is not None:
+                drop_duplicate_rois(pn_d, hash_index)
+                stats['duplicates'] += len(pn_d.get('duplicate_rois', []))
+            with metrics.timer('store_append'):
+                append_rois_to_store(roi_store, pn_d)
+            stats['rois'] += sum(len(pn_d.get(key, {})) for key in
+                                 ['positive_roi_arrs', 'negative_roi_arrs'])
+    finally:
+        pool.terminate()
+        session.close()
+
+    stats['seconds'] = time.time() - start_time
+    stats['images_per_sec'] = (stats['images'] / stats['seconds']
+                                if stats['seconds'] > 0 else 0.0)
+    metrics.incr('images_cut', stats['images'] - len(stats['failed']))
+    if verbose:
+        p_str = "Cut {0} ROIs from {1} images ({2} downloaded, {3} read, {4} skipped, {5} failed) in {6:.1f}s: {7:.2f} images/sec"
+        print p_str.format(stats['rois'], stats['images'], stats['downloaded'],
+                            stats['read'], stats['skipped'],
+                            len(stats['failed']), stats['seconds'],
+                            stats['images_per_sec'])
+    return stats
+
+
+def _bounded_imap(pool, func, iterable, max_pending):
+    """
+    Ordered pool.imap over iterable, with at most max_pending items taken
+    from it and not yet yielded (pool.imap alone would read the whole 
+    iterable ahead). The window slides one item at a time, so a slow item
+    only holds back the results after it, not the other workers.
+    """
+    pending = deque()
+    for item in iterable:
+        pending.append(pool.apply_async(func, (item,)))
+        if len(pending) >= max(max_pending, 1):
+            yield pending.popleft().get()
+    while pending:
+        yield pending.popleft().get()
+
+
+class _TileFetcher(object):
+    """
+    Helper for run_pipeline. Gets the encoded bytes of an annotated tile,
+    from disk if it is there, else from the API.
+    """
+
+    def __init__(self, session, limiter, tiles_dir, catalog, api_key, retries,
+                    timeout, save_tiles, image_size, scale, api_url):
+        self.session = session
+        self.limiter = limiter
+        self.tiles_dir = tiles_dir
+        self.catalog = catalog
+        self.api_key = api_key
+        self.retries = retries
+        self.timeout = timeout
+        self.save_tiles = save_tiles
+        self.image_size = image_size
+        self.scale = scale
+        #SatImageCollector's default unless given
+        self.url_kwargs = {'api_url': api_url} if api_url else {}
+
+    def __call__(self, pn_d):
+        """(tuple) pn_d, encoded image or None, source ('read' or 'downloaded'), error."""
+        img_file = pn_d['img_file']
+        tile = self.catalog.get(img_file) if self.catalog is not None else None
+        path = tile['path'] if tile else os.path.join(self.tiles_dir, img_file)
+        if os.path.exists(path):
+            with open(path, 'rb') as fin:
+                return pn_d, fin.read(), 'read', None
+
+        try:
+            tile = parse_tile_fname(img_file)
+        except Exception:
+            return pn_d, None, None, "Not on disk, and no location in the file name"
+        #file names hold the zoom after scaling, see setup_calls
+        zoom = tile['zoom'] - int(math.log(self.scale, 2))
+        collector = SatImageCollector(tile['lat'], tile['lng'], max_tiles = 1,
+                                        zoom = zoom, image_size = self.image_size,
+                                        scale = self.scale, **self.url_kwargs)
+        img_url = collector.tile_url(tile['lat'], tile['lng'])
+        if self.api_key is not None:
+            img_url += '&key=' + self.api_key
+        with metrics.timer('tile_download'):
+            err, content = collector.download(self.session, self.limiter,
+                                                img_url, self.retries,
+                                                timeout = self.timeout)
+        if err is not None:
+            metrics.incr('tiles_failed')
+            return pn_d, None, None, err
+        metrics.incr('tiles_downloaded')
+        metrics.incr('bytes_downloaded', len(content))
+
+        if self.save_tiles is not None:
+            fpath = os.path.join(self.save_tiles, img_file)
+            with open(fpath + '.part', 'wb') as fout:
+                fout.write(content)
+            os.rename(fpath + '.part', fpath)
+        return pn_d, content, 'downloaded', None
+
+
+def _decode_and_cut(item, roi_dims, edge_mode, hash_rois = False):
+    """
+    Helper for run_pipeline. Decode a fetched tile in memory and cut (and 
+    with hash_rois, hash) its ROIs.
+    """
+    pn_d, content, source, err = item
+    if err is not None:
+        return pn_d, source, err
+    try:
+        with metrics.timer('png_decode'):
+            img = Image.open(StringIO(content))
+            img_arr = np.asarray(img.convert('RGB') if img.mode != 'RGB' else img,
+                                 dtype = np.uint8)
+    except IOError as e:
+        return pn_d, source, "Can't decode image: {0}".format(e)
+    pn_d = cut_posneg_rois(pn_d.copy(), img_arr, roi_dims, edge_mode = edge_mode)
+    if hash_rois:
+        hash_posneg_rois(pn_d)
+    return pn_d, source, None
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    subparsers = ap.add_subparsers(dest = 'command')
+    google_satellite_images.add_arguments(
+        subparsers.add_parser('collect', help = "Download tiles around a location."))
+    region_plan.add_arguments(
+        subparsers.add_parser('cover', help = "Download the tiles covering a region (region_plan.py)."))
+    sharding.add_arguments(
+        subparsers.add_parser('merge', help = "Check and merge collection shard catalogs."))
+    cut_and_save_rois.add_arguments(
+        subparsers.add_parser('cut', help = "Cut ROIs out of saved tiles."))
+
+    run_ap = subparsers.add_parser('run', help = "Stream annotated tiles straight into an ROI store.")
+    run_ap.add_argument('annotations', help="Annotation JSON, or a .jsonl journal (streamed).")
+    run_ap.add_argument('-o', '--outpath', required=True, help="ROI store to append to.")
+    run_ap.add_argument('-p', '--path', default='', help="Directory of saved tiles, read instead of downloading.")
+    run_ap.add_argument('-c', '--catalog', help="Tile catalog to locate saved tiles with.")
+    run_ap.add_argument('-k', '--key', help="Google Maps API key, for tiles not on disk.")
+    run_ap.add_argument('-d', '--dims', type=int, default=48, help="Side length of cutout.")
+    run_ap.add_argument('-e', '--edge', default='drop',
+                        choices=[mode for mode in cut_and_save_rois.EDGE_MODES
+                                 if mode != 'neighbors'],
+                        help="How to cut ROIs that run off the image.")
+    run_ap.add_argument('-w', '--workers', type=int, default=4, help="Threads per stage.")
+    run_ap.add_argument('-r', '--rps', type=float, help="Maximum requests per second.")
+    run_ap.add_argument('-q', '--queue', type=int, default=8, help="Tiles buffered between stages.")
+    run_ap.add_argument('--save-tiles', help="Also save downloaded tiles in this directory.")
+    run_ap.add_argument('--dedup', type=int, metavar='DISTANCE',
+                        help="Leave out ROIs within this perceptual hash distance (e.g. 4) of one already stored.")
+    metrics_help = "Write run metrics to this file: Prometheus textfile if it ends in .prom, else JSON."
+    run_ap.add_argument('-m', '--metrics', help=metrics_help)
+
+    args = ap.parse_args()
+    if args.command == 'collect':
+        google_satellite_images.main(args)
+    elif args.command == 'cover':
+        region_plan.main(args)
+    elif args.command == 'merge':
+        sharding.main(args)
+    elif args.command == 'cut':
+        cut_and_save_rois.main(args)
+    else:
+        if args.metrics:
+            metrics.enable()
+        catalog = TileCatalog(args.catalog) if args.catalog else None
+        stats = run_pipeline(iter_annotations(args.annotations), args.outpath,
+                                tiles_dir = args.path, catalog = catalog,
+                                api_key = args.key,
+                                roi_dims = [args.dims, args.dims],
+                                edge_mode = args.edge, workers = args.workers,
+                                max_rps = args.rps, queue_size = args.queue,
+                                save_tiles = args.save_tiles,
+                                dedup_distance = args.dedup)
+        if args.metrics:
+            metrics.export(args.metrics)
+        if stats['failed']:
+            print json.dumps({'failed': stats['failed']})
+
+
+if __name__ == '__main__':
+    main()
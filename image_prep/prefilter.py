@@ -0,0 +1,125 @@
+"""
+Cheap color test to reject windows that obviously hold no target (e.g. no
+pool: no blue/cyan water pixels) before running the CNN on them.
+
+The score of a window is the fraction of its pixels that look like water.
+The rejection threshold is calibrated on the positive_samples and
+negative_samples written by cut_and_save_rois.py, for a target recall on the
+positive samples.
+
+example usage:
+python prefilter.py output/rois/dir -r 0.98 > prefilter.json
+"""
+import argparse
+import glob
+import json
+import numpy as np
+import os
+from image_io import read_rgb
+from roi_store import RoiStore
+
+
+def water_mask(img_arr, margin = 0.04):
+    """
+    (bool array) pixels of an RGB(A) image, or a batch of them, whose blue
+    channel exceeds red by margin and whose green is above red, which
+    is where pool water sits in color space. Works on float images in [0, 1]
+    and uint8 images in [0, 255].
+    """
+    img_arr = np.asarray(img_arr)
+    if img_arr.dtype == np.uint8:
+        margin = margin * 255
+    red = img_arr[..., 0].astype(np.float32)
+    green = img_arr[..., 1]
+    blue = img_arr[..., 2]
+    return (blue > red + margin) & (green > red)
+
+
+def roi_scores(rois):
+    """(array) water fraction of each of a batch of (N, rows, cols, channels) ROIs."""
+    return water_mask(rois).mean(axis = (1, 2))
+
+
+def window_scores(img_arr, window, stride):
+    """
+    Water fraction of every square window of an image, from an integral image
+    of the water mask, so each window costs four lookups whatever its size.
+
+    OUTPUT:
+    (array) of shape (grid rows, grid cols), for the windows with upper left
+    corner at (row * stride, col * stride), as in detect_tiles.scan_images.
+    """
+    mask = water_mask(img_arr)
+    integral = np.zeros((mask.shape[0] + 1, mask.shape[1] + 1), dtype = np.int64)
+    integral[1:, 1:] = mask.cumsum(axis = 0).cumsum(axis = 1)
+
+    rows = np.arange(0, mask.shape[0] - window + 1, stride)
+    cols = np.arange(0, mask.shape[1] - window + 1, stride)
+    top, left = rows[:, np.newaxis], cols[np.newaxis, :]
+    bottom, right = top + window, left + window
+    sums = (integral[bottom, right] - integral[top, right] -
+            integral[bottom, left] + integral[top, left])
+
+    return sums / float(window * window)
+
+
+def calibrate(samples_path, target_recall = 0.98):
+    """
+    Pick the highest rejection threshold that keeps target_recall of the
+    positive samples, and measure what it costs and saves.
+
+    INPUT:
+    samples_path: (str) directory with positive_samples/negative_samples PNG
+                  directories, or an ROI store, as written by
+                  cut_and_save_rois.py.
+    target_recall: (float) fraction of positive samples that must pass.
+
+    OUTPUT:
+    (dict) 'threshold': windows scoring below it are rejected,
+           'recall': fraction of positive samples passing,
+           'recall_lost': 1 - recall,
+           'rejection_rate': fraction of negative samples rejected,
+           'num_positive', 'num_negative': sample counts.
+    """
+    pos_scores, neg_scores = _sample_scores(samples_path)
+    if len(pos_scores) == 0:
+        raise Exception("No positive samples in: {0}".format(samples_path))
+
+    threshold = float(np.percentile(pos_scores, 100 * (1.0 - target_recall),
+                                    interpolation = 'lower'))
+    recall = float(np.mean(pos_scores >= threshold))
+    rejection_rate = (float(np.mean(neg_scores < threshold))
+                        if len(neg_scores) else 0.0)
+
+    return {'threshold': threshold, 'recall': recall,
+            'recall_lost': 1.0 - recall, 'rejection_rate': rejection_rate,
+            'num_positive': len(pos_scores), 'num_negative': len(neg_scores)}
+
+
+def _sample_scores(samples_path):
+    """Helper for calibrate. Water fractions of positive and negative samples."""
+    if os.path.exists(os.path.join(samples_path, 'meta.json')):
+        X, y = RoiStore(samples_path).arrays()
+        scores = np.concatenate([roi_scores(X[start:start + 1024])
+                                 for start in xrange(0, len(X), 1024)])
+        labels = np.asarray(y)
+        return scores[labels == 1], scores[labels == 0]
+
+    scores_l = []
+    for subdir in ['positive_samples', 'negative_samples']:
+        paths = glob.glob(os.path.join(samples_path, subdir, '*.png'))
+        scores_l.append(np.array([roi_scores(read_rgb(path)[np.newaxis])[0]
+                                  for path in paths]))
+    return scores_l[0], scores_l[1]
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    samples_help = "Directory of positive_samples/negative_samples, or an ROI store."
+    ap.add_argument('samples', help = samples_help)
+    ap.add_argument('-r', '--recall', type=float, default=0.98,
+                    help="Fraction of positive samples to keep.")
+
+    args = ap.parse_args()
+    calibration = calibrate(args.samples, target_recall = args.recall)
+    print json.dumps(calibration)
@@ -0,0 +1,251 @@
+"""
+Coarse to fine collection: download a low zoom pass, score it with a cheap
+test (by default the water fraction of prefilter.py), and only download the
+higher zoom tiles under promising parts of it.
+
+Each level up doubles the zoom, so a tile's area holds 2 x 2 child tiles
+on the next level. The grid of each level is anchored so that its tiles
+split their parent tiles exactly (a quadtree), and children get ordinary
+SatImageCollector steps, file names and urls at their zoom. A child is
+downloaded if some window of its footprint in the parent image, about the
+size of an ROI at the final zoom, scores at least the threshold.
+
+Compared to sweeping the same area at the final zoom (4**levels tiles per
+coarse tile), the calls saved grow with the share of the area that has
+nothing of interest.
+
+All levels share one catalog. The coarse pass keeps the catalog's 'plan'
+and 'step_range', and each refinement level records its own under
+'quadtree_level{N}_plan' and 'quadtree_level{N}_step_range'. Step indices
+of a level follow those of the level below, and a child's index is fixed
+by its parent's index and its quadrant, so levels never share indices and
+a resumed run numbers tiles as before.
+
+example usage:
+python quadtree.py --bbox 36.10 -115.20 36.20 -115.10 -z 16 -l 2 -f prefilter.json -o tiles/dir -c tiles.db -w 8 -k YOUR_API_KEY
+"""
+import argparse
+import json
+import math
+import numpy as np
+import os
+from region_plan import bbox_ring, coverage_collector, read_polygon
+from google_satellite_images import SatImageCollector
+from image_io import read_many
+import metrics
+from prefilter import window_scores
+from tile_catalog import TileCatalog
+from utils import parse_tile_fname
+from web_mercator import latlng2worldpix, worldpix2latlng
+
+
+def level_anchor(coarse, level):
+    """
+    (pair of floats) lat, lng of the (0, 0) tile of a quadtree level over
+    the coarse collector's grid, so that each tile (i, j) of level - 1 is
+    split by the tiles (2i or 2i + 1, 2j or 2j + 1) of level.
+    """
+    pixel_step = math.floor((1.0 - coarse.image_overlap) * coarse.scale *
+                            coarse.image_size)
+    anchor_x, anchor_y = latlng2worldpix(coarse.init_lat, coarse.init_lng,
+                                         coarse.effective_zoom)
+    #corner of the coarse (0, 0) cell, plus half a cell of this level
+    offset = pixel_step * (0.5 / 2 ** level - 0.5)
+    lat, lng = worldpix2latlng((anchor_x + offset) * 2 ** level,
+                               (anchor_y + offset) * 2 ** level,
+                               coarse.effective_zoom + level)
+    return float(lat), float(lng)
+
+
+def child_scores(img_arr, window, stride, overlap, score_fn = window_scores):
+    """
+    Score of each of the 4 children of a tile: the best window score inside
+    the child's footprint in the tile image.
+
+    INPUT:
+    img_arr: (array) the tile image.
+    window, stride: (int) scoring window size and stride, in image pixels.
+    overlap: (float) image_overlap of the grid.
+    score_fn: (function) (img_arr, window, stride) -> (grid rows, grid cols)
+              array of window scores, as prefilter.window_scores.
+
+    OUTPUT:
+    (2 x 2 array) scores, indexed [child row (0 north), child col (0 west)].
+    """
+    rows, cols = img_arr.shape[:2]
+    scores = score_fn(img_arr, window, stride)
+    #window centers, as fractions of the image
+    win_rows = (np.arange(scores.shape[0]) * stride + window / 2.0) / rows
+    win_cols = (np.arange(scores.shape[1]) * stride + window / 2.0) / cols
+
+    #children are centered a quarter cell from the tile center, and span
+    #half the tile
+    cell = 1.0 - overlap
+    out = np.full((2, 2), -np.inf)
+    for i, center_r in enumerate([0.5 - cell / 4, 0.5 + cell / 4]):
+        in_rows = np.abs(win_rows - center_r) <= 0.25
+        for j, center_c in enumerate([0.5 - cell / 4, 0.5 + cell / 4]):
+            in_cols = np.abs(win_cols - center_c) <= 0.25
+            if in_rows.any() and in_cols.any():
+                out[i, j] = scores[in_rows][:, in_cols].max()
+    return out
+
+
+def collect_quadtree(coarse, levels = 1, threshold = 0.02, roi_dim = 48,
+                        score_fn = window_scores, verbose = True, workers = 1,
+                        **kwargs):
+    """
+    Download a coarse pass, then the children of its promising tiles, level
+    by level.
+
+    INPUT:
+    coarse: (SatImageCollector) the coarse pass, e.g. a spiral or
+            region_plan.coverage_collector, with save_dir set.
+    levels: (int) number of zoom levels to refine by.
+    threshold: (float) children scoring below it are not downloaded, e.g.
+               a threshold calibrated with prefilter.py.
+    roi_dim: (int) ROI size at the final zoom, scaled down to size the
+             scoring windows on coarser levels.
+    score_fn: see child_scores.
+    workers: (int) download and decode threads.
+    kwargs: passed on to SatImageCollector.get_images, e.g. api_key,
+            max_rps, retries or catalog.
+
+    OUTPUT:
+    (dict) 'levels': per level zoom, tiles 'requested', 'skipped' (already
+           saved), 'downloaded', 'failed' and 'promising' (children kept),
+           'tiles' (planned on all levels), 'calls' (API calls made on all
+           levels), 'full_sweep_calls' (tiles to sweep the planned coarse 
+           area at the final zoom), 'calls_saved' (full_sweep_calls - 
+           calls) and 'seconds'.
+    """
+    if coarse.image_info is None:
+        coarse.setup_calls()
+    overlap = coarse.image_overlap
+    n_coarse = len(coarse.image_info)
+    report = {'levels': [], 'tiles': 0, 'calls': 0, 'seconds': 0.0}
+    collector = coarse
+    #step index of each tile of the current level, by (xstep, ystep)
+    level_base = coarse.first_step
+    tile_idxs = dict(((tile['xstep'], tile['ystep']), level_base + i)
+                     for i, tile in enumerate(parse_tile_fname(fname)
+                                              for fname, _ in coarse.image_info))
+    for level in xrange(levels + 1):
+        stats = collector.get_images(verbose = verbose, workers = workers,
+                                     **kwargs)
+        level_report = {'zoom': collector.zoom,
+                        'requested': stats['requested'],
+                        'skipped': stats['skipped'],
+                        'downloaded': stats['downloaded'],
+                        'failed': len(stats['failed']), 'promising': 0}
+        report['levels'].append(level_report)
+        report['tiles'] += stats['requested']
+        report['calls'] += stats['requested'] - stats['skipped']
+        report['seconds'] += stats['seconds']
+        if level == levels:
+            break
+
+        #score the saved tiles of this level for the next one
+        save_dir = collector.save_dir if collector.save_dir is not None else ''
+        saved = [(fname, os.path.join(save_dir, fname))
+                 for fname, _ in collector.image_info
+                 if os.path.exists(os.path.join(save_dir, fname))]
+        window = max(roi_dim // 2 ** (levels - level), 2)
+        children = {}
+        for (fname, _), img_arr in zip(saved, read_many([path for _, path in saved],
+                                                        workers = workers)):
+            tile = parse_tile_fname(fname)
+            scale_px = img_arr.shape[1] / float(collector.scale * collector.image_size)
+            win_px = max(int(round(window * scale_px)), 1)
+            scores = child_scores(img_arr, win_px, max(win_px // 2, 1), overlap,
+                                  score_fn)
+            parent_idx = tile_idxs[(tile['xstep'], tile['ystep'])]
+            for i, j in zip(*np.nonzero(scores >= threshold)):
+                #level L holds up to n_coarse * 4**L tiles, indexed by parent
+                #and quadrant
+                children[(2 * tile['xstep'] + int(j),
+                          2 * tile['ystep'] + int(i))] = (
+                    level_base + n_coarse * 4 ** level +
+                    4 * (parent_idx - level_base) + 2 * int(i) + int(j))
+        level_report['promising'] = len(children)
+
+        anchor = level_anchor(coarse, level + 1)
+        step_coords = sorted(children)
+        collector = SatImageCollector(anchor[0], anchor[1],
+                                      max_tiles = len(children),
+                                      zoom = coarse.zoom + level + 1,
+                                      image_size = coarse.image_size,
+                                      scale = coarse.scale,
+                                      save_dir = coarse.save_dir,
+                                      step_coords = step_coords,
+                                      api_url = coarse.api_url)
+        collector.setup_calls(image_overlap = overlap)
+        level_base += n_coarse * 4 ** level
+        collector.first_step = level_base
+        collector.step_idxs = [children[step] for step in step_coords]
+        collector.meta_prefix = 'quadtree_level{0}_'.format(level + 1)
+        tile_idxs = children
+
+    report['full_sweep_calls'] = n_coarse * 4 ** levels
+    report['calls_saved'] = report['full_sweep_calls'] - report['calls']
+    if verbose:
+        p_str = "{0} calls over {1} levels, against {2} for a full sweep at zoom {3}: {4} saved"
+        print p_str.format(report['calls'], levels + 1,
+                           report['full_sweep_calls'], coarse.zoom + levels,
+                           report['calls_saved'])
+    return report
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    region = ap.add_mutually_exclusive_group(required=True)
+    region.add_argument('--bbox', type=float, nargs=4,
+                        metavar=('MIN_LAT', 'MIN_LNG', 'MAX_LAT', 'MAX_LNG'),
+                        help="Bounding box to cover.")
+    region.add_argument('--polygon', help="GeoJSON (Multi)Polygon to cover.")
+    region.add_argument('--center', type=float, nargs=2, metavar=('LAT', 'LNG'),
+                        help="Spiral out from this point instead, see -n.")
+    ap.add_argument('-n', '--max_tiles', type=int, default=100,
+                    help="Coarse tiles in the spiral, with --center.")
+    ap.add_argument('-z', '--zoom', type=int, default=16, help="Coarse API zoom level.")
+    ap.add_argument('-l', '--levels', type=int, default=1,
+                    help="Zoom levels to refine by.")
+    ap.add_argument('-t', '--threshold', type=float, default=0.02,
+                    help="Lowest window score worth refining.")
+    ap.add_argument('-f', '--prefilter', help="Take the threshold from prefilter.py's calibration JSON.")
+    ap.add_argument('-d', '--dims', type=int, default=48, help="ROI size at the final zoom.")
+    ap.add_argument('-o', '--outpath', help="Directory to save images in.")
+    ap.add_argument('-c', '--catalog', help="SQLite tile catalog to record and resume the run with.")
+    ap.add_argument('-k', '--key', help="Google Maps API key.")
+    ap.add_argument('-w', '--workers', type=int, default=1, help="Number of concurrent downloads.")
+    ap.add_argument('-r', '--rps', type=float, help="Maximum requests per second.")
+    ap.add_argument('--retries', type=int, default=3, help="Retries per tile after a failed call.")
+    ap.add_argument('--api-url', default='http://maps.googleapis.com/maps/api/staticmap?',
+                    help="Base url of the static maps API, e.g. a local server for testing.")
+    metrics_help = "Write run metrics to this file: Prometheus textfile if it ends in .prom, else JSON."
+    ap.add_argument('-m', '--metrics', help=metrics_help)
+
+    args = ap.parse_args()
+    if args.metrics:
+        metrics.enable()
+    threshold = args.threshold
+    if args.prefilter:
+        with open(args.prefilter) as fin:
+            threshold = json.load(fin)['threshold']
+    catalog = TileCatalog(args.catalog) if args.catalog else None
+    if args.center:
+        coarse = SatImageCollector(args.center[0], args.center[1],
+                                   max_tiles = args.max_tiles, zoom = args.zoom,
+                                   save_dir = args.outpath, api_url = args.api_url)
+    else:
+        rings = read_polygon(args.polygon) if args.polygon else [bbox_ring(args.bbox)]
+        coarse, _ = coverage_collector(rings, zoom = args.zoom, catalog = catalog,
+                                       save_dir = args.outpath,
+                                       skip_stored = False, api_url = args.api_url)
+    report = collect_quadtree(coarse, levels = args.levels, threshold = threshold,
+                              roi_dim = args.dims, workers = args.workers,
+                              api_key = args.key, max_rps = args.rps,
+                              retries = args.retries, catalog = catalog)
+    print json.dumps(report)
+    if args.metrics:
+        metrics.export(args.metrics)
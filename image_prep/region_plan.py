@@ -0,0 +1,330 @@
+"""
+Plan the tiles covering a bounding box or polygon, instead of spiraling
+max_tiles out from one point.
+
+Tiles are laid on the same grid of steps as SatImageCollector.setup_calls,
+anchored at a lat/lng (by default the center of the region). The grid is
+projected to Web Mercator world pixels, where the region's edges are
+straight lines, and a tile is planned if its cell (the pixel_step square
+around its center) overlaps the region. That is: if a cell corner is in
+the region (a vectorized even-odd point in polygon test over the grid of
+cell corners), or if one of the region's edges runs through the cell.
+Cells that a saved tile at the same zoom already covers are skipped.
+
+The planned steps go to SatImageCollector(step_coords = ...), so file
+names, urls, catalogs, resuming and sharding work as for a spiral.
+
+example usage:
+python region_plan.py --bbox 36.10 -115.20 36.20 -115.10 -z 17 -o tiles/dir -c tiles.db -w 8 -k YOUR_API_KEY
+python region_plan.py --polygon region.geojson -z 17 -o tiles/dir -n
+"""
+import argparse
+import json
+import math
+import numpy as np
+import os
+from google_satellite_images import SatImageCollector
+import metrics
+import sharding
+from tile_catalog import TileCatalog
+from utils import parse_tile_fname
+from web_mercator import latlng2worldpix
+
+
+def bbox_ring(bbox):
+    """(array) [min_lat, min_lng, max_lat, max_lng] as a closed ring of (lat, lng) vertices."""
+    min_lat, min_lng, max_lat, max_lng = bbox
+    return np.array([[min_lat, min_lng], [min_lat, max_lng], [max_lat, max_lng],
+                     [max_lat, min_lng], [min_lat, min_lng]], dtype = np.float64)
+
+
+def read_polygon(path):
+    """
+    Rings of a region from a GeoJSON file: a Polygon or MultiPolygon
+    geometry, a Feature or the first Feature of a FeatureCollection.
+
+    OUTPUT:
+    (list of arrays) rings of (lat, lng) vertices (GeoJSON is lng, lat).
+    Holes are rings too: the point in polygon test is even-odd.
+    """
+    with open(path) as fin:
+        geometry = json.load(fin)
+    if geometry.get('type') == 'FeatureCollection':
+        geometry = geometry['features'][0]
+    if geometry.get('type') == 'Feature':
+        geometry = geometry['geometry']
+    if geometry['type'] == 'Polygon':
+        polygons = [geometry['coordinates']]
+    elif geometry['type'] == 'MultiPolygon':
+        polygons = geometry['coordinates']
+    else:
+        raise Exception("Expected a Polygon or MultiPolygon, got: {0}".format(
+                            geometry['type']))
+    return [np.array(ring, dtype = np.float64)[:, ::-1]
+            for polygon in polygons for ring in polygon]
+
+
+def points_in_polygon(x, y, rings):
+    """
+    Even-odd point in polygon test, vectorized over the points.
+
+    INPUT:
+    x, y: (arrays) point coordinates, any (matching) shape.
+    rings: (list of (N, 2) arrays) polygon rings of (x, y) vertices, closed
+           or not.
+
+    OUTPUT:
+    (bool array) of the shape of x, True for points inside.
+    """
+    x = np.asarray(x, dtype = np.float64)
+    y = np.asarray(y, dtype = np.float64)
+    inside = np.zeros(x.shape, dtype = bool)
+    for ring in rings:
+        x0, y0 = ring[:, 0], ring[:, 1]
+        x1, y1 = np.roll(x0, -1), np.roll(y0, -1)
+        for i in xrange(len(ring)):
+            if y0[i] == y1[i]:
+                continue
+            #edges crossed by a ray from each point in the +x direction
+            crosses = (y0[i] > y) != (y1[i] > y)
+            x_cross = x0[i] + (y - y0[i]) * (x1[i] - x0[i]) / (y1[i] - y0[i])
+            inside ^= crosses & (x < x_cross)
+    return inside
+
+
+def _edge_cells(ring):
+    """
+    (pair of int arrays) cols, rows of the grid cells each edge of a ring
+    (in cell units, cell (i, j) spanning i +/- 0.5, j +/- 0.5) runs through.
+    """
+    cols = []
+    rows = []
+    x0, y0 = ring[:, 0], ring[:, 1]
+    x1, y1 = np.roll(x0, -1), np.roll(y0, -1)
+    for i in xrange(len(ring)):
+        #split the edge where it crosses cell boundaries, then take the
+        #cell of the midpoint of each piece
+        ts = [np.array([0.0, 1.0])]
+        for start, end in [(x0[i], x1[i]), (y0[i], y1[i])]:
+            if start != end:
+                lines = np.arange(math.ceil(min(start, end) - 0.5),
+                                  math.floor(max(start, end) - 0.5) + 1) + 0.5
+                ts.append((lines - start) / (end - start))
+        ts = np.unique(np.clip(np.concatenate(ts), 0.0, 1.0))
+        mids = (ts[:-1] + ts[1:]) / 2.0 if len(ts) > 1 else ts
+        cols.append(np.floor(x0[i] + mids * (x1[i] - x0[i]) + 0.5))
+        rows.append(np.floor(y0[i] + mids * (y1[i] - y0[i]) + 0.5))
+    return (np.concatenate(cols).astype(np.int64),
+            np.concatenate(rows).astype(np.int64))
+
+
+def plan_coverage(rings, zoom = 17, scale = 2, image_size = 640,
+                    image_overlap = 0.1, anchor = None, stored_latlngs = None):
+    """
+    Steps of the smallest grid of tiles covering a region.
+
+    INPUT:
+    rings: (list of arrays) (lat, lng) rings of the region, e.g. from
+           bbox_ring or read_polygon.
+    zoom, scale, image_size, image_overlap: as for SatImageCollector.
+    anchor: (pair of floats) lat, lng of the (0, 0) tile. Defaults to the
+            center of the region's bounding box. Plans with the same anchor
+            and zoom share a grid.
+    stored_latlngs: (pair of arrays) lat, lng centers of tiles saved at the
+                    same zoom. Cells one of them covers are skipped.
+
+    OUTPUT:
+    (tuple) anchor (lat, lng), (N, 2) int array of (x, y) steps in row
+    major order, and a dict of counts: 'planned', 'stored' (cells skipped as
+    saved), 'bbox_tiles' (the grid over the bounding box) and
+    'spiral_tiles' (a spiral from the anchor reaching the whole region).
+    """
+    all_latlng = np.concatenate(rings)
+    if anchor is None:
+        anchor = ((all_latlng[:, 0].min() + all_latlng[:, 0].max()) / 2.0,
+                  (all_latlng[:, 1].min() + all_latlng[:, 1].max()) / 2.0)
+    effective_zoom = zoom + math.log(scale, 2)
+    pixel_step = math.floor((1.0 - image_overlap) * scale * image_size)
+    anchor_x, anchor_y = latlng2worldpix(anchor[0], anchor[1], effective_zoom)
+
+    def _to_cells(lats, lngs):
+        world_x, world_y = latlng2worldpix(lats, lngs, effective_zoom)
+        return (world_x - anchor_x) / pixel_step, (world_y - anchor_y) / pixel_step
+
+    cell_rings = [np.column_stack(_to_cells(ring[:, 0], ring[:, 1]))
+                  for ring in rings]
+    all_cells = np.concatenate(cell_rings)
+    col0, row0 = np.floor(all_cells.min(axis = 0) + 0.5).astype(np.int64)
+    col1, row1 = np.floor(all_cells.max(axis = 0) + 0.5).astype(np.int64)
+    n_cols, n_rows = col1 - col0 + 1, row1 - row0 + 1
+
+    #cells with a corner in the region
+    corner_x, corner_y = np.meshgrid(np.arange(col0, col1 + 2) - 0.5,
+                                     np.arange(row0, row1 + 2) - 0.5)
+    corners = points_in_polygon(corner_x, corner_y, cell_rings)
+    covered = (corners[:-1, :-1] | corners[:-1, 1:] |
+               corners[1:, :-1] | corners[1:, 1:])
+    #cells an edge runs through, e.g. around a region smaller than a cell
+    for ring in cell_rings:
+        cols, rows = _edge_cells(ring)
+        covered[rows - row0, cols - col0] = True
+
+    n_stored = 0
+    if stored_latlngs is not None and len(stored_latlngs[0]):
+        saved = _saved_cells(_to_cells(*stored_latlngs), scale * image_size,
+                             pixel_step, col0, row0, n_cols, n_rows)
+        n_stored = int((covered & saved).sum())
+        covered &= ~saved
+
+    rows, cols = np.nonzero(covered)
+    steps = np.column_stack([cols + col0, rows + row0])
+    reach = max(abs(col0), abs(col1), abs(row0), abs(row1))
+    counts = {'planned': len(steps), 'stored': n_stored,
+              'bbox_tiles': int(n_cols * n_rows),
+              'spiral_tiles': int((2 * reach + 1) ** 2)}
+    return anchor, steps, counts
+
+
+def _saved_cells(stored_cells, dim, pixel_step, col0, row0, n_cols, n_rows):
+    """
+    (bool array) grid cells lying wholly inside a saved tile, marked for all
+    the tiles at once through a 2D difference array.
+    """
+    half = dim / 2.0 / pixel_step
+    cols, rows = stored_cells
+    #cell i is inside a tile centered at c if c - half <= i - 0.5 and i + 0.5 <= c + half
+    col_lo = np.maximum(np.ceil(cols - half + 0.5) - col0, 0).astype(np.int64)
+    col_hi = np.minimum(np.floor(cols + half - 0.5) - col0, n_cols - 1).astype(np.int64)
+    row_lo = np.maximum(np.ceil(rows - half + 0.5) - row0, 0).astype(np.int64)
+    row_hi = np.minimum(np.floor(rows + half - 0.5) - row0, n_rows - 1).astype(np.int64)
+    keep = (col_lo <= col_hi) & (row_lo <= row_hi)
+    col_lo, col_hi = col_lo[keep], col_hi[keep]
+    row_lo, row_hi = row_lo[keep], row_hi[keep]
+
+    diff = np.zeros((n_rows + 1, n_cols + 1), dtype = np.int64)
+    np.add.at(diff, (row_lo, col_lo), 1)
+    np.add.at(diff, (row_lo, col_hi + 1), -1)
+    np.add.at(diff, (row_hi + 1, col_lo), -1)
+    np.add.at(diff, (row_hi + 1, col_hi + 1), 1)
+    return diff.cumsum(axis = 0).cumsum(axis = 1)[:n_rows, :n_cols] > 0
+
+
+def stored_tile_latlngs(effective_zoom, catalog = None, save_dir = None):
+    """
+    (pair of arrays) lat, lng centers of the tiles saved at an effective
+    zoom, from a catalog (tiles marked done) or else from the file names in
+    save_dir.
+    """
+    if catalog is not None:
+        tiles = catalog.query(status = 'done', zoom = effective_zoom)
+    elif save_dir is not None and os.path.isdir(save_dir):
+        tiles = []
+        for fname in os.listdir(save_dir):
+            try:
+                tile = parse_tile_fname(fname)
+            except Exception:
+                continue
+            if tile['zoom'] == effective_zoom:
+                tiles.append(tile)
+    else:
+        tiles = []
+    return (np.array([tile['lat'] for tile in tiles], dtype = np.float64),
+            np.array([tile['lng'] for tile in tiles], dtype = np.float64))
+
+
+def coverage_collector(rings, zoom = 17, scale = 2, image_size = 640,
+                        image_overlap = 0.1, anchor = None, catalog = None,
+                        save_dir = None, skip_stored = True, shard = None,
+                        **kwargs):
+    """
+    SatImageCollector for the tiles covering a region, with its calls set up.
+
+    INPUT:
+    rings, zoom, scale, image_size, image_overlap, anchor: see plan_coverage.
+    catalog: (TileCatalog) saved tiles are looked up in it, else in save_dir.
+    skip_stored: (bool) leave out cells saved tiles already cover. Off for
+                 shards, which must plan the same tiles on every machine
+                 (tiles in the catalog are still skipped by get_images).
+    shard: (pair of ints) only collect shard index, count of the plan.
+    kwargs: passed on to SatImageCollector, e.g. api_url.
+
+    OUTPUT:
+    (pair) the SatImageCollector and the counts of plan_coverage.
+    """
+    effective_zoom = int(zoom + math.log(scale, 2))
+    stored = (stored_tile_latlngs(effective_zoom, catalog, save_dir)
+              if skip_stored and shard is None else None)
+    anchor, steps, counts = plan_coverage(rings, zoom, scale, image_size,
+                                          image_overlap, anchor, stored)
+    step_range = (sharding.shard_range(len(steps), *shard)
+                  if shard is not None else None)
+    collector = SatImageCollector(anchor[0], anchor[1], max_tiles = len(steps),
+                                  zoom = zoom, image_size = image_size,
+                                  scale = scale, save_dir = save_dir,
+                                  step_coords = steps.tolist(),
+                                  step_range = step_range, **kwargs)
+    #part of the plan, so shards of different regions don't merge
+    collector.region = [ring.tolist() for ring in rings]
+    collector.setup_calls(image_overlap = image_overlap)
+    return collector, counts
+
+
+def add_arguments(ap):
+    """Add the command line arguments of this script to an ArgumentParser."""
+    region = ap.add_mutually_exclusive_group(required=True)
+    region.add_argument('--bbox', type=float, nargs=4,
+                        metavar=('MIN_LAT', 'MIN_LNG', 'MAX_LAT', 'MAX_LNG'),
+                        help="Bounding box to cover.")
+    region.add_argument('--polygon', help="GeoJSON (Multi)Polygon to cover.")
+    ap.add_argument('-z', '--zoom', type=int, default=17, help="API zoom level.")
+    ap.add_argument('--overlap', type=float, default=0.1,
+                    help="Fraction of each tile repeated on its neighbors.")
+    ap.add_argument('--anchor', type=float, nargs=2, metavar=('LAT', 'LNG'),
+                    help="Center of the (0, 0) tile, to share a grid with other plans.")
+    ap.add_argument('-o', '--outpath', help="Directory to save images in.")
+    ap.add_argument('-c', '--catalog',
+                    help="SQLite tile catalog to record and resume the run with.")
+    ap.add_argument('-n', '--dry-run', action='store_true',
+                    help="Only print the plan's tile counts.")
+    ap.add_argument('-k', '--key', help="Google Maps API key.")
+    ap.add_argument('-w', '--workers', type=int, default=1,
+                    help="Number of concurrent downloads.")
+    ap.add_argument('-r', '--rps', type=float,
+                    help="Maximum requests per second.")
+    ap.add_argument('--retries', type=int, default=3,
+                    help="Retries per tile after a failed call.")
+    ap.add_argument('--shard', type=sharding.parse_shard,
+                    help="Only collect shard INDEX/COUNT of the planned tiles.")
+    ap.add_argument('--api-url', default='http://maps.googleapis.com/maps/api/staticmap?',
+                    help="Base url of the static maps API, e.g. a local server for testing.")
+    metrics_help = "Write run metrics to this file: Prometheus textfile if it ends in .prom, else JSON."
+    ap.add_argument('-m', '--metrics', help=metrics_help)
+
+
+def main(args):
+    """Plan and collect the tiles covering a region with parsed command line arguments, see add_arguments."""
+    if args.metrics:
+        metrics.enable()
+    rings = read_polygon(args.polygon) if args.polygon else [bbox_ring(args.bbox)]
+    catalog = TileCatalog(args.catalog) if args.catalog else None
+    collector, counts = coverage_collector(rings, zoom = args.zoom,
+                                           image_overlap = args.overlap,
+                                           anchor = args.anchor,
+                                           catalog = catalog,
+                                           save_dir = args.outpath,
+                                           shard = args.shard,
+                                           api_url = args.api_url)
+    print json.dumps(counts)
+    if args.dry_run or not counts['planned']:
+        return
+    collector.get_images(api_key = args.key, workers = args.workers,
+                         max_rps = args.rps, retries = args.retries,
+                         catalog = catalog)
+    if args.metrics:
+        metrics.export(args.metrics)
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    add_arguments(ap)
+    main(ap.parse_args())
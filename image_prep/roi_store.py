@@ -0,0 +1,142 @@
+import itertools
+import json
+import numpy as np
+import os
+
+
+class RoiStore(object):
+    """
+    Appendable on-disk dataset of equally sized ROI images, an alternative to
+    writing each ROI as its own PNG. A store is a directory holding:
+
+    rois.bin: the ROI pixels, one (rows, cols, channels) array after another
+              in C order, so the whole file maps to one (N, rows, cols,
+              channels) array.
+    labels.bin: one uint8 class label per ROI (1 positive, 0 negative).
+    index.jsonl: one JSON line of provenance per ROI: source image file,
+                 pixel center [col, row] and label.
+    meta.json: dtype, ROI shape and the number of committed ROIs.
+
+    meta.json is rewritten atomically after each append, and anything past
+    the committed count is discarded on the next append, so a crash in the
+    middle of an append never corrupts the store.
+    """
+
+    def __init__(self, path):
+        """
+        INPUT:
+        path: (str) Directory of the store. Created if it doesn't exist.
+        """
+        self.path = path
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+        meta_path = os.path.join(path, 'meta.json')
+        if os.path.exists(meta_path):
+            with open(meta_path) as fin:
+                self.meta = json.load(fin)
+        else:
+            self.meta = {'dtype': None, 'roi_shape': None, 'count': 0,
+                         'index_bytes': 0}
+
+
+    def __len__(self):
+        return self.meta['count']
+
+
+    def append(self, rois, labels, img_file = None, centers = None):
+        """
+        Add ROIs to the end of the store.
+
+        INPUT:
+        rois: (array) of shape (N, rows, cols, channels).
+        labels: (list of ints) class label of each ROI.
+        img_file: (str) source image of the ROIs.
+        centers: (list of pairs of ints) [col, row] pixel center of each ROI
+                 in the source image.
+
+        OUTPUT:
+        (list of ints) store indices of the added ROIs.
+        """
+        rois = np.ascontiguousarray(rois)
+        if len(rois) == 0:
+            return []
+        if len(labels) != len(rois):
+            raise Exception("Got {0} labels for {1} ROIs.".format(len(labels),
+                                                                    len(rois)))
+
+        if self.meta['dtype'] is None:
+            self.meta['dtype'] = rois.dtype.str
+            self.meta['roi_shape'] = list(rois.shape[1:])
+        elif ((rois.dtype.str != self.meta['dtype']) or
+                (list(rois.shape[1:]) != self.meta['roi_shape'])):
+            except_s = "ROIs of dtype {0} and shape {1} don't match store: {2} {3}"
+            raise Exception(except_s.format(rois.dtype.str, rois.shape[1:],
+                                            self.meta['dtype'],
+                                            self.meta['roi_shape']))
+
+        count = self.meta['count']
+        roi_nbytes = rois[0].nbytes
+        if centers is None:
+            centers = [None] * len(rois)
+        index_lines = ''.join(json.dumps({'img_file': img_file,
+                                          'center': center,
+                                          'label': int(label)}) + '\n'
+                                for label, center in zip(labels, centers))
+
+        self._append_bytes('rois.bin', count * roi_nbytes, rois.tostring())
+        self._append_bytes('labels.bin', count,
+                            np.asarray(labels, dtype=np.uint8).tostring())
+        self._append_bytes('index.jsonl', self.meta['index_bytes'],
+                            index_lines)
+
+        self.meta['count'] = count + len(rois)
+        self.meta['index_bytes'] += len(index_lines)
+        self._write_meta()
+
+        return range(count, count + len(rois))
+
+
+    def arrays(self):
+        """
+        Open the store without copying or decoding.
+
+        OUTPUT:
+        (pair) X: read only memory map of shape (N, rows, cols, channels),
+               y: read only memory map of the N labels.
+        """
+        count = self.meta['count']
+        if count == 0:
+            raise Exception("ROI store is empty: {0}".format(self.path))
+
+        X = np.memmap(os.path.join(self.path, 'rois.bin'),
+                        dtype=np.dtype(self.meta['dtype']), mode='r',
+                        shape=tuple([count] + self.meta['roi_shape']))
+        y = np.memmap(os.path.join(self.path, 'labels.bin'), dtype=np.uint8,
+                        mode='r', shape=(count,))
+        return X, y
+
+
+    def provenance(self):
+        """Generator of the provenance dicts of the ROIs, in store order."""
+        with open(os.path.join(self.path, 'index.jsonl')) as fin:
+            for line in itertools.islice(fin, self.meta['count']):
+                yield json.loads(line)
+
+
+    def _append_bytes(self, fname, committed_nbytes, data):
+        with open(os.path.join(self.path, fname), 'ab') as fout:
+            #drop anything left over from an interrupted append
+            fout.truncate(committed_nbytes)
+            fout.write(data)
+            fout.flush()
+            os.fsync(fout.fileno())
+
+
+    def _write_meta(self):
+        meta_path = os.path.join(self.path, 'meta.json')
+        with open(meta_path + '.tmp', 'w') as fout:
+            json.dump(self.meta, fout)
+            fout.flush()
+            os.fsync(fout.fileno())
+        os.rename(meta_path + '.tmp', meta_path)
@@ -0,0 +1,395 @@
+"""
+Upload tiles, ROI stores or any directory to S3 (with boto 2), either as one
+object per file or streamed into a single .tar.gz object. No archive is
+ever written to local disk.
+
+Files above the part size go up as multipart uploads, with their parts
+sent in parallel straight from the file. A streamed archive is cut into
+parts as tar writes it, and at most a few parts are held in memory at a
+time. Files whose object already exists with a matching checksum (ETag)
+are skipped, and so are archives whose directory hasn't changed since
+they were uploaded.
+
+Credentials come from the usual boto places (environment variables or
+~/.boto). --host/--port point the upload at an S3 compatible server, e.g.
+a local stand-in for testing.
+
+example usage:
+python s3_upload.py tiles/dir -b my-bucket -p tiles/ -w 8
+python s3_upload.py rois/store -b my-bucket -a rois/store.tar.gz
+"""
+import argparse
+from cStringIO import StringIO
+import functools
+import hashlib
+import json
+import os
+import tarfile
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+import boto
+import boto.s3.connection
+from boto.s3.multipart import MultiPartUpload
+
+#S3 parts must be at least 5MB, except the last one
+PART_SIZE = 8 * 1024 * 1024
+READ_SIZE = 1024 * 1024
+
+
+def connect_s3(access_key = None, secret_key = None, host = None, port = None,
+                is_secure = True):
+    """
+    (S3Connection) connection to S3, or to an S3 compatible server at host.
+    Without keys, boto reads them from the environment or its config file.
+    """
+    kwargs = {'is_secure': is_secure}
+    if host is not None:
+        kwargs['host'] = host
+        kwargs['calling_format'] = boto.s3.connection.OrdinaryCallingFormat()
+    if port is not None:
+        kwargs['port'] = port
+    return boto.s3.connection.S3Connection(access_key, secret_key, **kwargs)
+
+
+def file_etag(path, part_size = PART_SIZE):
+    """
+    (str) ETag S3 gives the file once uploaded by upload_dir: its md5 hex
+    digest, or for a multipart upload the md5 of the parts' binary md5s
+    followed by '-' and the number of parts. Reads the file in blocks.
+    """
+    part_md5s = []
+    whole_md5 = hashlib.md5()
+    with open(path, 'rb') as fin:
+        while True:
+            part_md5 = hashlib.md5()
+            nbytes = 0
+            while nbytes < part_size:
+                block = fin.read(min(READ_SIZE, part_size - nbytes))
+                if not block:
+                    break
+                part_md5.update(block)
+                whole_md5.update(block)
+                nbytes += len(block)
+            if nbytes == 0:
+                break
+            part_md5s.append(part_md5.digest())
+            if nbytes < part_size:
+                break
+    if len(part_md5s) <= 1:
+        return whole_md5.hexdigest()
+    return '{0}-{1}'.format(hashlib.md5(''.join(part_md5s)).hexdigest(),
+                            len(part_md5s))
+
+
+class _Buckets(object):
+    """One connection and bucket per thread, as boto connections are not shared."""
+
+    def __init__(self, connect, bucket_name):
+        self.connect = connect
+        self.bucket_name = bucket_name
+        self._local = threading.local()
+
+    def get(self):
+        if not hasattr(self._local, 'bucket'):
+            self._local.bucket = self.connect().get_bucket(self.bucket_name,
+                                                           validate = False)
+        return self._local.bucket
+
+
+def _upload_part(buckets, key_name, upload_id, part_num, source):
+    """
+    Upload one part of a multipart upload, from a (path, offset, size) range
+    of a file or from a string.
+    """
+    mp = MultiPartUpload(buckets.get())
+    mp.key_name = key_name
+    mp.id = upload_id
+    if isinstance(source, str):
+        mp.upload_part_from_file(StringIO(source), part_num)
+        return len(source)
+    path, offset, size = source
+    with open(path, 'rb') as fin:
+        fin.seek(offset)
+        mp.upload_part_from_file(fin, part_num, size = size)
+    return size
+
+
+def _upload_file(buckets, part_pool, path, key_name, part_size):
+    """Helper for upload_dir. Upload one file, in parallel parts if it is large."""
+    size = os.path.getsize(path)
+    bucket = buckets.get()
+    if size <= part_size:
+        key = bucket.new_key(key_name)
+        with open(path, 'rb') as fin:
+            key.set_contents_from_file(fin)
+        return size
+
+    mp = bucket.initiate_multipart_upload(key_name)
+    try:
+        ranges = [(part_num + 1, (path, offset, min(part_size, size - offset)))
+                  for part_num, offset in enumerate(xrange(0, size, part_size))]
+        results = [part_pool.apply_async(_upload_part,
+                                         (buckets, key_name, mp.id, part_num,
+                                          source))
+                   for part_num, source in ranges]
+        for result in results:
+            result.get()
+        mp.complete_upload()
+    except Exception:
+        mp.cancel_upload()
+        raise
+    return size
+
+
+def upload_file(connect, bucket_name, path, key_name, workers = 8,
+                part_size = PART_SIZE):
+    """
+    Upload one file, in parallel parts if it is larger than part_size.
+    See upload_dir for the arguments.
+
+    OUTPUT:
+    (int) bytes uploaded.
+    """
+    part_pool = ThreadPool(max(workers, 1))
+    try:
+        return _upload_file(_Buckets(connect, bucket_name), part_pool, path,
+                            key_name, part_size)
+    finally:
+        part_pool.terminate()
+
+
+def upload_dir(connect, bucket_name, root, prefix = '', workers = 8,
+                part_size = PART_SIZE, skip_matching = True, verbose = True):
+    """
+    Upload every file under a directory as its own object.
+
+    INPUT:
+    connect: (function) returning a new S3Connection, e.g.
+             functools.partial(connect_s3, host = ...). Called once per
+             thread.
+    bucket_name: (str) bucket to upload to.
+    root: (str) directory to upload. Object names are prefix followed by
+          the path relative to root.
+    prefix: (str) prefix of the object names, e.g. 'tiles/'.
+    workers: (int) files uploaded at a time, and parts of large files
+             uploaded at a time.
+    part_size: (int) bytes per part. Larger files are uploaded in parts.
+    skip_matching: (bool) skip files whose object already has their ETag.
+
+    OUTPUT:
+    (dict) counts of files 'uploaded' and 'skipped', 'bytes' uploaded, a
+           list of 'failed' (path, reason), 'seconds' and 'mb_per_sec'.
+    """
+    buckets = _Buckets(connect, bucket_name)
+    existing = {}
+    if skip_matching:
+        #one listing instead of a HEAD request per file
+        for key in buckets.get().list(prefix = prefix):
+            existing[key.name] = key.etag.strip('"')
+
+    paths = []
+    for dirpath, dirnames, fnames in os.walk(root):
+        dirnames.sort()
+        for fname in sorted(fnames):
+            path = os.path.join(dirpath, fname)
+            key_name = prefix + os.path.relpath(path, root).replace(os.sep, '/')
+            paths.append((path, key_name))
+
+    stats = {'uploaded': 0, 'skipped': 0, 'bytes': 0, 'failed': []}
+    part_pool = ThreadPool(max(workers, 1))
+    file_pool = ThreadPool(max(workers, 1))
+
+    def _task(item):
+        path, key_name = item
+        try:
+            if (key_name in existing and
+                    existing[key_name] == file_etag(path, part_size)):
+                return path, None, None
+            return path, _upload_file(buckets, part_pool, path, key_name,
+                                      part_size), None
+        except Exception as e:
+            return path, None, str(e)
+
+    start_time = time.time()
+    try:
+        for path, nbytes, err in file_pool.imap_unordered(_task, paths):
+            if err is not None:
+                stats['failed'].append((path, err))
+                if verbose:
+                    print "Failed to upload {0}: {1}".format(path, err)
+            elif nbytes is None:
+                stats['skipped'] += 1
+            else:
+                stats['uploaded'] += 1
+                stats['bytes'] += nbytes
+    finally:
+        file_pool.terminate()
+        part_pool.terminate()
+
+    return _finish(stats, start_time, verbose)
+
+
+def _finish(stats, start_time, verbose):
+    stats['seconds'] = time.time() - start_time
+    stats['mb_per_sec'] = (stats['bytes'] / 1e6 / stats['seconds']
+                           if stats['seconds'] > 0 else 0.0)
+    if verbose:
+        p_str = "Uploaded {0} objects, {1:.1f} MB ({2} skipped, {3} failed) in {4:.1f}s: {5:.2f} MB/sec"
+        print p_str.format(stats['uploaded'], stats['bytes'] / 1e6,
+                           stats['skipped'], len(stats['failed']),
+                           stats['seconds'], stats['mb_per_sec'])
+    return stats
+
+
+class _PartWriter(object):
+    """
+    File-like object that tar writes the archive into. Each time part_size
+    bytes have been written, they are sent off as the next part of a
+    multipart upload, with at most max_pending parts in memory.
+    """
+
+    def __init__(self, buckets, mp, part_pool, part_size, max_pending):
+        self.buckets = buckets
+        self.mp = mp
+        self.part_pool = part_pool
+        self.part_size = part_size
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._chunks = []
+        self._buffered = 0
+        self._results = []
+        self.bytes = 0
+
+    def write(self, data):
+        self._chunks.append(data)
+        self._buffered += len(data)
+        if self._buffered >= self.part_size:
+            self._send(''.join(self._chunks))
+
+    def _send(self, part):
+        self._chunks = []
+        self._buffered = 0
+        #blocks while max_pending parts are waiting or uploading
+        self._slots.acquire()
+        #stop at the first failed part instead of streaming on
+        for result in self._results:
+            if result.ready() and not result.successful():
+                self._slots.release()
+                result.get()
+        self._results.append(self.part_pool.apply_async(
+                self._upload, (len(self._results) + 1, part)))
+        self.bytes += len(part)
+
+    def _upload(self, part_num, part):
+        try:
+            return _upload_part(self.buckets, self.mp.key_name, self.mp.id,
+                                part_num, part)
+        finally:
+            self._slots.release()
+
+    def close(self):
+        """Send the last part and wait for all parts to be uploaded."""
+        if self._chunks or not self._results:
+            self._send(''.join(self._chunks))
+        for result in self._results:
+            result.get()
+
+
+def dir_fingerprint(root):
+    """
+    (str) md5 over the relative path, size and modification time of every
+    file under root, to tell whether an archive of it is out of date
+    without reading the files.
+    """
+    fingerprint = hashlib.md5()
+    for dirpath, dirnames, fnames in os.walk(root):
+        dirnames.sort()
+        for fname in sorted(fnames):
+            path = os.path.join(dirpath, fname)
+            info = os.stat(path)
+            fingerprint.update('{0}\t{1}\t{2}\n'.format(
+                    os.path.relpath(path, root), info.st_size,
+                    int(info.st_mtime)))
+    return fingerprint.hexdigest()
+
+
+def upload_archive(connect, bucket_name, root, key_name, workers = 8,
+                    part_size = PART_SIZE, skip_matching = True,
+                    verbose = True):
+    """
+    Stream a directory to one .tar.gz object, as tar czf would write it,
+    without building the archive on disk.
+
+    INPUT:
+    connect, bucket_name, workers, part_size: see upload_dir.
+    root: (str) directory to archive. Archive members are under its name.
+    key_name: (str) name of the archive object.
+    skip_matching: (bool) skip the upload if the object was uploaded from
+                   the directory as it is now (see dir_fingerprint).
+
+    OUTPUT:
+    (dict) as for upload_dir, with 'bytes' the compressed size.
+    """
+    buckets = _Buckets(connect, bucket_name)
+    bucket = buckets.get()
+    fingerprint = dir_fingerprint(root)
+    stats = {'uploaded': 0, 'skipped': 0, 'bytes': 0, 'failed': []}
+    start_time = time.time()
+    if skip_matching:
+        key = bucket.get_key(key_name)
+        if (key is not None) and (key.get_metadata('dir-fingerprint') == fingerprint):
+            stats['skipped'] = 1
+            return _finish(stats, start_time, verbose)
+
+    mp = bucket.initiate_multipart_upload(
+            key_name, metadata = {'dir-fingerprint': fingerprint})
+    part_pool = ThreadPool(max(workers, 1))
+    try:
+        writer = _PartWriter(buckets, mp, part_pool, part_size,
+                             max_pending = max(workers, 1) + 1)
+        tar = tarfile.open(fileobj = writer, mode = 'w|gz')
+        tar.add(root, arcname = os.path.basename(os.path.normpath(root)))
+        tar.close()
+        writer.close()
+        mp.complete_upload()
+        stats['uploaded'] = 1
+        stats['bytes'] = writer.bytes
+    except Exception as e:
+        mp.cancel_upload()
+        stats['failed'].append((root, str(e)))
+        if verbose:
+            print "Failed to upload {0}: {1}".format(root, e)
+    finally:
+        part_pool.terminate()
+
+    return _finish(stats, start_time, verbose)
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument('path', help="Directory to upload, e.g. tiles or an ROI store.")
+    ap.add_argument('-b', '--bucket', required=True, help="Bucket to upload to.")
+    ap.add_argument('-p', '--prefix', default='', help="Prefix of the object names.")
+    ap.add_argument('-a', '--archive', help="Upload as this one .tar.gz object instead.")
+    ap.add_argument('-w', '--workers', type=int, default=8, help="Parallel uploads.")
+    ap.add_argument('--part-mb', type=int, default=PART_SIZE // (1024 * 1024),
+                    help="Multipart part size in MB (at least 5).")
+    ap.add_argument('--force', action='store_true', help="Upload even if the checksums match.")
+    ap.add_argument('--host', help="S3 compatible server to upload to instead of AWS.")
+    ap.add_argument('--port', type=int, help="Port of --host.")
+    ap.add_argument('--insecure', action='store_true', help="Use http instead of https.")
+
+    args = ap.parse_args()
+    connect = functools.partial(connect_s3, host = args.host, port = args.port,
+                                is_secure = not args.insecure)
+    part_size = args.part_mb * 1024 * 1024
+    if args.archive:
+        stats = upload_archive(connect, args.bucket, args.path, args.archive,
+                               workers = args.workers, part_size = part_size,
+                               skip_matching = not args.force)
+    else:
+        stats = upload_dir(connect, args.bucket, args.path, prefix = args.prefix,
+                           workers = args.workers, part_size = part_size,
+                           skip_matching = not args.force)
+    if stats['failed']:
+        print json.dumps({'failed': stats['failed']})
@@ -3,22 +3,97 @@ import cv2
 import json
 import numpy as np
 import os
+from annotation_journal import AnnotationJournal, iter_annotations, seen_files as annotated_files
+from streaming import prefetch
+from tile_catalog import TileCatalog
 
-#GLOBALS
-# initialize the list of reference points and boolean indicating
-# whether cropping is being performed or not
-refPt = []
-neg_refPt = []
 window_side = 48
 halfwin_side = window_side // 2
-positive_examples = True
-image = None
+
+
+class AnnotationSession(object):
+    """
+    State of an annotation pass over one image at a time: the image being 
+    shown, the positive/negative points clicked on it so far, and whether
+    clicks are positive. Holds no windowing code, so it can be driven 
+    headlessly, e.g. session.click(x, y); session.key('c').
+    """
+
+    def __init__(self):
+        self.img_fname = None
+        self.image = None
+        self.pos_points = []
+        self.neg_points = []
+        self.positive_examples = True
+        #True when self.image has changed and should be redrawn
+        self.dirty = False
+
+    def start_image(self, img_fname, image):
+        self.img_fname = img_fname
+        self.image = image
+        self.pos_points = []
+        self.neg_points = []
+        self.dirty = True
+
+    def click(self, x, y):
+        """
+        Record the pixel location of a click and annotate the image with a 
+        color coded box. Green box: recorded as a "positive example", 
+        Blue box: recorded as a "negative example."
+        """
+        if self.positive_examples:
+            self.pos_points.append((x, y))
+            rect_color = (0, 255, 0)
+        else:
+            self.neg_points.append((x, y))
+            rect_color = (255, 0, 0)
+        self._draw_box((x, y), rect_color)
+
+    def key(self, key):
+        """
+        Handle a key press (see batch_image_roi_collector for the keys).
+
+        OUTPUT:
+        (str) 'next' to move on to the next image, 'quit' to stop, else None.
+        """
+        # if the 'r' key is pressed, remove last click, display white box
+        if key == "r":
+            points = self.pos_points if self.positive_examples else self.neg_points
+            if points:
+                self._draw_box(points.pop(), (255, 255, 255))
+        elif key == "p":
+            self.positive_examples = True
+        elif key == "n":
+            self.positive_examples = False
+        elif key == "c":
+            return 'next'
+        elif key == "q":
+            return 'quit'
+        return None
+
+    def result(self):
+        """(dict) annotation of the current image, see batch_image_roi_collector."""
+        return {'img_file': self.img_fname, 
+                'positive_points': list(self.pos_points), 
+                'negative_points': list(self.neg_points)}
+
+    def _draw_box(self, point, rect_color):
+        # draw a rectangle around the region of interest
+        upleft_corner = (point[0] - halfwin_side, point[1] - halfwin_side)
+        lowright_corner = (point[0] + halfwin_side, point[1] + halfwin_side)
+        if self.image is not None:
+            cv2.rectangle(self.image, upleft_corner, lowright_corner, rect_color, 2)
+        self.dirty = True
+
 
 def batch_image_roi_collector(images_l, dirpath, shuffle_files = False, 
-                                seen_files = None):
+                                seen_files = None, catalog = None, 
+                                prefetch_images = 3, journal = None):
     """
     Save pixel locations of regions of interest across a batch of images.
     Images are displayed and a user clicks on ROIs in the image to be recorded.
+    The window is only redrawn after a click or key press, and the next 
+    images are decoded in a background thread while the current one is shown.
 
     KEYBOARD USAGE:
     p: Set next clicks to be recorded as Positive Examples. Displays green box.
@@ -32,8 +107,14 @@ def batch_image_roi_collector(images_l, dirpath, shuffle_files = False,
     images_l: (list) of image filenames.
     dirpath: (str) File path to images.
     shuffle_files: (bool) Randomize the order images are shown.
-    seen_files: (list) of image filenames, that are a subset of images_l, that 
-                have been seen, and therefore should not be fetched again.
+    seen_files: (list or set) of image filenames, that are a subset of 
+                images_l, that have been seen, and therefore should not be 
+                fetched again.
+    catalog: (TileCatalog) If given, image paths are looked up in the tile 
+             catalog, and dirpath is only used for images not in it.
+    prefetch_images: (int) Number of images to decode ahead of the one shown.
+    journal: (AnnotationJournal) If given, each image's annotation is written
+             to it as soon as the image is done.
 
     OUTPUT:
     (list of dicts) Can be written to JSON. Contains: Image filename, lists of
@@ -45,141 +126,104 @@ def batch_image_roi_collector(images_l, dirpath, shuffle_files = False,
          {"img_file": "img-1_1_37.7792471625_-122.401920827_zoom18.png", 
          "negative_points": [[605, 259]], "positive_points": []}]
     """
-    global image, refPt, neg_refPt, positive_examples
     img_roi_ds = []
 
-
     if seen_files is not None:
-        original_images_len = len(images_l)
-        images_l = np.setdiff1d(images_l, seen_files)
-        #print "Removed {0} images from input images list.".format(original_images_len - len(images_l))
+        seen_files = set(seen_files)
+        images_l = [fname for fname in images_l if fname not in seen_files]
     if shuffle_files:
         np.random.shuffle(images_l)
 
-    quit_called = False
+    img_paths = []
     for img_fname in images_l:
-    # load the image, clone it, and setup the mouse callback function
-        if quit_called:
+        tile = catalog.get(img_fname) if catalog is not None else None
+        img_paths.append(tile['path'] if tile else os.path.join(dirpath, img_fname))
+
+    def _load_images():
+        for img_fname, img_path in zip(images_l, img_paths):
+            yield img_fname, cv2.imread(img_path)
+
+    session = AnnotationSession()
+    cv2.namedWindow("image")
+    cv2.setMouseCallback("image", _on_mouse, session)
+
+    for img_fname, image in prefetch(_load_images(), max_queued = prefetch_images):
+        session.start_image(img_fname, image)
+        action = None
+        while action is None:
+            if session.dirty:
+                cv2.imshow("image", session.image)
+                session.dirty = False
+            # block until a key is pressed, clicks are handled meanwhile by _on_mouse
+            key = cv2.waitKey(0) & 0xFF
+            action = session.key(chr(key))
+
+        img_roi_ds.append(session.result())
+        if journal is not None:
+            journal.append(img_roi_ds[-1])
+        if action == 'quit':
             break
-        image = cv2.imread(os.path.join(dirpath, img_fname))
-
-        ## DEPRECATED.
-        ## Download file here instead of in google_satellite_images.py
-        ## using the file name format
-        ## e.g. img-1_0_37.7841313802_-122.401920827_zoom18.png
-        # lat, lng = img_fname.split('_')[2:4]
-
-        # map_byte_str = googlemapspixels.api_url_builder_requester(lat, lng)
-        # map_arr = np.fromstring(map_byte_str, np.uint8)
-        # image = cv2.imdecode(map_arr, cv2.CV_LOAD_IMAGE_COLOR)
-
-        cv2.namedWindow("image")
-        cv2.setMouseCallback("image", _click)
-         
-        # keep looping until the 'q' key is pressed
-        while True:
-            # display the image and wait for a keypress
-            cv2.imshow("image", image)
-
-            key = cv2.waitKey(1) & 0xFF
-         
-            # if the 'r' key is pressed, remove last click, display white box
-            if key == ord("r"):
-                if positive_examples and (len(refPt) > 0):
-                    remove_coords = refPt[-1]
-                    refPt = refPt[:-1]
-                elif (not positive_examples) and (len(neg_refPt) > 0):
-                    remove_coords = neg_refPt[-1]
-                    neg_refPt = neg_refPt[:-1]
-                else:
-                    remove_coords = False
-
-                if remove_coords:
-                    upleft_corner = (remove_coords[0] - halfwin_side, \
-                                        remove_coords[1] - halfwin_side)
-                    lowright_corner = (remove_coords[0] + halfwin_side, \
-                                        remove_coords[1] + halfwin_side)
-                    cv2.rectangle(image, upleft_corner, lowright_corner, 
-                                    (255, 255, 255), 2)
-
-            elif key == ord("p"):
-                positive_examples = True
-            elif key == ord("n"):
-                positive_examples = False
-            # if the 'c' key is pressed, break from the loop, move to next image
-            elif key == ord("c"):
-                break
-            elif key == ord("q"):
-                quit_called = True
-                break
-
-        img_roi_ds.append({'img_file':img_fname, 
-                           'positive_points':refPt, 
-                           'negative_points':neg_refPt})
-        refPt = []
-        neg_refPt = []
 
+    cv2.destroyWindow("image")
     return img_roi_ds
 
 
-def _click(event, x, y, flags, param):
+def _on_mouse(event, x, y, flags, session):
     """
-    Helper func.
-    Record the pixel location of click on an image and annotate the image with
-    a color coded box. Green box: recorded as a "positive example", Blue box: 
-    recorded as a "negative example."
+    Helper func. OpenCV mouse callback: record a click in the session and 
+    redraw the image.
 
     Modified from:
     http://www.pyimagesearch.com/2015/03/09/capturing-mouse-click-events-with-python-and-opencv/
     """
-    # grab references to the global variables
-    global refPt, neg_refPt, positive_examples
- 
-
     if event == cv2.EVENT_LBUTTONUP:
-        # record the ending (x, y) coordinates and indicate that
-        # And draw a colored box around the click point.
-        if positive_examples:
-            refPt.append((x, y))
-            rect_color = (0, 255, 0)
-        else:
-            neg_refPt.append((x, y))
-            rect_color = (255, 0, 0)
-
- 
-        # draw a rectangle around the region of interest
-        upleft_corner = (x - halfwin_side, y - halfwin_side)
-        lowright_corner = (x + halfwin_side, y + halfwin_side)
-        cv2.rectangle(image, upleft_corner, lowright_corner, rect_color, 2)
-        cv2.imshow("image", image)
+        session.click(x, y)
+        cv2.imshow("image", session.image)
+        session.dirty = False
 
 
 if __name__ == "__main__":
     ap = argparse.ArgumentParser()
-    ap.add_argument('textfile', help="File listing of images using naming convention.")
+    ap.add_argument('textfile', nargs='?', 
+                    help="File listing of images using naming convention.")
     ap.add_argument('-p', '--path', help="Path to images listed in textfile")
     json_help = "Path to json file of results, if some of the images in input textfile have been seen."
     ap.add_argument('-j', '--json', help=json_help)
+    catalog_help = "Tile catalog written by google_satellite_images.py. If no textfile is given, annotate all saved tiles in it."
+    ap.add_argument('-c', '--catalog', help=catalog_help)
+    journal_help = "Journal (.jsonl) each finished image is appended to. Images already in it are skipped, so a crashed session can be resumed."
+    ap.add_argument('-l', '--journal', help=journal_help)
 
     args = ap.parse_args()
-    with open(args.textfile) as fin:
-        images_l = [imgname.strip() for imgname in fin.readlines()]
+    catalog = TileCatalog(args.catalog) if args.catalog else None
+    if args.textfile:
+        with open(args.textfile) as fin:
+            images_l = [imgname.strip() for imgname in fin.readlines()]
+    elif catalog is not None:
+        images_l = [tile['fname'] for tile in catalog.query(status = 'done')]
+    else:
+        ap.error("Either a textfile or a catalog is required.")
 
     dirpath = args.path if args.path else ''
 
-    if args.json:
-        seen_files_json = json.load(open(args.json))
-        seen_files = [x['img_file'] for x in seen_files_json]
-    else:
-        seen_files = None
+    journal = AnnotationJournal(args.journal) if args.journal else None
+    seen_files = annotated_files(args.json)
+    if journal is not None:
+        seen_files.update(journal.seen_files())
 
     img_rois = batch_image_roi_collector(images_l, dirpath, 
                                             shuffle_files = True, 
-                                            seen_files = seen_files)
-
+                                            seen_files = seen_files,
+                                            catalog = catalog,
+                                            journal = journal)
+
+    #the journal holds this session's results as well as earlier sessions'
+    if journal is not None:
+        journal.close()
+        img_rois = list(iter_annotations(args.journal))
     #include the previously input results with new output.
-    if seen_files:
-        img_rois.extend(seen_files_json)
+    if args.json:
+        img_rois.extend(iter_annotations(args.json))
 
     print json.dumps(img_rois)
 
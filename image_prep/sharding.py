@@ -0,0 +1,221 @@
+"""
+Split one tile collection across machines, and merge the results.
+
+The tiles planned by SatImageCollector are numbered by their step in the
+spiral, so a plan (center, max_tiles, zoom, ...) is split into contiguous
+ranges of step indices. Every machine plans the same spiral and only
+downloads its own range. The split depends only on the plan and the shard
+count, so a shard can be rerun anywhere and get the same tiles. Each shard
+records its tiles in its own catalog. merge_shards checks that the shard
+catalogs come from one plan and cover each of its steps exactly once, then
+writes them into one catalog.
+
+example usage, for 4 machines:
+python google_satellite_images.py 36.1699390347 -115.139826918 -n 100000 \
+ --shard 0/4 -o tiles -c shard0.db -w 8 -k YOUR_API_KEY
+(shards 1/4 to 3/4 on the other machines, or --steps 25000:50000 etc.)
+python sharding.py shard0.db shard1.db shard2.db shard3.db -o tiles.db
+"""
+import argparse
+import json
+import numpy as np
+import os
+import sys
+from tile_catalog import TileCatalog
+
+
+def shard_range(n_steps, shard_index, shard_count):
+    """
+    (pair of ints) [first, last) step indices of shard shard_index out of
+    shard_count near equal contiguous shards of n_steps steps.
+    """
+    if not 0 <= shard_index < shard_count:
+        raise Exception("Shard index {0} out of range for {1} shards.".format(
+                            shard_index, shard_count))
+    return (n_steps * shard_index // shard_count,
+            n_steps * (shard_index + 1) // shard_count)
+
+
+def parse_shard(text):
+    """
+    (pair of ints) shard index and count from 'INDEX/COUNT', e.g. '0/4'. An
+    argparse type, so bad input raises argparse.ArgumentTypeError.
+    """
+    try:
+        shard_index, shard_count = [int(part) for part in text.split('/')]
+    except ValueError:
+        raise argparse.ArgumentTypeError("Expected a shard as INDEX/COUNT, got: {0}".format(text))
+    if not 0 <= shard_index < shard_count:
+        raise argparse.ArgumentTypeError("Shard index {0} out of range for {1} shards.".format(
+                                              shard_index, shard_count))
+    return shard_index, shard_count
+
+
+def parse_step_range(text):
+    """
+    (pair of ints) [first, last) step indices from 'FIRST:LAST', e.g. 
+    '0:25000'. An argparse type, as parse_shard.
+    """
+    try:
+        first, last = [int(part) for part in text.split(':')]
+    except ValueError:
+        raise argparse.ArgumentTypeError("Expected a step range as FIRST:LAST, got: {0}".format(text))
+    if not 0 <= first <= last:
+        raise argparse.ArgumentTypeError("Bad step range: {0}".format(text))
+    return first, last
+
+
+def _index_ranges(indices):
+    """(list of pairs) sorted step indices collapsed into [first, last) ranges."""
+    ranges = []
+    for idx in indices:
+        if ranges and ranges[-1][1] == idx:
+            ranges[-1][1] = idx + 1
+        else:
+            ranges.append([idx, idx + 1])
+    return ranges
+
+
+def check_coverage(shard_dbs):
+    """
+    Check that shard catalogs come from one plan and, together, hold each of
+    its steps exactly once.
+
+    INPUT:
+    shard_dbs: (list of str) paths of the shard catalogs.
+
+    OUTPUT:
+    (dict) 'plan', 'shards' (path, step range, status counts per shard),
+           'tiles', problems: 'mismatched' (shards with another plan),
+           'missing' ([first, last) ranges of steps no shard has),
+           'duplicates' (steps in more than one shard, or out of the
+           plan, with the shards holding them) and 'not_done' (file
+           names of tiles not downloaded), and 'valid' (True if there are
+           no mismatched, missing or duplicate tiles).
+    """
+    report = {'plan': None, 'shards': [], 'tiles': 0, 'mismatched': [],
+              'missing': [], 'duplicates': [], 'not_done': []}
+    step_idxs = []
+    shard_ids = []
+    for shard_id, db_path in enumerate(shard_dbs):
+        if not os.path.exists(db_path):
+            raise Exception("No shard catalog at: {0}".format(db_path))
+        catalog = TileCatalog(db_path)
+        plan = catalog.get_meta('plan')
+        report['shards'].append({'path': db_path,
+                                 'step_range': catalog.get_meta('step_range'),
+                                 'status_counts': catalog.status_counts()})
+        if plan is None:
+            report['mismatched'].append(db_path)
+            catalog.close()
+            continue
+        if report['plan'] is None:
+            report['plan'] = plan
+        elif plan != report['plan']:
+            report['mismatched'].append(db_path)
+            catalog.close()
+            continue
+
+        for row in catalog.query():
+            step_idxs.append(row['step_idx'])
+            shard_ids.append(shard_id)
+            if row['status'] != 'done':
+                report['not_done'].append(row['fname'])
+        catalog.close()
+
+    report['tiles'] = len(step_idxs)
+    if report['plan'] is not None:
+        n_steps = report['plan']['max_tiles']
+        step_idxs = np.array(step_idxs, dtype = np.int64)
+        shard_ids = np.array(shard_ids, dtype = np.int64)
+        in_plan = (step_idxs >= 0) & (step_idxs < n_steps)
+        counts = np.bincount(step_idxs[in_plan], minlength = n_steps)
+        report['missing'] = _index_ranges(np.flatnonzero(counts == 0).tolist())
+
+        #steps out of the plan, or held more than once
+        bad = ~in_plan
+        bad[in_plan] = counts[step_idxs[in_plan]] > 1
+        dup_steps = {}
+        for idx, shard_id in zip(step_idxs[bad].tolist(), shard_ids[bad].tolist()):
+            dup_steps.setdefault(idx, []).append(shard_dbs[shard_id])
+        report['duplicates'] = [{'step_idx': idx, 'shards': paths}
+                                for idx, paths in sorted(dup_steps.items())]
+
+    report['valid'] = ((report['plan'] is not None) and
+                       not (report['mismatched'] or report['missing'] or
+                            report['duplicates']))
+    return report
+
+
+def merge_shards(shard_dbs, out_db, allow_incomplete = False):
+    """
+    Merge shard catalogs into one catalog, after checking their coverage
+    with check_coverage.
+
+    INPUT:
+    shard_dbs: (list of str) paths of the shard catalogs.
+    out_db: (str) path of the merged catalog. Replaced if it exists.
+    allow_incomplete: (bool) Merge even if some tiles failed to download
+                      (rerunning their shard with its catalog retries them).
+
+    OUTPUT:
+    (dict) the coverage report. Raises an Exception, without writing
+    out_db, if the shards don't cover the plan.
+    """
+    report = check_coverage(shard_dbs)
+    if not report['valid']:
+        raise Exception("Shards don't cover the plan: {0} mismatched, {1} missing step ranges, {2} duplicates.".format(
+                            len(report['mismatched']), len(report['missing']),
+                            len(report['duplicates'])))
+    if report['not_done'] and not allow_incomplete:
+        raise Exception("{0} tiles are not downloaded, e.g. {1}".format(
+                            len(report['not_done']), report['not_done'][0]))
+
+    #build next to the output, so a failed merge never leaves half a catalog
+    tmp_path = out_db + '.part'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    merged = TileCatalog(tmp_path)
+    for db_path in shard_dbs:
+        catalog = TileCatalog(db_path)
+        merged.add_rows(catalog.query())
+        catalog.close()
+    merged.set_meta('plan', report['plan'])
+    merged.set_meta('step_range', [0, report['plan']['max_tiles']])
+    merged.close()
+    os.rename(tmp_path, out_db)
+    return report
+
+
+def add_arguments(ap):
+    """Add the command line arguments of this script to an ArgumentParser."""
+    ap.add_argument('shards', nargs='+', help="Shard catalogs to merge.")
+    ap.add_argument('-o', '--outpath', help="Merged catalog to write. Without it, only check coverage.")
+    ap.add_argument('--allow-incomplete', action='store_true',
+                    help="Merge even if some tiles failed to download.")
+
+
+def main(args):
+    """Check and merge shard catalogs with parsed command line arguments, see add_arguments."""
+    report = check_coverage(args.shards)
+    print json.dumps(dict((key, report[key]) for key in
+                          ['plan', 'shards', 'tiles', 'valid', 'mismatched',
+                           'missing', 'duplicates']))
+    if report['not_done']:
+        print "{0} tiles not downloaded, e.g. {1}".format(
+                len(report['not_done']), report['not_done'][0])
+    if not report['valid']:
+        sys.exit(1)
+    if report['not_done'] and args.outpath and not args.allow_incomplete:
+        print "Not merging: rerun the shards to retry them, or pass --allow-incomplete."
+        sys.exit(1)
+    if args.outpath:
+        merge_shards(args.shards, args.outpath,
+                     allow_incomplete = args.allow_incomplete)
+        print "Merged {0} tiles into {1}".format(report['tiles'], args.outpath)
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    add_arguments(ap)
+    main(ap.parse_args())
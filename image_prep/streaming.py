@@ -0,0 +1,44 @@
+import Queue
+import sys
+import threading
+
+_DONE = object()
+
+
+def prefetch(iterable, max_queued = 2):
+    """
+    Run an iterable in a background thread, max_queued items ahead of the
+    consumer. The bounded queue gives backpressure: the producer blocks once
+    max_queued items are waiting. Exceptions in the producer are re-raised
+    in the consumer.
+
+    INPUT:
+    iterable: (iterable) e.g. a generator that does disk or network IO.
+    max_queued: (int) Number of items to read ahead.
+
+    OUTPUT:
+    (generator) of the items of iterable, in order.
+    """
+    item_queue = Queue.Queue(maxsize = max(max_queued, 1))
+
+    def _producer():
+        try:
+            for item in iterable:
+                item_queue.put(item)
+        except Exception:
+            item_queue.put((_DONE, sys.exc_info()))
+            return
+        item_queue.put((_DONE, None))
+
+    thread = threading.Thread(target = _producer)
+    thread.daemon = True
+    thread.start()
+
+    while True:
+        item = item_queue.get()
+        if isinstance(item, tuple) and (len(item) == 2) and (item[0] is _DONE):
+            if item[1] is not None:
+                exc_type, exc_value, exc_tb = item[1]
+                raise exc_type, exc_value, exc_tb
+            return
+        yield item
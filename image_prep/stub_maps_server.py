@@ -0,0 +1,132 @@
+"""
+Local stand-in for the Google static maps API, for tests and dry runs of
+the collectors (see their api_url / --api-url).
+
+Each call gets a PNG of plain ground at the requested center, zoom, size and
+scale, with a blue disc (a "pool", about 10 pixels across at zoom 18
+scale 2) at every lat/lng in pools. Given failures, the first calls for
+some centers get an HTTP 500.
+
+example usage:
+python stub_maps_server.py 8765 --pools 36.15 -115.15 36.16 -115.12
+python google_satellite_images.py 36.15 -115.15 -n 25 -o tiles --api-url http://127.0.0.1:8765/staticmap?
+"""
+import argparse
+import BaseHTTPServer
+from cStringIO import StringIO
+import numpy as np
+import SocketServer
+import threading
+import urlparse
+from PIL import Image
+from web_mercator import latlng2pix
+
+GROUND_RGB = [120, 110, 90]
+POOL_RGB = [40, 150, 220]
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class StubMapsServer(object):
+    """
+    Threaded HTTP server rendering stub map tiles. Counts the calls it gets,
+    per center, in calls.
+    """
+
+    def __init__(self, pools = None, failures = None, port = 0):
+        """
+        INPUT:
+        pools: (list of pairs of floats) lat, lng of the pools to draw.
+        failures: (dict) maps a center, as in the url ('lat,lng'), to the
+                  number of calls for it that fail with a 500 before one
+                  succeeds. float('inf') to always fail.
+        port: (int) port to listen on, 0 for any free port.
+        """
+        self.pools = np.array(pools if pools else [], dtype = np.float64).reshape(-1, 2)
+        self.failures = dict(failures or {})
+        self.calls = {}
+        self.lock = threading.Lock()
+        stub = self
+
+        class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            def do_GET(self):
+                stub._respond(self)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = _Server(('127.0.0.1', port), _Handler)
+        self.thread = None
+
+    @property
+    def url(self):
+        """(str) base url to pass as api_url."""
+        return 'http://127.0.0.1:{0}/staticmap?'.format(self.server.server_address[1])
+
+    def start(self):
+        self.thread = threading.Thread(target = self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def total_calls(self):
+        with self.lock:
+            return sum(self.calls.values())
+
+    def render(self, lat, lng, zoom, size, scale):
+        """(array) uint8 RGB tile of side size * scale centered on lat, lng."""
+        dim = size * scale
+        img_arr = np.empty((dim, dim, 3), dtype = np.uint8)
+        img_arr[:] = GROUND_RGB
+        if len(self.pools):
+            eff_zoom = zoom + np.log2(scale)
+            pix_x, pix_y = latlng2pix(self.pools[:, 0], self.pools[:, 1], lat,
+                                      lng, eff_zoom, dim)
+            radius = max(5.0 * 2 ** (eff_zoom - 19), 1.5)
+            rows, cols = np.mgrid[0:dim, 0:dim]
+            for x, y in zip(pix_x, pix_y):
+                img_arr[(rows - y) ** 2 + (cols - x) ** 2 <= radius ** 2] = POOL_RGB
+        return img_arr
+
+    def _respond(self, handler):
+        params = urlparse.parse_qs(urlparse.urlparse(handler.path).query)
+        center = params['center'][0]
+        with self.lock:
+            self.calls[center] = self.calls.get(center, 0) + 1
+            failed = self.calls[center] <= self.failures.get(center, 0)
+        if failed:
+            handler.send_response(500)
+            handler.end_headers()
+            return
+
+        lat, lng = [float(part) for part in center.split(',')]
+        img_arr = self.render(lat, lng, int(params['zoom'][0]),
+                              int(params['size'][0].split('x')[0]),
+                              int(params['scale'][0]))
+        buf = StringIO()
+        Image.fromarray(img_arr).save(buf, 'PNG')
+        content = buf.getvalue()
+        handler.send_response(200)
+        handler.send_header('Content-Type', 'image/png')
+        handler.send_header('Content-Length', str(len(content)))
+        handler.end_headers()
+        handler.wfile.write(content)
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument('port', type=int, help="Port to listen on.")
+    ap.add_argument('--pools', type=float, nargs='+', default=[],
+                    help="lat lng pairs of pools to draw.")
+
+    args = ap.parse_args()
+    stub = StubMapsServer(zip(args.pools[::2], args.pools[1::2]), port = args.port)
+    print "Serving stub tiles at {0}".format(stub.url)
+    stub.server.serve_forever()
@@ -0,0 +1,242 @@
+"""
+Minimal local stand-in for S3, for tests of s3_upload.py: bucket listings,
+PUT/GET/HEAD of objects with their metadata, and multipart uploads (with
+S3's md5-of-part-md5s ETags). Everything is kept in memory and any bucket
+name works. Requests aren't authenticated.
+
+Chosen part numbers can be made to fail, to test aborting uploads.
+
+example usage:
+python stub_s3_server.py 8766
+python s3_upload.py tiles/dir -b my-bucket --host 127.0.0.1 --port 8766 --insecure
+"""
+import argparse
+import BaseHTTPServer
+from cgi import escape
+import hashlib
+import SocketServer
+import threading
+import time
+import urlparse
+import uuid
+
+_XML = '<?xml version="1.0" encoding="UTF-8"?>'
+_DATE = '2020-01-01T00:00:00.000Z'
+
+
+class _Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class StubS3Server(object):
+    """
+    Threaded HTTP server holding objects in memory. objects maps (bucket,
+    key) to {'data', 'etag', 'meta'}, uploads holds the multipart uploads in
+    progress, aborted the ids of cancelled ones, and stats counts 'puts',
+    'parts' and the most part/object PUTs handled at once, 'max_active'.
+    """
+
+    def __init__(self, fail_parts = None, put_delay = 0.0, port = 0):
+        """
+        INPUT:
+        fail_parts: (set of ints) part numbers whose upload fails (403).
+        put_delay: (float) seconds each PUT takes, to see them overlap.
+        port: (int) port to listen on, 0 for any free port.
+        """
+        self.fail_parts = set(fail_parts or [])
+        self.put_delay = put_delay
+        self.objects = {}
+        self.uploads = {}
+        self.aborted = []
+        self.stats = {'puts': 0, 'parts': 0, 'active': 0, 'max_active': 0}
+        self.lock = threading.Lock()
+        stub = self
+
+        class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                stub._get(self)
+
+            def do_HEAD(self):
+                stub._get(self, head = True)
+
+            def do_PUT(self):
+                stub._put(self)
+
+            def do_POST(self):
+                stub._post(self)
+
+            def do_DELETE(self):
+                stub._delete(self)
+
+            def log_message(self, *args):
+                pass
+
+        self.server = _Server(('127.0.0.1', port), _Handler)
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target = self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    @staticmethod
+    def multipart_etag(parts):
+        """(str) ETag of an object uploaded in parts (list of str)."""
+        digests = ''.join(hashlib.md5(part).digest() for part in parts)
+        return '{0}-{1}'.format(hashlib.md5(digests).hexdigest(), len(parts))
+
+    def _send(self, handler, code, body = '', headers = None, head = False):
+        handler.send_response(code)
+        for name, value in (headers or {}).items():
+            handler.send_header(name, value)
+        handler.send_header('Content-Length', str(len(body)))
+        handler.end_headers()
+        if not head:
+            handler.wfile.write(body)
+
+    def _parse(self, handler):
+        url = urlparse.urlparse(handler.path)
+        parts = url.path.lstrip('/').split('/', 1)
+        key = urlparse.unquote(parts[1]) if len(parts) > 1 else ''
+        return parts[0], key, urlparse.parse_qs(url.query, keep_blank_values = True)
+
+    def _body(self, handler):
+        return handler.rfile.read(int(handler.headers.get('Content-Length', 0)))
+
+    def _get(self, handler, head = False):
+        bucket, key, query = self._parse(handler)
+        if not key:
+            prefix = query.get('prefix', [''])[0]
+            with self.lock:
+                items = sorted((name, obj) for (obj_bucket, name), obj in
+                               self.objects.items()
+                               if obj_bucket == bucket and name.startswith(prefix))
+            contents = ''.join(
+                '<Contents><Key>{0}</Key><LastModified>{1}</LastModified>'
+                '<ETag>&quot;{2}&quot;</ETag><Size>{3}</Size>'
+                '<StorageClass>STANDARD</StorageClass></Contents>'.format(
+                    escape(name), _DATE, obj['etag'], len(obj['data']))
+                for name, obj in items)
+            body = ('{0}<ListBucketResult><Name>{1}</Name><Prefix>{2}</Prefix>'
+                    '<IsTruncated>false</IsTruncated>{3}</ListBucketResult>').format(
+                        _XML, bucket, escape(prefix), contents)
+            return self._send(handler, 200, body, {'Content-Type': 'application/xml'})
+        if 'uploadId' in query:
+            #ListParts, used by boto to complete an upload
+            upload_id = query['uploadId'][0]
+            with self.lock:
+                parts = sorted(self.uploads[upload_id]['parts'].items())
+            contents = ''.join(
+                '<Part><PartNumber>{0}</PartNumber><LastModified>{1}</LastModified>'
+                '<ETag>"{2}"</ETag><Size>{3}</Size></Part>'.format(
+                    part_num, _DATE, hashlib.md5(data).hexdigest(), len(data))
+                for part_num, data in parts)
+            body = ('{0}<ListPartsResult><Bucket>{1}</Bucket><Key>{2}</Key>'
+                    '<UploadId>{3}</UploadId><IsTruncated>false</IsTruncated>'
+                    '{4}</ListPartsResult>').format(_XML, bucket, escape(key),
+                                                    upload_id, contents)
+            return self._send(handler, 200, body)
+
+        with self.lock:
+            obj = self.objects.get((bucket, key))
+        if obj is None:
+            return self._send(handler, 404, '' if head else
+                              '<Error><Code>NoSuchKey</Code></Error>', head = head)
+        headers = {'ETag': '"{0}"'.format(obj['etag']),
+                   'Last-Modified': 'Wed, 01 Jan 2020 00:00:00 GMT'}
+        headers.update(obj['meta'])
+        if head:
+            handler.send_response(200)
+            for name, value in headers.items():
+                handler.send_header(name, value)
+            handler.send_header('Content-Length', str(len(obj['data'])))
+            handler.end_headers()
+            return
+        self._send(handler, 200, obj['data'], headers)
+
+    def _put(self, handler):
+        bucket, key, query = self._parse(handler)
+        with self.lock:
+            self.stats['active'] += 1
+            self.stats['max_active'] = max(self.stats['max_active'],
+                                           self.stats['active'])
+        data = self._body(handler)
+        time.sleep(self.put_delay)
+        with self.lock:
+            self.stats['active'] -= 1
+
+        if 'uploadId' in query:
+            part_num = int(query['partNumber'][0])
+            if part_num in self.fail_parts:
+                return self._send(handler, 403,
+                                  '<Error><Code>AccessDenied</Code></Error>')
+            with self.lock:
+                self.uploads[query['uploadId'][0]]['parts'][part_num] = data
+                self.stats['parts'] += 1
+        else:
+            meta = dict((name, value) for name, value in handler.headers.items()
+                        if name.lower().startswith('x-amz-meta-'))
+            with self.lock:
+                self.objects[(bucket, key)] = {'data': data, 'meta': meta,
+                                               'etag': hashlib.md5(data).hexdigest()}
+                self.stats['puts'] += 1
+        self._send(handler, 200, '', {'ETag': '"{0}"'.format(hashlib.md5(data).hexdigest())})
+
+    def _post(self, handler):
+        bucket, key, query = self._parse(handler)
+        self._body(handler)
+        if 'uploads' in query:
+            upload_id = uuid.uuid4().hex
+            meta = dict((name, value) for name, value in handler.headers.items()
+                        if name.lower().startswith('x-amz-meta-'))
+            with self.lock:
+                self.uploads[upload_id] = {'parts': {}, 'meta': meta}
+            body = ('{0}<InitiateMultipartUploadResult><Bucket>{1}</Bucket>'
+                    '<Key>{2}</Key><UploadId>{3}</UploadId>'
+                    '</InitiateMultipartUploadResult>').format(_XML, bucket,
+                                                               escape(key), upload_id)
+            return self._send(handler, 200, body)
+
+        with self.lock:
+            upload = self.uploads.pop(query['uploadId'][0])
+            parts = [upload['parts'][part_num] for part_num in sorted(upload['parts'])]
+            etag = self.multipart_etag(parts)
+            self.objects[(bucket, key)] = {'data': ''.join(parts), 'etag': etag,
+                                           'meta': upload['meta']}
+        body = ('{0}<CompleteMultipartUploadResult><Bucket>{1}</Bucket>'
+                '<Key>{2}</Key><ETag>"{3}"</ETag>'
+                '</CompleteMultipartUploadResult>').format(_XML, bucket,
+                                                           escape(key), etag)
+        self._send(handler, 200, body)
+
+    def _delete(self, handler):
+        bucket, key, query = self._parse(handler)
+        with self.lock:
+            if 'uploadId' in query:
+                upload_id = query['uploadId'][0]
+                self.uploads.pop(upload_id, None)
+                self.aborted.append(upload_id)
+            else:
+                self.objects.pop((bucket, key), None)
+        self._send(handler, 204)
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument('port', type=int, help="Port to listen on.")
+
+    args = ap.parse_args()
+    stub = StubS3Server(port = args.port)
+    print "Serving a stub S3 at 127.0.0.1:{0}".format(stub.port)
+    stub.server.serve_forever()
@@ -0,0 +1,95 @@
+"""
+Tests of SatImageCollector.get_images against a local stub of the maps API
+(stub_maps_server.py): retries, failing tiles and resuming.
+
+python -m unittest discover -s image_prep -p 'test_*.py'
+"""
+import glob
+import hashlib
+import os
+import shutil
+import tempfile
+import unittest
+import urlparse
+from google_satellite_images import SatImageCollector
+from image_io import read_rgb
+from stub_maps_server import StubMapsServer
+from tile_catalog import TileCatalog
+
+
+def _center(url):
+    return urlparse.parse_qs(urlparse.urlparse(url).query)['center'][0]
+
+
+class TestGetImages(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.stub = StubMapsServer().start()
+        self.collector = SatImageCollector(36.17, -115.14, max_tiles = 9,
+                                           zoom = 17, image_size = 64,
+                                           save_dir = self.tmp_dir,
+                                           api_url = self.stub.url)
+        self.collector.setup_calls()
+        #tile 2 fails once then succeeds, tile 5 always fails
+        self.flaky, self.broken = self.collector.image_info[2], self.collector.image_info[5]
+        self.stub.failures = {_center(self.flaky[1]): 1,
+                              _center(self.broken[1]): float('inf')}
+        self.catalog = TileCatalog(os.path.join(self.tmp_dir, 'tiles.db'))
+
+    def tearDown(self):
+        self.stub.stop()
+        self.catalog.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def _get_images(self):
+        return self.collector.get_images(verbose = False, workers = 3,
+                                         retries = 2, backoff = 0.01,
+                                         catalog = self.catalog)
+
+    def test_retries_and_failures(self):
+        stats = self._get_images()
+        self.assertEqual(stats['requested'], 9)
+        self.assertEqual(stats['skipped'], 0)
+        self.assertEqual(stats['downloaded'], 8)
+        self.assertEqual([fname for fname, _ in stats['failed']], [self.broken[0]])
+        self.assertEqual(self.stub.calls[_center(self.flaky[1])], 2)
+        self.assertEqual(self.stub.calls[_center(self.broken[1])], 3)
+
+        #every tile but the broken one is saved whole, under its final name
+        saved = sorted(os.path.basename(path) for path in
+                       glob.glob(os.path.join(self.tmp_dir, '*.png')))
+        expected = sorted(fname for fname, _ in self.collector.image_info
+                          if fname != self.broken[0])
+        self.assertEqual(saved, expected)
+        self.assertEqual(glob.glob(os.path.join(self.tmp_dir, '*.part')), [])
+        for fname in saved:
+            path = os.path.join(self.tmp_dir, fname)
+            self.assertEqual(read_rgb(path).shape, (128, 128, 3))
+            with open(path, 'rb') as fin:
+                checksum = hashlib.md5(fin.read()).hexdigest()
+            self.assertEqual(self.catalog.get(fname)['checksum'], checksum)
+        self.assertEqual(self.catalog.get(self.broken[0])['status'], 'failed')
+
+    def test_resume(self):
+        self._get_images()
+        self.stub.failures = {}
+        calls = self.stub.total_calls()
+        stats = self._get_images()
+        self.assertEqual(stats['skipped'], 8)
+        self.assertEqual(stats['downloaded'], 1)
+        self.assertEqual(stats['failed'], [])
+        self.assertEqual(self.stub.total_calls(), calls + 1)
+
+    def test_partial_file_is_replaced(self):
+        #a .part left by an interrupted run is neither saved nor skipped
+        path = os.path.join(self.tmp_dir, self.flaky[0])
+        with open(path + '.part', 'wb') as fout:
+            fout.write('truncated')
+        self.collector.get_images(verbose = False, retries = 2, backoff = 0.01)
+        self.assertFalse(os.path.exists(path + '.part'))
+        self.assertEqual(read_rgb(path).shape, (128, 128, 3))
+
+
+if __name__ == '__main__':
+    unittest.main()
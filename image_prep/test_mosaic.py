@@ -0,0 +1,60 @@
+"""
+Tests for mosaic.py windows at the mosaic edges.
+
+python -m unittest discover -s image_prep -p 'test_*.py'
+"""
+import numpy as np
+import os
+import shutil
+import tempfile
+import unittest
+from image_io import write_rgb
+from mosaic import TileMosaic
+
+
+class TestMosaicRead(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        rng = np.random.RandomState(0)
+        tile_paths = []
+        for xstep in [0, 1]:
+            for ystep in [0, 1]:
+                fname = 'img{0}_{1}_36.17_-115.14_zoom18.png'.format(xstep, ystep)
+                path = os.path.join(self.tmp_dir, fname)
+                write_rgb(path, rng.randint(0, 256, (8, 8, 3)).astype(np.uint8))
+                tile_paths.append(path)
+        self.mosaic = TileMosaic.build(os.path.join(self.tmp_dir, 'mosaic'),
+                                       tile_paths, 6, verbose = False)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_inside(self):
+        window = self.mosaic.read(2, 3, 5, 4)
+        np.testing.assert_array_equal(window, self.mosaic.pixels[2:7, 3:7])
+
+    def test_crosses_top_left_corner(self):
+        #only the part of the window inside the mosaic is returned
+        window = self.mosaic.read(-3, -2, 5, 6)
+        np.testing.assert_array_equal(window, self.mosaic.pixels[0:2, 0:4])
+
+    def test_crosses_bottom_right_corner(self):
+        rows, cols = self.mosaic.pixels.shape[:2]
+        window = self.mosaic.read(rows - 2, cols - 3, 5, 6)
+        np.testing.assert_array_equal(window, self.mosaic.pixels[rows - 2:, cols - 3:])
+
+    def test_outside(self):
+        self.assertEqual(self.mosaic.read(-10, 0, 5, 5).shape[0], 0)
+
+    def test_latlng_box_past_top_left(self):
+        #pixel box cols -4.5 to 3.5, rows -4.5 to 4.5: read_latlng covers
+        #rows -5 to 5 and cols -5 to 4, of which rows 0-5, cols 0-4 exist
+        min_lat, min_lng = self.mosaic.pix2latlng(-4.5, 4.5)
+        max_lat, max_lng = self.mosaic.pix2latlng(3.5, -4.5)
+        window = self.mosaic.read_latlng(min_lat, min_lng, max_lat, max_lng)
+        np.testing.assert_array_equal(window, self.mosaic.pixels[0:6, 0:5])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,105 @@
+"""
+Tests of quadtree.collect_quadtree against a local stub of the maps API
+(stub_maps_server.py) with a few pools in an otherwise empty region: the
+calls made against a full sweep at the final zoom, the tiles kept, and the
+catalog left behind.
+
+python -m unittest discover -s image_prep -p 'test_*.py'
+"""
+import json
+import numpy as np
+import os
+import shutil
+import tempfile
+import unittest
+from image_io import read_rgb
+from quadtree import collect_quadtree
+from region_plan import bbox_ring, coverage_collector
+from stub_maps_server import POOL_RGB, StubMapsServer
+from tile_catalog import TileCatalog
+from web_mercator import latlng2pix
+
+BBOX = [36.12, -115.18, 36.15, -115.15]
+POOLS = [[36.125, -115.171], [36.1405, -115.1562], [36.1466, -115.1795]]
+
+
+class TestQuadtree(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.stub = StubMapsServer(POOLS).start()
+        self.catalog = TileCatalog(os.path.join(self.tmp_dir, 'tiles.db'))
+
+    def tearDown(self):
+        self.stub.stop()
+        self.catalog.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def _collect(self):
+        coarse, _ = coverage_collector([bbox_ring(BBOX)], zoom = 15,
+                                       image_size = 64, catalog = self.catalog,
+                                       save_dir = self.tmp_dir,
+                                       skip_stored = False,
+                                       api_url = self.stub.url)
+        report = collect_quadtree(coarse, levels = 2, threshold = 0.005,
+                                  verbose = False, workers = 8,
+                                  catalog = self.catalog, backoff = 0.01)
+        return coarse, report
+
+    def test_calls_saved(self):
+        coarse, report = self._collect()
+        n_coarse = len(coarse.image_info)
+        self.assertEqual(report['full_sweep_calls'], n_coarse * 16)
+        self.assertEqual(report['calls'], self.stub.total_calls())
+        self.assertEqual(report['calls'], report['tiles'])
+        self.assertLess(report['calls'], report['full_sweep_calls'] / 4)
+        self.assertEqual(report['calls_saved'],
+                         report['full_sweep_calls'] - report['calls'])
+
+        #every final tile holds a pool, and every pool is in a final tile
+        final = self.catalog.query(zoom = 18)
+        self.assertEqual(len(final), report['levels'][-1]['requested'])
+        found = set()
+        for tile in final:
+            img_arr = read_rgb(tile['path'])
+            self.assertTrue((img_arr == POOL_RGB).all(axis = 2).any(), tile['fname'])
+            pix_x, pix_y = latlng2pix(np.array(POOLS)[:, 0], np.array(POOLS)[:, 1],
+                                      tile['lat'], tile['lng'], 18, img_arr.shape[0])
+            found.update(np.flatnonzero((pix_x >= 0) & (pix_x < img_arr.shape[1]) &
+                                        (pix_y >= 0) & (pix_y < img_arr.shape[0])))
+        self.assertEqual(found, set(range(len(POOLS))))
+
+    def test_catalog_levels(self):
+        coarse, report = self._collect()
+        n_coarse = len(coarse.image_info)
+        #the coarse plan is left as is, refinement levels get their own keys
+        self.assertEqual(self.catalog.get_meta('plan'),
+                         json.loads(json.dumps(coarse.plan())))
+        self.assertEqual(self.catalog.get_meta('step_range'), [0, n_coarse])
+        coarse_rows = self.catalog.query(step_range = [0, n_coarse])
+        self.assertEqual(set(row['zoom'] for row in coarse_rows), set([16]))
+        self.assertEqual(len(coarse_rows), n_coarse)
+
+        step_idxs = [row['step_idx'] for row in self.catalog.query()]
+        self.assertEqual(len(step_idxs), len(set(step_idxs)))
+        for level, zoom in [(1, 17), (2, 18)]:
+            prefix = 'quadtree_level{0}_'.format(level)
+            first, last = self.catalog.get_meta(prefix + 'step_range')
+            rows = self.catalog.query(step_range = [first, last])
+            self.assertEqual(set(row['zoom'] for row in rows), set([zoom]))
+            self.assertEqual(len(rows), report['levels'][level]['requested'])
+            self.assertEqual(self.catalog.get_meta(prefix + 'plan')['zoom'], zoom - 1)
+
+    def test_resume(self):
+        _, first = self._collect()
+        rows = dict((row['fname'], row['step_idx']) for row in self.catalog.query())
+        _, report = self._collect()
+        self.assertEqual(report['calls'], 0)
+        self.assertEqual(report['tiles'], first['tiles'])
+        self.assertEqual(report['calls_saved'], report['full_sweep_calls'])
+        self.assertEqual(dict((row['fname'], row['step_idx'])
+                              for row in self.catalog.query()), rows)
+
+
+if __name__ == '__main__':
+    unittest.main()
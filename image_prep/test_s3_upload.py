@@ -0,0 +1,164 @@
+"""
+Tests of s3_upload.py against a local stand-in for S3 (stub_s3_server.py):
+single and multipart uploads, skipping unchanged files and archives, and
+aborting a multipart upload when one of its parts fails.
+
+python -m unittest discover -s image_prep -p 'test_*.py'
+"""
+import functools
+import os
+import shutil
+import tarfile
+import tempfile
+import unittest
+from cStringIO import StringIO
+from s3_upload import connect_s3, file_etag, upload_archive, upload_dir, upload_file
+from stub_s3_server import StubS3Server
+
+BUCKET = 'tiles-bucket'
+PART_SIZE = 64 * 1024
+
+
+def _write(path, nbytes, seed = 0):
+    """Write nbytes of data that differs from part to part."""
+    with open(path, 'wb') as fout:
+        fout.write(''.join(chr((i * 7 + seed) % 251) for i in xrange(nbytes)))
+
+
+class TestS3Upload(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.root = os.path.join(self.tmp_dir, 'tiles')
+        os.makedirs(os.path.join(self.root, 'sub'))
+        self.small = os.path.join(self.root, 'small.png')
+        self.large = os.path.join(self.root, 'sub', 'large.bin')
+        _write(self.small, 1000)
+        _write(self.large, int(PART_SIZE * 3.5), seed = 3)
+
+        self.env = dict((name, os.environ.get(name)) for name in
+                        ['AWS_ACCESS_KEY_ID', 'AWS_SECRET_ACCESS_KEY'])
+        os.environ['AWS_ACCESS_KEY_ID'] = 'test-key'
+        os.environ['AWS_SECRET_ACCESS_KEY'] = 'test-secret'
+        self.stub = StubS3Server(put_delay = 0.05).start()
+        self.connect = functools.partial(connect_s3, host = '127.0.0.1',
+                                         port = self.stub.port, is_secure = False)
+
+    def tearDown(self):
+        self.stub.stop()
+        for name, value in self.env.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+        shutil.rmtree(self.tmp_dir)
+
+    def _upload_dir(self):
+        return upload_dir(self.connect, BUCKET, self.root, prefix = 'tiles/',
+                          workers = 4, part_size = PART_SIZE, verbose = False)
+
+    def _stored(self, key_name):
+        return self.stub.objects.get((BUCKET, key_name))
+
+    def test_single_put(self):
+        nbytes = upload_file(self.connect, BUCKET, self.small, 'one/small.png',
+                             part_size = PART_SIZE)
+        self.assertEqual(nbytes, 1000)
+        self.assertEqual(self.stub.stats['puts'], 1)
+        self.assertEqual(self.stub.stats['parts'], 0)
+        with open(self.small, 'rb') as fin:
+            self.assertEqual(self._stored('one/small.png')['data'], fin.read())
+        self.assertEqual(self._stored('one/small.png')['etag'],
+                         file_etag(self.small, PART_SIZE))
+
+    def test_parallel_multipart(self):
+        stats = self._upload_dir()
+        self.assertEqual(stats['uploaded'], 2)
+        self.assertEqual(stats['failed'], [])
+        self.assertEqual(stats['bytes'], 1000 + int(PART_SIZE * 3.5))
+        #the small file in one PUT, the large one in 4 parts sent at once
+        self.assertEqual(self.stub.stats['puts'], 1)
+        self.assertEqual(self.stub.stats['parts'], 4)
+        self.assertGreater(self.stub.stats['max_active'], 1)
+        self.assertEqual(self.stub.uploads, {})
+
+        stored = self._stored('tiles/sub/large.bin')
+        with open(self.large, 'rb') as fin:
+            self.assertEqual(stored['data'], fin.read())
+        #S3's ETag of a multipart upload, md5 of the parts' md5s and '-4'
+        self.assertTrue(stored['etag'].endswith('-4'))
+        self.assertEqual(stored['etag'], file_etag(self.large, PART_SIZE))
+
+    def test_skip_matching(self):
+        self._upload_dir()
+        puts, parts = self.stub.stats['puts'], self.stub.stats['parts']
+        stats = self._upload_dir()
+        self.assertEqual(stats['uploaded'], 0)
+        self.assertEqual(stats['skipped'], 2)
+        self.assertEqual((self.stub.stats['puts'], self.stub.stats['parts']),
+                         (puts, parts))
+
+        #only the file that changed goes up again
+        _write(self.large, int(PART_SIZE * 3.5), seed = 5)
+        stats = self._upload_dir()
+        self.assertEqual(stats['uploaded'], 1)
+        self.assertEqual(stats['skipped'], 1)
+        self.assertEqual(self._stored('tiles/sub/large.bin')['etag'],
+                         file_etag(self.large, PART_SIZE))
+
+    def test_archive(self):
+        stats = upload_archive(self.connect, BUCKET, self.root, 'tiles.tar.gz',
+                               workers = 4, part_size = PART_SIZE, verbose = False)
+        self.assertEqual(stats['uploaded'], 1)
+        self.assertEqual(stats['failed'], [])
+        stored = self._stored('tiles.tar.gz')
+        self.assertEqual(stats['bytes'], len(stored['data']))
+        tar = tarfile.open(fileobj = StringIO(stored['data']), mode = 'r:gz')
+        with open(self.large, 'rb') as fin:
+            self.assertEqual(tar.extractfile('tiles/sub/large.bin').read(), fin.read())
+        self.assertEqual(sorted(tar.getnames()), ['tiles', 'tiles/small.png',
+                                                  'tiles/sub', 'tiles/sub/large.bin'])
+
+        #skipped while the directory is unchanged
+        puts, parts = self.stub.stats['puts'], self.stub.stats['parts']
+        stats = upload_archive(self.connect, BUCKET, self.root, 'tiles.tar.gz',
+                               part_size = PART_SIZE, verbose = False)
+        self.assertEqual(stats['uploaded'], 0)
+        self.assertEqual(stats['skipped'], 1)
+        self.assertEqual((self.stub.stats['puts'], self.stub.stats['parts']),
+                         (puts, parts))
+
+        _write(os.path.join(self.root, 'new.png'), 10)
+        stats = upload_archive(self.connect, BUCKET, self.root, 'tiles.tar.gz',
+                               part_size = PART_SIZE, verbose = False)
+        self.assertEqual(stats['uploaded'], 1)
+
+    def test_failed_part_aborts(self):
+        self.stub.fail_parts = set([2])
+        stats = self._upload_dir()
+        self.assertEqual(stats['uploaded'], 1)
+        self.assertEqual([path for path, _ in stats['failed']], [self.large])
+        #the multipart upload was cancelled and left no object behind
+        self.assertEqual(len(self.stub.aborted), 1)
+        self.assertEqual(self.stub.uploads, {})
+        self.assertIsNone(self._stored('tiles/sub/large.bin'))
+        self.assertIsNotNone(self._stored('tiles/small.png'))
+
+        self.assertRaises(Exception, upload_file, self.connect, BUCKET,
+                          self.large, 'large.bin', part_size = PART_SIZE)
+        self.assertEqual(len(self.stub.aborted), 2)
+        self.assertIsNone(self._stored('large.bin'))
+
+    def test_failed_archive_part_aborts(self):
+        self.stub.fail_parts = set([1])
+        stats = upload_archive(self.connect, BUCKET, self.root, 'tiles.tar.gz',
+                               part_size = PART_SIZE, verbose = False)
+        self.assertEqual(stats['uploaded'], 0)
+        self.assertEqual([path for path, _ in stats['failed']], [self.root])
+        self.assertEqual(len(self.stub.aborted), 1)
+        self.assertEqual(self.stub.uploads, {})
+        self.assertIsNone(self._stored('tiles.tar.gz'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,75 @@
+"""
+Tests of AnnotationSession driven headlessly, without an OpenCV window:
+the points clicks record, toggling positive/negative, undo and committing.
+
+python -m unittest discover -s image_prep -p 'test_*.py'
+"""
+import numpy as np
+import unittest
+from save_image_annotation import AnnotationSession, halfwin_side
+
+
+class TestAnnotationSession(unittest.TestCase):
+
+    def setUp(self):
+        self.session = AnnotationSession()
+        self.image = np.zeros((200, 200, 3), dtype = np.uint8)
+        self.session.start_image('img0_0_36.17_-115.14_zoom18.png', self.image)
+
+    def test_clicks_and_commit(self):
+        session = self.session
+        session.click(50, 60)
+        self.assertIsNone(session.key('n'))
+        session.click(150, 140)
+        session.click(100, 100)
+        self.assertIsNone(session.key('p'))
+        session.click(30, 170)
+        self.assertEqual(session.key('c'), 'next')
+        self.assertEqual(session.result(),
+                         {'img_file': 'img0_0_36.17_-115.14_zoom18.png',
+                          'positive_points': [(50, 60), (30, 170)],
+                          'negative_points': [(150, 140), (100, 100)]})
+
+    def test_boxes_drawn(self):
+        self.session.click(50, 60)
+        self.assertTrue(self.session.dirty)
+        #green box edge for a positive click, inside left untouched
+        self.assertEqual(list(self.image[60, 50 - halfwin_side]), [0, 255, 0])
+        self.assertEqual(list(self.image[60, 50]), [0, 0, 0])
+        self.session.key('n')
+        self.session.click(150, 140)
+        self.assertEqual(list(self.image[140, 150 - halfwin_side]), [255, 0, 0])
+
+    def test_undo(self):
+        session = self.session
+        session.click(50, 60)
+        session.click(70, 80)
+        session.key('n')
+        session.click(150, 140)
+        #r removes the last point of the current kind only
+        self.assertIsNone(session.key('r'))
+        self.assertEqual(session.neg_points, [])
+        self.assertEqual(list(self.image[140, 150 - halfwin_side]), [255, 255, 255])
+        session.key('r')
+        self.assertEqual(session.neg_points, [])
+        session.key('p')
+        session.key('r')
+        self.assertEqual(session.pos_points, [(50, 60)])
+        self.assertEqual(session.key('q'), 'quit')
+
+    def test_start_image_resets_points(self):
+        self.session.click(50, 60)
+        self.session.key('n')
+        self.session.click(150, 140)
+        self.session.start_image('img1_0_36.17_-115.14_zoom18.png', None)
+        self.assertEqual(self.session.result(),
+                         {'img_file': 'img1_0_36.17_-115.14_zoom18.png',
+                          'positive_points': [], 'negative_points': []})
+        #the kind of click carries over to the next image
+        self.session.click(10, 20)
+        self.assertEqual(self.session.neg_points, [(10, 20)])
+        self.assertIsNone(self.session.key('x'))
+
+
+if __name__ == '__main__':
+    unittest.main()
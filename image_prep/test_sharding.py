@@ -0,0 +1,162 @@
+"""
+Tests of sharded collection: shards run as separate processes of
+google_satellite_images.py against a local stub of the maps API
+(stub_maps_server.py), then are checked and merged by sharding.py.
+
+python -m unittest discover -s image_prep -p 'test_*.py'
+"""
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+import urlparse
+from google_satellite_images import SatImageCollector
+import sharding
+from stub_maps_server import StubMapsServer
+from tile_catalog import TileCatalog
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+LAT, LNG = 36.17, -115.14
+N_TILES = 20
+N_SHARDS = 3
+
+
+def _run_shards(stub_url, outpath, shard_args, extra_args = ()):
+    """Run one google_satellite_images.py process per shard argument list, all at once."""
+    procs = []
+    for args in shard_args:
+        cmd = [sys.executable, os.path.join(HERE, 'google_satellite_images.py'),
+               str(LAT), str(LNG), '-n', str(N_TILES), '-o', outpath, '-w', '2',
+               '--api-url', stub_url] + list(args) + list(extra_args)
+        procs.append(subprocess.Popen(cmd, stdout = subprocess.PIPE,
+                                      stderr = subprocess.STDOUT))
+    for proc in procs:
+        output = proc.communicate()[0]
+        if proc.returncode != 0:
+            raise Exception("Shard failed: {0}".format(output))
+
+
+class TestSharding(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.tmp_dir = tempfile.mkdtemp()
+        cls.stub = StubMapsServer().start()
+        cls.tiles = os.path.join(cls.tmp_dir, 'tiles')
+        os.makedirs(cls.tiles)
+        _run_shards(cls.stub.url, cls.tiles,
+                    [['--shard', '{0}/{1}'.format(i, N_SHARDS)]
+                     for i in xrange(N_SHARDS)])
+        cls.shard_calls = cls.stub.total_calls()
+        cls.shard_dbs = [os.path.join(cls.tiles, 'shard_{0}_{1}.db'.format(
+                             *sharding.shard_range(N_TILES, i, N_SHARDS)))
+                         for i in xrange(N_SHARDS)]
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.stub.stop()
+        shutil.rmtree(cls.tmp_dir)
+
+    def _extra_shard(self, name, args, extra_args = ()):
+        #a shard collected into its own directory, with its own catalog
+        outpath = os.path.join(self.tmp_dir, name)
+        os.makedirs(outpath)
+        catalog_path = os.path.join(outpath, 'shard.db')
+        _run_shards(self.stub.url, outpath, [args + ['-c', catalog_path]],
+                    extra_args)
+        return catalog_path
+
+    def test_merge(self):
+        #each tile was downloaded once, by one of the shards
+        self.assertEqual(self.shard_calls, N_TILES)
+        out_db = os.path.join(self.tmp_dir, 'merged.db')
+        report = sharding.merge_shards(self.shard_dbs, out_db)
+        self.assertTrue(report['valid'])
+        self.assertEqual(report['tiles'], N_TILES)
+
+        merged = TileCatalog(out_db)
+        rows = merged.query()
+        self.assertEqual([row['step_idx'] for row in rows], range(N_TILES))
+        self.assertEqual(merged.status_counts(), {'done': N_TILES})
+        self.assertEqual(merged.get_meta('step_range'), [0, N_TILES])
+        self.assertEqual(merged.get_meta('plan')['max_tiles'], N_TILES)
+        merged.close()
+
+        #the merged steps are the tiles of the unsharded plan
+        whole = SatImageCollector(LAT, LNG, max_tiles = N_TILES)
+        whole.setup_calls()
+        self.assertEqual([row['fname'] for row in rows],
+                         [fname for fname, _ in whole.image_info])
+        self.assertFalse(os.path.exists(out_db + '.part'))
+
+    def test_gap(self):
+        report = sharding.check_coverage([self.shard_dbs[0], self.shard_dbs[2]])
+        self.assertFalse(report['valid'])
+        self.assertEqual(report['missing'],
+                         [list(sharding.shard_range(N_TILES, 1, N_SHARDS))])
+        out_db = os.path.join(self.tmp_dir, 'gap.db')
+        self.assertRaises(Exception, sharding.merge_shards,
+                          [self.shard_dbs[0], self.shard_dbs[2]], out_db)
+        self.assertFalse(os.path.exists(out_db))
+
+    def test_overlap(self):
+        overlap_db = self._extra_shard('overlap', ['--steps', '5:9'])
+        report = sharding.check_coverage(self.shard_dbs + [overlap_db])
+        self.assertFalse(report['valid'])
+        self.assertEqual([dup['step_idx'] for dup in report['duplicates']],
+                         range(5, 9))
+        self.assertRaises(Exception, sharding.merge_shards,
+                          self.shard_dbs + [overlap_db],
+                          os.path.join(self.tmp_dir, 'overlap.db'))
+
+    def test_mismatched_plan(self):
+        #the same shard of a plan at another zoom
+        other_db = self._extra_shard('other_zoom', ['--shard', '1/3', '-z', '16'])
+        shard_dbs = [self.shard_dbs[0], other_db, self.shard_dbs[2]]
+        report = sharding.check_coverage(shard_dbs)
+        self.assertFalse(report['valid'])
+        self.assertEqual(report['mismatched'], [other_db])
+        self.assertRaises(Exception, sharding.merge_shards, shard_dbs,
+                          os.path.join(self.tmp_dir, 'mismatched.db'))
+
+    def test_incomplete(self):
+        #one tile of shard 1 always fails
+        first, _ = sharding.shard_range(N_TILES, 1, N_SHARDS)
+        whole = SatImageCollector(LAT, LNG, max_tiles = N_TILES)
+        whole.setup_calls()
+        fname, url = whole.image_info[first]
+        center = urlparse.parse_qs(urlparse.urlparse(url).query)['center'][0]
+        self.stub.failures = {center: float('inf')}
+        try:
+            failing_db = self._extra_shard('incomplete', ['--shard', '1/3'],
+                                           ['--retries', '0'])
+        finally:
+            self.stub.failures = {}
+        shard_dbs = [self.shard_dbs[0], failing_db, self.shard_dbs[2]]
+
+        report = sharding.check_coverage(shard_dbs)
+        self.assertTrue(report['valid'])
+        self.assertEqual(report['not_done'], [fname])
+        out_db = os.path.join(self.tmp_dir, 'incomplete.db')
+        self.assertRaises(Exception, sharding.merge_shards, shard_dbs, out_db)
+        self.assertFalse(os.path.exists(out_db))
+
+        #the command line refuses too, unless told to allow it
+        cmd = [sys.executable, os.path.join(HERE, 'sharding.py')] + shard_dbs + ['-o', out_db]
+        proc = subprocess.Popen(cmd, stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
+        proc.communicate()
+        self.assertEqual(proc.returncode, 1)
+        self.assertFalse(os.path.exists(out_db))
+        proc = subprocess.Popen(cmd + ['--allow-incomplete'], stdout = subprocess.PIPE,
+                                stderr = subprocess.STDOUT)
+        proc.communicate()
+        self.assertEqual(proc.returncode, 0)
+        merged = TileCatalog(out_db)
+        self.assertEqual(merged.status_counts(), {'done': N_TILES - 1, 'failed': 1})
+        merged.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
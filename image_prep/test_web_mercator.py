@@ -0,0 +1,117 @@
+"""
+Equivalence tests of the vectorized web_mercator.py against the scalar
+projection math SatImageCollector used before it.
+
+python -m unittest discover -s image_prep -p 'test_*.py'
+"""
+import math
+import numpy as np
+import unittest
+from google_satellite_images import SatImageCollector
+from utils import spiral_stepper
+from web_mercator import latlng2pix, pix2latlng, steps2latlng
+
+CENTERS = [(36.1699390347, -115.139826918), (29.7604243716, -95.3698001178),
+           (-33.8688, 151.2093), (64.1466, -21.9426)]
+
+
+def _baseline_pix2latlng(pix_x, pix_y, imcenterlat, imcenterlng, zoom, dim):
+    """Copy of the original SatImageCollector._pix2latlng, one pixel at a time."""
+    center = (dim // 2.0) - 0.5
+
+    scalefact = 128.0 * math.pow(2, zoom) / math.pi
+
+    center_abs_x = scalefact * math.pi * ((imcenterlng / 180.) + 1.)
+    y_term = (math.pi - math.log(math.tan(math.pi * (0.25 + imcenterlat/360.0))))
+    center_abs_y = scalefact * y_term
+
+    abs_pix_x = center_abs_x + (pix_x - center)
+    abs_pix_y = center_abs_y + (pix_y - center)
+
+    exp_term = math.exp(math.pi - (abs_pix_y/scalefact))
+    lat = 180./math.pi * (2. * math.atan(exp_term) - (math.pi/2.0))
+    lng = 180./math.pi * ((abs_pix_x/scalefact) - math.pi)
+
+    return lat, lng
+
+
+def _baseline_setup_calls(collector, image_overlap = 0.1):
+    """Copy of the original SatImageCollector.setup_calls loop."""
+    pixel_step = math.floor((1.0 - image_overlap) * collector.scale * collector.image_size)
+    center_pix = (collector.scale * collector.image_size) / 2.0
+    dim = collector.scale * collector.image_size
+
+    fnames_urls = []
+    fname_template = 'img{0}_{1}_{2}_{3}_zoom{4}.png'
+    maps_url1 = 'http://maps.googleapis.com/maps/api/staticmap?'
+    maps_url2 = 'zoom={0}&size={1}x{1}&scale={2}&maptype=satellite&center={3},{4}'
+    for x_trans, y_trans in spiral_stepper(max_steps = collector.max_tiles,
+                                           step_size = 1):
+        pix_x = center_pix + x_trans * pixel_step
+        pix_y = center_pix + y_trans * pixel_step
+
+        lat1, lng1 = _baseline_pix2latlng(pix_x, pix_y, collector.init_lat,
+                                          collector.init_lng,
+                                          collector.effective_zoom, dim)
+
+        fname = fname_template.format(x_trans, y_trans,
+                        lat1, lng1, int(collector.effective_zoom))
+        url_params = maps_url2.format(collector.zoom, collector.image_size,
+                        collector.scale, lat1, lng1)
+        fnames_urls.append( [fname, maps_url1 + url_params] )
+    return fnames_urls
+
+
+class TestWebMercator(unittest.TestCase):
+
+    def test_steps2latlng_matches_baseline(self):
+        x_steps, y_steps = np.meshgrid(np.arange(-30, 31), np.arange(-30, 31))
+        x_steps, y_steps = x_steps.ravel(), y_steps.ravel()
+        for center_lat, center_lng in CENTERS:
+            for zoom in [12, 16, 17, 18.5, 20]:
+                lats, lngs = steps2latlng(x_steps, y_steps, center_lat,
+                                          center_lng, zoom, 1280, 1152)
+                expected = np.array([_baseline_pix2latlng(
+                                        640.0 + x * 1152, 640.0 + y * 1152,
+                                        center_lat, center_lng, zoom, 1280)
+                                     for x, y in zip(x_steps, y_steps)])
+                np.testing.assert_allclose(lats, expected[:, 0], rtol = 0, atol = 1e-10)
+                np.testing.assert_allclose(lngs, expected[:, 1], rtol = 0, atol = 1e-10)
+
+    def test_pix2latlng_matches_baseline(self):
+        rng = np.random.RandomState(0)
+        pix_x, pix_y = rng.uniform(-2000, 3000, (2, 500))
+        for center_lat, center_lng in CENTERS:
+            for zoom, dim in [(17, 1280), (18, 640), (15.5, 1000)]:
+                lats, lngs = pix2latlng(pix_x, pix_y, center_lat, center_lng,
+                                        zoom, dim)
+                for i in xrange(len(pix_x)):
+                    lat, lng = _baseline_pix2latlng(pix_x[i], pix_y[i],
+                                                    center_lat, center_lng,
+                                                    zoom, dim)
+                    self.assertAlmostEqual(lats[i], lat, places = 10)
+                    self.assertAlmostEqual(lngs[i], lng, places = 10)
+
+    def test_latlng2pix_round_trip(self):
+        rng = np.random.RandomState(1)
+        pix_x, pix_y = rng.uniform(-5000, 6000, (2, 1000))
+        for center_lat, center_lng in CENTERS:
+            for zoom in [10, 17, 21]:
+                lats, lngs = pix2latlng(pix_x, pix_y, center_lat, center_lng,
+                                        zoom, 1280)
+                back_x, back_y = latlng2pix(lats, lngs, center_lat, center_lng,
+                                            zoom, 1280)
+                np.testing.assert_allclose(back_x, pix_x, rtol = 0, atol = 1e-6)
+                np.testing.assert_allclose(back_y, pix_y, rtol = 0, atol = 1e-6)
+
+    def test_setup_calls_matches_baseline(self):
+        for center_lat, center_lng in CENTERS[:2]:
+            collector = SatImageCollector(center_lat, center_lng,
+                                          max_tiles = 2500, zoom = 17)
+            collector.setup_calls(image_overlap = 0.1, chunk_size = 700)
+            self.assertEqual(collector.image_info,
+                             _baseline_setup_calls(collector, 0.1))
+
+
+if __name__ == '__main__':
+    unittest.main()
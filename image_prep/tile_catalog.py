@@ -0,0 +1,235 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from utils import parse_tile_fname
+
+
+class TileCatalog(object):
+    """
+    SQLite backed catalog of the tiles planned and collected by
+    SatImageCollector. One row per tile file records its step, center lat/lng,
+    zoom, url, status ('planned', 'done' or 'failed'), byte size, checksum
+    and timestamps, so a restarted collection run can tell which tiles are
+    left without checking the disk, and later stages can look tiles up
+    without parsing file names.
+
+    Writes are committed as they happen (in WAL mode) so the catalog stays
+    consistent if a run is killed. One catalog object can be shared between
+    threads.
+    """
+
+    def __init__(self, db_path):
+        """
+        INPUT:
+        db_path: (str) Path of the SQLite file. Created if it doesn't exist.
+        """
+        self.db_path = db_path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(db_path, check_same_thread = False)
+        self._conn.row_factory = sqlite3.Row
+        with self._lock:
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS tiles (
+                    fname TEXT PRIMARY KEY,
+                    step_idx INTEGER,
+                    xstep INTEGER,
+                    ystep INTEGER,
+                    lat REAL,
+                    lng REAL,
+                    zoom INTEGER,
+                    url TEXT,
+                    path TEXT,
+                    status TEXT NOT NULL DEFAULT 'planned',
+                    nbytes INTEGER,
+                    checksum TEXT,
+                    error TEXT,
+                    created REAL,
+                    updated REAL);
+                CREATE INDEX IF NOT EXISTS tiles_status ON tiles (status);
+                CREATE INDEX IF NOT EXISTS tiles_step ON tiles (step_idx);
+                CREATE INDEX IF NOT EXISTS tiles_latlng ON tiles (lat, lng);
+                CREATE INDEX IF NOT EXISTS tiles_zoom ON tiles (zoom);
+                CREATE INDEX IF NOT EXISTS tiles_xy ON tiles (xstep, ystep);
+                CREATE TABLE IF NOT EXISTS meta (
+                    key TEXT PRIMARY KEY,
+                    value TEXT);
+                """)
+            self._conn.commit()
+
+
+    def add_planned(self, image_info, save_dir = '', step_offset = 0, 
+                    step_idxs = None):
+        """
+        Record the tiles of a collection plan. Tiles already in the catalog
+        keep their status.
+
+        INPUT:
+        image_info: (list of pairs) [(file name, url)] as built by
+                    SatImageCollector.setup_calls. The list order is stored
+                    as the tile's step index.
+        save_dir: (str) Directory the tiles are saved in.
+        step_offset: (int) Step index of the first tile, when image_info
+                     is one shard of a larger plan.
+        step_idxs: (list of ints) Step index of each tile, instead of the 
+                   list order, e.g. for quadtree.py levels.
+
+        OUTPUT:
+        (int) number of new tiles added.
+        """
+        now = time.time()
+        rows = []
+        if step_idxs is None:
+            step_idxs = xrange(step_offset, step_offset + len(image_info))
+        for step_idx, (fname, url) in zip(step_idxs, image_info):
+            tile = parse_tile_fname(fname)
+            rows.append((fname, step_idx, tile['xstep'], tile['ystep'],
+                         tile['lat'], tile['lng'], tile['zoom'], url,
+                         os.path.join(save_dir, fname), now, now))
+
+        with self._lock:
+            before = self._conn.total_changes
+            self._conn.executemany("""
+                INSERT OR IGNORE INTO tiles
+                (fname, step_idx, xstep, ystep, lat, lng, zoom, url, path,
+                 created, updated)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""", rows)
+            self._conn.commit()
+            return self._conn.total_changes - before
+
+
+    def add_rows(self, rows):
+        """
+        Insert catalog rows (dicts as returned by query) as they are, e.g.
+        rows from another catalog. Rows replace tiles with the same file name.
+        """
+        columns = ['fname', 'step_idx', 'xstep', 'ystep', 'lat', 'lng', 'zoom',
+                   'url', 'path', 'status', 'nbytes', 'checksum', 'error',
+                   'created', 'updated']
+        sql = 'INSERT OR REPLACE INTO tiles ({0}) VALUES ({1})'.format(
+                ', '.join(columns), ', '.join('?' * len(columns)))
+        with self._lock:
+            self._conn.executemany(sql, ([row.get(col) for col in columns]
+                                         for row in rows))
+            self._conn.commit()
+
+
+    def set_meta(self, key, value):
+        """Save a JSON serializable value about the catalog, e.g. its collection plan."""
+        with self._lock:
+            self._conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                                (key, json.dumps(value, sort_keys = True)))
+            self._conn.commit()
+
+
+    def get_meta(self, key, default = None):
+        """Value saved with set_meta, or default if there is none."""
+        with self._lock:
+            row = self._conn.execute('SELECT value FROM meta WHERE key = ?',
+                                        (key,)).fetchone()
+        return json.loads(row[0]) if row is not None else default
+
+
+    def mark_done(self, fname, nbytes, checksum):
+        """Record a tile as saved to disk, with its size and md5 checksum."""
+        self._set_status(fname, 'done', nbytes = nbytes, checksum = checksum)
+
+
+    def mark_failed(self, fname, error):
+        """Record a failed download, with a description of the error."""
+        self._set_status(fname, 'failed', error = error)
+
+
+    def _set_status(self, fname, status, nbytes = None, checksum = None,
+                    error = None):
+        with self._lock:
+            self._conn.execute("""
+                UPDATE tiles SET status = ?, nbytes = ?, checksum = ?,
+                error = ?, updated = ? WHERE fname = ?""",
+                (status, nbytes, checksum, error, time.time(), fname))
+            self._conn.commit()
+
+
+    def done_fnames(self):
+        """(set) of file names of tiles that have been saved."""
+        with self._lock:
+            cur = self._conn.execute(
+                "SELECT fname FROM tiles WHERE status = 'done'")
+            return set(row[0] for row in cur)
+
+
+    def get(self, fname):
+        """(dict) catalog row of a tile, or None if it isn't in the catalog."""
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM tiles WHERE fname = ?",
+                                        (fname,)).fetchone()
+        return dict(row) if row is not None else None
+
+
+    def get_step(self, xstep, ystep, zoom = None):
+        """(dict) catalog row of the tile at a step, or None if there is none."""
+        sql = "SELECT * FROM tiles WHERE xstep = ? AND ystep = ?"
+        params = [xstep, ystep]
+        if zoom is not None:
+            sql += " AND zoom = ?"
+            params.append(zoom)
+        with self._lock:
+            row = self._conn.execute(sql, params).fetchone()
+        return dict(row) if row is not None else None
+
+
+    def query(self, status = None, step_range = None, bbox = None,
+                zoom = None):
+        """
+        Look up tiles, using the catalog indexes.
+
+        INPUT:
+        status: (str) Only tiles with this status.
+        step_range: (pair of ints) Only tiles with step index in
+                    [first, last).
+        bbox: (list of floats) [min_lat, min_lng, max_lat, max_lng] Only
+              tiles centered inside this box.
+        zoom: (int) Only tiles at this zoom level.
+
+        OUTPUT:
+        (list of dicts) catalog rows, ordered by step index.
+        """
+        clauses = []
+        params = []
+        if status is not None:
+            clauses.append('status = ?')
+            params.append(status)
+        if step_range is not None:
+            clauses.append('step_idx >= ? AND step_idx < ?')
+            params.extend(step_range)
+        if bbox is not None:
+            clauses.append('lat BETWEEN ? AND ? AND lng BETWEEN ? AND ?')
+            params.extend([bbox[0], bbox[2], bbox[1], bbox[3]])
+        if zoom is not None:
+            clauses.append('zoom = ?')
+            params.append(zoom)
+
+        sql = 'SELECT * FROM tiles'
+        if clauses:
+            sql += ' WHERE ' + ' AND '.join(clauses)
+        sql += ' ORDER BY step_idx'
+
+        with self._lock:
+            return [dict(row) for row in self._conn.execute(sql, params)]
+
+
+    def status_counts(self):
+        """(dict) number of tiles per status."""
+        with self._lock:
+            cur = self._conn.execute(
+                'SELECT status, COUNT(*) FROM tiles GROUP BY status')
+            return dict((row[0], row[1]) for row in cur)
+
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
@@ -1,10 +1,15 @@
+import math
+import os
+import threading
+import time
+
 
 
 # HELPER FUNCTION
 def spiral_stepper(step_size = 1, max_steps = 1):
     """
     Create a list of integer steps to spiral outward in a square pattern
-    from the origin.
+    from the origin. See SpiralSteps for a lazy version.
 
     INPUT:
     step_size: (int) Could use pixel values for step size, but easier 
@@ -13,63 +18,159 @@ def spiral_stepper(step_size = 1, max_steps = 1):
 
     OUTPUT:
     (list) of tuples of coordinates e.g.: 
-    >>>spiral_stepper(max_steps = 5)
+    >>>spiral_stepper(max_steps = 7)
     >>>[(0, 0), (1, 0), (1, 1), (0, 1), (-1, 1), (-1, 0), (-1, -1)]
     """
-    
-    def _next_spiral_corner(x0=0, y0=0, k=1, accum=[(0,0)], 
-                            max_len=100, step_size=1):
-        """
-        recursive algo idea from:
-        http://stackoverflow.com/questions/3706219/
+    return list(SpiralSteps(max_steps = max_steps, step_size = step_size))
+
+
+def spiral_step(k, step_size = 1):
+    """
+    Coordinates of the k-th step (zero-indexed) of the square spiral walked
+    by SpiralSteps, computed directly without walking the spiral.
+
+    The spiral is made of pairs of legs, the m-th pair moving m steps along
+    x then m steps along y, in the positive direction for odd m and negative
+    for even m. So after m full pairs, i.e. k = m * (m + 1), the walk sits at 
+    the corner (c, c) with c = (m + 1) / 2 for odd m and c = -m / 2 for even m.
+    """
+    if k < 0:
+        raise Exception("Spiral step index must be >= 0, got: {0}".format(k))
+
+    m = _spiral_pair(k)
+    corner = (m + 1) // 2 if (m % 2) == 1 else -(m // 2)
+    remainder = k - m * (m + 1)
+    leg_len = m + 1
+    step_dir = 1 if (leg_len % 2) == 1 else -1
 
-        N = INT((1+k)/2)
-        Sign = | +1 when N is Odd
-               | -1 when N is Even
-        [dx,dy] = | [N*Sign,0]  when k is Odd
-                  | [0,N*Sign]  when k is Even
-        [X(k),Y(k)] = [X(k-1)+dx,Y(k-1)+dy]
+    if remainder <= leg_len:
+        x, y = corner + step_dir * remainder, corner
+    else:
+        x, y = corner + step_dir * leg_len, corner + step_dir * (remainder - leg_len)
 
-        weird recursion issue where sometimes search 
-        gets reset to (1,0) so some points repeated
+    return (x * step_size, y * step_size)
+
+
+def _spiral_pair(k):
+    """
+    Helper for spiral_step. Number of complete leg pairs before step k, 
+    i.e. the largest m with m * (m + 1) <= k.
+    """
+    m = int((math.sqrt(4 * k + 1) - 1) / 2)
+    #correct for float rounding on very large k
+    while m * (m + 1) > k:
+        m -= 1
+    while (m + 1) * (m + 2) <= k:
+        m += 1
+    return m
+
+
+class SpiralSteps(object):
+    """
+    Lazy, re-iterable sequence of integer steps spiraling outward in a square
+    pattern from the origin: (0, 0), (1, 0), (1, 1), (0, 1), (-1, 1), ...
+    Iterating is O(1) per step in constant memory, and steps can be indexed
+    directly, so a run can resume mid-spiral with start = k.
+    """
 
+    def __init__(self, max_steps, step_size = 1, start = 0):
         """
+        INPUT:
+        max_steps: (int) total number of steps in the spiral.
+        step_size: (int) size of each step.
+        start: (int) index of the first step to yield.
+        """
+        self.max_steps = max_steps
+        self.step_size = step_size
+        self.start = min(max(start, 0), max_steps)
+
+    def __len__(self):
+        return self.max_steps - self.start
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("Spiral step index out of range: {0}".format(i))
+        return spiral_step(self.start + i, step_size = self.step_size)
+
+    def __iter__(self):
+        k = self.start
+        if k >= self.max_steps:
+            return
+        x, y = spiral_step(k)
+        m = _spiral_pair(k)
+        remainder = k - m * (m + 1)
+
+        while True:
+            yield (x * self.step_size, y * self.step_size)
+            k += 1
+            if k >= self.max_steps:
+                return
+
+            leg_len = m + 1
+            step_dir = 1 if (leg_len % 2) == 1 else -1
+            if remainder < leg_len:
+                x += step_dir
+            else:
+                y += step_dir
+            remainder += 1
+            if remainder == 2 * leg_len:
+                m += 1
+                remainder = 0
+
+
+def parse_tile_fname(fname):
+    """
+    Parse the metadata out of a tile file name written by SatImageCollector.
+
+    INPUT:
+    fname: (str) e.g. 'img-10_-10_36.2198109_-115.201625_zoom18.png', 
+           optionally with a leading directory path.
+
+    OUTPUT:
+    (dict) with keys: xstep, ystep (ints), lat, lng (floats), zoom (int).
+    """
+    base = os.path.basename(fname)
+    if not (base.startswith('img') and base.endswith('.png')):
+        raise Exception("Not a tile file name: {0}".format(fname))
 
-        if len(accum) >= max_len:
-            return accum
-        num_steps = (k + 1) // 2
+    xstep, ystep, lat, lng, zoom = base[3:-4].split('_')
+    return {'xstep': int(xstep), 'ystep': int(ystep), 
+            'lat': float(lat), 'lng': float(lng), 
+            'zoom': int(zoom.replace('zoom', ''))}
 
 
-        step_dir = -1 if (num_steps % 2) == 0 else 1
-        
-        x_trans, y_trans = (0, step_dir) if (k % 2) == 0 else (step_dir, 0)
+class RateLimiter(object):
+    """
+    Thread-safe limiter that spaces out calls so no more than max_rps happen
+    per second. Call wait() before each request. max_rps of None disables it.
+    """
 
-        for i in xrange(1, num_steps+1):
-            xnext = x0 + (i*step_size*x_trans)
-            ynext = y0 + (i*step_size*y_trans)
-            
-            if (xnext,ynext) in accum:
-                print xnext,ynext, x0, y0, i, x_trans, y_trans,k,len(accum)
-            accum.append((xnext, ynext))
+    def __init__(self, max_rps = None):
+        self.interval = 1.0 / max_rps if max_rps else 0.0
+        self._next_time = 0.0
+        self._lock = threading.Lock()
 
-        if len(set(accum)) < len(accum):
-            #raise Exception('Recursion error, retry')
-            return _next_spiral_corner(x0=0, y0=0, k=1, accum=[(0,0)], 
-                                        max_len=max_len, step_size=step_size)
-        return _next_spiral_corner(x0=accum[-1][0], y0=accum[-1][1], k=k+1, 
-                                    accum=accum, max_len=max_len, 
-                                    step_size=step_size)
+    def wait(self):
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.time()
+            sleep_time = self._next_time - now
+            self._next_time = max(now, self._next_time) + self.interval
+        if sleep_time > 0:
+            time.sleep(sleep_time)
 
-    return _next_spiral_corner(x0=0, y0=0, k=1, accum=[(0,0)], 
-                                max_len=max_steps, step_size=step_size) 
 
-def send2S3(file_path,bucket_name,s3_filename):
+def send2S3(file_path,bucket_name,s3_filename,awspubkey=None,awsseckey=None):
     """
-    run:
-    !tar czf tarball_of_dir.tar.gz dirpath/
+    Upload one file to S3. Large files go up as a parallel multipart upload.
+    Keys default to boto's environment variables/config file.
+    To upload a whole directory (e.g. tiles or an ROI store), without
+    building a tarball first, see s3_upload.py.
     """
-    conn = boto.s3.connection.S3Connection(awspubkey,awsseckey)
-    bucket = conn.get_bucket(bucket_name)
-    k = boto.s3.key.Key(bucket)
-    k.key = s3_filename
-    k.set_contents_from_filename(file_path)
\ No newline at end of file
+    import functools
+    from s3_upload import connect_s3, upload_file
+    connect = functools.partial(connect_s3, awspubkey, awsseckey)
+    upload_file(connect, bucket_name, file_path, s3_filename)
\ No newline at end of file
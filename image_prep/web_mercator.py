@@ -0,0 +1,133 @@
+"""
+Vectorized "Web Mercator" projection math, as used by Google Maps.
+
+World pixel coordinates put the whole earth on a 256 * 2**zoom pixel square,
+with x growing eastward and y growing southward. Image pixel coordinates are
+relative to the upper left corner of a square image of side dim (pixels)
+centered on a known lat/lng. All functions accept scalars or numpy arrays,
+broadcasting against each other, and return float arrays.
+"""
+import numpy as np
+
+
+def _scalefact(zoom):
+    return 128.0 * np.power(2.0, zoom) / np.pi
+
+
+def _image_center(dim):
+    ## Assumes pixel coordinates are centered so center of image
+    ## (with even-numbered dimensions) is 0.5 pix from dim / 2
+    ## with zero-indexing subtract this factor
+    return (np.asarray(dim) // 2.0) - 0.5
+
+
+def latlng2worldpix(lat, lng, zoom):
+    """
+    Convert latitude/longitude to world pixel coordinates at a zoom level.
+
+    INPUT:
+    lat, lng: (float or array) location(s) on earth in decimal degrees.
+    zoom: (float or array) effective zoom level (zoom + log2(scale)).
+
+    OUTPUT:
+    (pair of arrays) world pixel x, y.
+    """
+    lat = np.asarray(lat, dtype=np.float64)
+    lng = np.asarray(lng, dtype=np.float64)
+    scalefact = _scalefact(zoom)
+
+    world_x = scalefact * np.pi * ((lng / 180.) + 1.)
+    y_term = np.pi - np.log(np.tan(np.pi * (0.25 + lat / 360.0)))
+    world_y = scalefact * y_term
+
+    return world_x, world_y
+
+
+def worldpix2latlng(world_x, world_y, zoom):
+    """
+    Inverse of latlng2worldpix.
+
+    INPUT:
+    world_x, world_y: (float or array) world pixel coordinates.
+    zoom: (float or array) effective zoom level.
+
+    OUTPUT:
+    (pair of arrays) lat, lng in decimal degrees.
+    """
+    world_x = np.asarray(world_x, dtype=np.float64)
+    world_y = np.asarray(world_y, dtype=np.float64)
+    scalefact = _scalefact(zoom)
+
+    exp_term = np.exp(np.pi - (world_y / scalefact))
+    lat = 180. / np.pi * (2. * np.arctan(exp_term) - (np.pi / 2.0))
+    lng = 180. / np.pi * ((world_x / scalefact) - np.pi)
+
+    return lat, lng
+
+
+def pix2latlng(pix_x, pix_y, center_lat, center_lng, zoom, dim):
+    """
+    Given x,y pixel locations on Google Map images (with known center lat/lng
+    and zoom level) return the latitudes and longitudes of the pixels.
+
+    INPUT:
+    pix_x, pix_y: (float or array) pixel coordinates in the image.
+    center_lat, center_lng: (float or array) lat/lng of the image center(s).
+    zoom: (float) effective zoom level.
+    dim: (int) pixel side length of the (square) images.
+
+    OUTPUT:
+    (pair of arrays) lat, lng of the pixels.
+    """
+    center_x, center_y = latlng2worldpix(center_lat, center_lng, zoom)
+    center = _image_center(dim)
+
+    world_x = center_x + (np.asarray(pix_x, dtype=np.float64) - center)
+    world_y = center_y + (np.asarray(pix_y, dtype=np.float64) - center)
+
+    return worldpix2latlng(world_x, world_y, zoom)
+
+
+def latlng2pix(lat, lng, center_lat, center_lng, zoom, dim):
+    """
+    Inverse of pix2latlng: pixel location of lat/lng points on an image with
+    a known center lat/lng. Points off the image give out of range pixels.
+
+    INPUT:
+    lat, lng: (float or array) locations in decimal degrees.
+    center_lat, center_lng: (float or array) lat/lng of the image center(s).
+    zoom: (float) effective zoom level.
+    dim: (int) pixel side length of the (square) images.
+
+    OUTPUT:
+    (pair of arrays) pixel x, y (floats, not rounded).
+    """
+    world_x, world_y = latlng2worldpix(lat, lng, zoom)
+    center_x, center_y = latlng2worldpix(center_lat, center_lng, zoom)
+    center = _image_center(dim)
+
+    return world_x - center_x + center, world_y - center_y + center
+
+
+def steps2latlng(x_steps, y_steps, center_lat, center_lng, zoom, dim,
+                    pixel_step):
+    """
+    Centers of the tiles translated by integer steps of pixel_step pixels
+    from the tile centered at center_lat/center_lng. This is the grid
+    SatImageCollector.setup_calls walks.
+
+    INPUT:
+    x_steps, y_steps: (int or array) tile steps. Positive y is southward.
+    center_lat, center_lng: (float) lat/lng of the (0, 0) tile center.
+    zoom: (float) effective zoom level.
+    dim: (int) pixel side length of the tiles.
+    pixel_step: (int) pixels between adjacent tile centers.
+
+    OUTPUT:
+    (pair of arrays) lat, lng of the tile centers.
+    """
+    center_pix = dim / 2.0
+    pix_x = center_pix + np.asarray(x_steps) * pixel_step
+    pix_y = center_pix + np.asarray(y_steps) * pixel_step
+
+    return pix2latlng(pix_x, pix_y, center_lat, center_lng, zoom, dim)
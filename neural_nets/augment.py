@@ -0,0 +1,123 @@
+"""
+Random augmentation of bc01 mini-batches for training on overhead imagery,
+which has no canonical orientation: flips and 90 degree rotations (the 8
+symmetries of the square), small shifts and color jitter. Each transform is
+applied to the whole batch in a few vectorized numpy operations, and the
+augmented copies only live as long as the batch.
+
+Use through PrefetchBatchIterator(..., augment = BatchAugmenter()) in
+nolearn.py, on the training iterator only.
+"""
+import numpy as np
+
+
+class BatchAugmenter(object):
+    """
+    Callable that returns a randomly augmented copy of a fp32 bc01 batch
+    (samples x colors x rows x cols). Draws come from its own RandomState,
+    so a given seed and sequence of batch shapes always gives the same
+    augmentations.
+    """
+
+    def __init__(self, flips = True, rotations = True, max_shift = 3,
+                    brightness = 0.1, contrast = 0.1, channel_gain = 0.05,
+                    seed = 42):
+        """
+        INPUT:
+        flips: (bool) random horizontal/vertical flips.
+        rotations: (bool) random rotations by multiples of 90 degrees (180
+                   only, for non square ROIs).
+        max_shift: (int) largest shift in pixels, along rows and columns
+                   independently. Edges are filled by reflection.
+        brightness: (float) samples are scaled by a factor in
+                    1 +/- brightness.
+        contrast: (float) deviations from each sample's mean are scaled by
+                  a factor in 1 +/- contrast.
+        channel_gain: (float) each color channel is scaled by a factor in
+                      1 +/- channel_gain.
+        seed: (int) seed of the random draws.
+
+        The color jitter is multiplicative, so it works for pixels in any
+        scale (0-255 or 0-1), as long as it comes before normalization.
+        """
+        self.flips = flips
+        self.rotations = rotations
+        self.max_shift = max_shift
+        self.brightness = brightness
+        self.contrast = contrast
+        self.channel_gain = channel_gain
+        self.rng = np.random.RandomState(seed)
+
+
+    def __call__(self, Xb):
+        Xb = np.asarray(Xb, dtype = np.float32)
+        n_samples, channels = Xb.shape[:2]
+        rng = self.rng
+        #draw everything up front, so the draws don't depend on the data
+        orient = self._draw_orientations(n_samples, Xb.shape[2] == Xb.shape[3])
+        shifts = rng.randint(-self.max_shift, self.max_shift + 1,
+                                size = (2, n_samples))
+        gain = (1.0 + rng.uniform(-self.brightness, self.brightness,
+                                    size = (n_samples, 1, 1, 1)) +
+                rng.uniform(-self.channel_gain, self.channel_gain,
+                            size = (n_samples, channels, 1, 1)))
+        contrast = 1.0 + rng.uniform(-self.contrast, self.contrast,
+                                        size = (n_samples, 1, 1, 1))
+
+        Xb = orient_batch(Xb, orient)
+        if self.max_shift > 0:
+            Xb = shift_batch(Xb, shifts[0], shifts[1], self.max_shift)
+
+        means = Xb.mean(axis = (1, 2, 3), keepdims = True)
+        Xb = (Xb - means) * contrast.astype(np.float32) + means
+        Xb *= gain.astype(np.float32)
+        return Xb
+
+
+    def _draw_orientations(self, n_samples, square):
+        #codes 0-3: k rotations by 90 degrees, 4-7: the same after a flip
+        codes = self.rng.randint(0, 8, size = n_samples)
+        if not self.flips:
+            codes %= 4
+        #180 degrees is left, as both flips
+        if not (self.rotations and square):
+            codes -= codes % 2
+        if not (self.rotations or self.flips):
+            codes[:] = 0
+        return codes
+
+
+def orient_batch(Xb, codes):
+    """
+    Apply one of the 8 symmetries of the square to each sample of a bc01
+    batch: code k in 0-3 rotates by k * 90 degrees, k + 4 flips the columns
+    first. Samples are grouped by code, so this is at most 8 numpy calls.
+    """
+    out = np.empty_like(Xb)
+    for code in np.unique(codes):
+        idx = np.flatnonzero(codes == code)
+        sub = Xb[idx]
+        if code >= 4:
+            sub = sub[:, :, :, ::-1]
+        out[idx] = np.rot90(sub, k = code % 4, axes = (2, 3))
+    return out
+
+
+def shift_batch(Xb, row_shifts, col_shifts, max_shift):
+    """
+    Shift each sample of a bc01 batch by its own (row, col) number of
+    pixels, at most max_shift, filling the edges by reflection. One padded
+    copy and one gather through a strided view of all the shifted windows.
+    """
+    n_samples, channels, rows, cols = Xb.shape
+    pad = ((0, 0), (0, 0), (max_shift, max_shift), (max_shift, max_shift))
+    padded = np.pad(Xb, pad, mode = 'reflect')
+    s_n, s_c, s_r, s_col = padded.strides
+    #(samples, channels, row offset, col offset, rows, cols) view, no copy
+    windows = np.lib.stride_tricks.as_strided(padded,
+                    shape = (n_samples, channels, 2 * max_shift + 1,
+                             2 * max_shift + 1, rows, cols),
+                    strides = (s_n, s_c, s_r, s_col, s_r, s_col))
+    #positive shifts move the content down/right
+    return windows[np.arange(n_samples), :, max_shift - row_shifts,
+                   max_shift - col_shifts]
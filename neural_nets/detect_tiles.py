@@ -0,0 +1,271 @@
+"""
+Sliding window detection over whole satellite tiles with a trained net
+(e.g. poolnet from nolearn.py), producing a probability heatmap per tile.
+
+example usage:
+python detect_tiles.py poolnet_model path/to/tiles/*.png -o heatmaps/dir \
+ --mean 90 --std 51 -s 16 -j 4
+python detect_tiles.py poolnet.pkl --benchmark 20 -j 4
+"""
+import argparse
+import glob
+import json
+import multiprocessing
+import numpy as np
+import os
+import pickle as pkl
+import shutil
+import sys
+import tempfile
+import time
+from model_io import load_model
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 
+                                os.pardir, 'image_prep'))
+from image_io import read_many, write_rgb
+from prefilter import window_scores
+
+#net loaded once per worker process by _init_worker
+_worker_net = None
+
+
+def window_grid(img_shape, window, stride):
+    """
+    (pair of ints) number of window rows and columns that fit in an image of
+    img_shape (rows, cols, ...) with square windows every stride pixels.
+    """
+    return ((img_shape[0] - window) // stride + 1,
+            (img_shape[1] - window) // stride + 1)
+
+
+def scan_images(net, img_arrs, window = 48, stride = 16, batch_size = 1024,
+                mean = 0.0, std = 1.0, prefilter_threshold = None, 
+                stats = None):
+    """
+    Run net over every window of a list of images, taking the windows of all
+    the images in batch_size chunks so each forward pass is large.
+
+    INPUT:
+    net: trained nolearn NeuralNet (anything with predict_proba on bc01 fp32
+         batches).
+    img_arrs: (list of arrays) images of shape (rows, cols, channels), 
+              uint8 as from image_io.read_rgb. An alpha channel is dropped.
+              Windows are converted to fp32 one batch at a time.
+    window: (int) side length of the (square) windows, the net's input size.
+    stride: (int) pixels between window positions.
+    batch_size: (int) windows per forward pass.
+    mean, std: (float) normalization used when training the net, in the 
+               pixel scale of img_arrs (0-255 for uint8 images, as with 
+               roi_stats on uint8 training data in nolearn.py).
+    prefilter_threshold: (float) if given, windows whose water fraction (see
+                         image_prep/prefilter.py) is below it are not run
+                         through the net, and get probability 0.
+    stats: (dict) if given, 'windows' and 'rejected' window counts are 
+           added to it.
+
+    OUTPUT:
+    (list of arrays) per image heatmap of shape window_grid(...), holding the
+    net's probability of the positive class for the window with its upper
+    left corner at (row * stride, col * stride).
+    """
+    views = []
+    for img_arr in img_arrs:
+        img_arr = img_arr[:, :, :3]
+        grid = window_grid(img_arr.shape, window, stride)
+        stride_r, stride_c, stride_ch = img_arr.strides
+        #(grid rows, grid cols, window, window, channels) view, no copy
+        views.append(np.lib.stride_tricks.as_strided(img_arr,
+                        shape = grid + (window, window, img_arr.shape[2]),
+                        strides = (stride_r * stride, stride_c * stride,
+                                   stride_r, stride_c, stride_ch)))
+
+    #flat list of (image, grid row, grid col) over all the images
+    img_idx = np.concatenate([np.repeat(i, v.shape[0] * v.shape[1])
+                                for i, v in enumerate(views)])
+    grid_rows = np.concatenate([np.repeat(np.arange(v.shape[0]), v.shape[1])
+                                for v in views])
+    grid_cols = np.concatenate([np.tile(np.arange(v.shape[1]), v.shape[0])
+                                for v in views])
+
+    probs = np.zeros(len(img_idx), dtype = np.float32)
+    if prefilter_threshold is not None:
+        scores = np.concatenate([window_scores(img_arr, window, stride).ravel()
+                                 for img_arr in img_arrs])
+        to_run = np.flatnonzero(scores >= prefilter_threshold)
+    else:
+        to_run = np.arange(len(img_idx))
+    if stats is not None:
+        stats['windows'] = stats.get('windows', 0) + len(img_idx)
+        stats['rejected'] = stats.get('rejected', 0) + len(img_idx) - len(to_run)
+
+    for start in xrange(0, len(to_run), batch_size):
+        batch = to_run[start:start + batch_size]
+        Xb = np.empty((len(batch), views[0].shape[-1], window, window),
+                        dtype = np.float32)
+        for i in np.unique(img_idx[batch]):
+            in_img = (img_idx[batch] == i)
+            Xb[in_img] = views[i][grid_rows[batch][in_img],
+                                  grid_cols[batch][in_img]].transpose(0, 3, 1, 2)
+        Xb -= mean
+        Xb /= std
+        probs[batch] = net.predict_proba(Xb)[:, 1]
+
+    heatmaps = []
+    start = 0
+    for v in views:
+        n_windows = v.shape[0] * v.shape[1]
+        heatmaps.append(probs[start:start + n_windows].reshape(v.shape[:2]))
+        start += n_windows
+    return heatmaps
+
+
+def scan_tiles(model_path, tile_paths, out_dir = None, window = 48,
+                stride = 16, batch_size = 1024, mean = 0.0, std = 1.0,
+                processes = 1, tiles_per_job = 4, prefilter_threshold = None, 
+                verbose = True):
+    """
+    Scan many tiles with a pickled net across a pool of processes. Each worker
+    loads the net once, then scans tiles_per_job tiles at a time. The reported 
+    rate excludes loading the net in the single process case only.
+
+    INPUT:
+    model_path: (str) pickle of the trained net, or a directory exported
+                by model_io.py, which workers load in milliseconds.
+    tile_paths: (list of str) tile images to scan.
+    out_dir: (str) if given, each heatmap is saved as out_dir/<tile name>.npy
+    processes: (int) worker processes.
+    tiles_per_job: (int) tiles whose windows are batched together.
+    Other args: see scan_images.
+
+    OUTPUT:
+    (dict) 'heatmaps': {tile path: heatmap} (only if out_dir is None),
+           'tiles', 'seconds', 'tiles_per_sec', and 'windows', 'rejected' 
+           and 'rejection_rate' of the prefilter.
+    """
+    if (out_dir is not None) and (not os.path.isdir(out_dir)):
+        os.makedirs(out_dir)
+
+    scan_kwargs = {'window': window, 'stride': stride,
+                   'batch_size': batch_size, 'mean': mean, 'std': std,
+                   'prefilter_threshold': prefilter_threshold}
+    jobs = [(tile_paths[i:i + tiles_per_job], out_dir, scan_kwargs)
+            for i in xrange(0, len(tile_paths), tiles_per_job)]
+
+    if processes > 1:
+        pool = multiprocessing.Pool(processes, initializer = _init_worker,
+                                    initargs = (model_path,))
+    else:
+        pool = None
+        _init_worker(model_path)
+
+    start_time = time.time()
+    if pool is not None:
+        results = pool.imap_unordered(_scan_job, jobs)
+    else:
+        results = (_scan_job(job) for job in jobs)
+
+    heatmaps = {}
+    window_counts = {'windows': 0, 'rejected': 0}
+    try:
+        for job_heatmaps, job_counts in results:
+            heatmaps.update(job_heatmaps)
+            for key in window_counts:
+                window_counts[key] += job_counts.get(key, 0)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+
+    seconds = time.time() - start_time
+    stats = {'tiles': len(tile_paths), 'seconds': seconds,
+             'tiles_per_sec': len(tile_paths) / seconds if seconds > 0 else 0.0}
+    stats.update(window_counts)
+    stats['rejection_rate'] = (window_counts['rejected'] / 
+                                float(max(window_counts['windows'], 1)))
+    if out_dir is None:
+        stats['heatmaps'] = heatmaps
+    if verbose:
+        print "Scanned {0} tiles in {1:.1f}s: {2:.2f} tiles/sec".format(
+                    stats['tiles'], stats['seconds'], stats['tiles_per_sec'])
+        if prefilter_threshold is not None:
+            print "Prefilter rejected {0:.1%} of {1} windows".format(
+                    stats['rejection_rate'], stats['windows'])
+    return stats
+
+
+def benchmark(model_path, num_tiles = 20, tile_dim = 1280, **scan_kwargs):
+    """
+    Throughput of scan_tiles in tiles/sec on num_tiles random tiles of side
+    tile_dim, written to a temporary directory.
+    """
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        rng = np.random.RandomState(0)
+        tile_paths = []
+        for i in xrange(num_tiles):
+            tile_path = os.path.join(tmp_dir, 'bench{0}.png'.format(i))
+            write_rgb(tile_path, rng.randint(0, 256, size = (tile_dim, tile_dim, 3)
+                                                ).astype(np.uint8))
+            tile_paths.append(tile_path)
+        return scan_tiles(model_path, tile_paths, **scan_kwargs)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def _init_worker(model_path):
+    global _worker_net
+    if os.path.isdir(model_path):
+        #exported by model_io.py: memory mapped weights, numpy forward pass
+        _worker_net = load_model(model_path)
+        return
+    #nets pickled by nolearn.py need a deep recursion limit to load as well
+    sys.setrecursionlimit(10000)
+    with open(model_path, 'rb') as fin:
+        _worker_net = pkl.load(fin)
+
+
+def _scan_job(job):
+    tile_paths, out_dir, scan_kwargs = job
+    img_arrs = list(read_many(tile_paths, workers = len(tile_paths)))
+    counts = {}
+    heatmaps = scan_images(_worker_net, img_arrs, stats = counts, **scan_kwargs)
+
+    results = {}
+    for tile_path, heatmap in zip(tile_paths, heatmaps):
+        if out_dir is None:
+            results[tile_path] = heatmap
+        else:
+            out_name = os.path.splitext(os.path.basename(tile_path))[0] + '.npy'
+            np.save(os.path.join(out_dir, out_name), heatmap)
+    return results, counts
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument('model', help="Pickled trained net, or a model_io.py export directory.")
+    ap.add_argument('tiles', nargs='*', help="Tile images (or glob patterns) to scan.")
+    ap.add_argument('-o', '--outpath', help="Directory to write heatmaps to.")
+    ap.add_argument('-w', '--window', type=int, default=48, help="Window side length.")
+    ap.add_argument('-s', '--stride', type=int, default=16, help="Window stride.")
+    ap.add_argument('-b', '--batch', type=int, default=1024, help="Windows per forward pass.")
+    ap.add_argument('--mean', type=float, default=0.0, help="Training data mean, in 0-255 pixel units.")
+    ap.add_argument('--std', type=float, default=1.0, help="Training data std, in 0-255 pixel units.")
+    ap.add_argument('-j', '--processes', type=int, default=1, help="Worker processes.")
+    bench_help = "Benchmark tiles/sec on this many random tiles instead of scanning."
+    ap.add_argument('--benchmark', type=int, help=bench_help)
+    prefilter_help = "JSON calibration from image_prep/prefilter.py, to skip windows without water."
+    ap.add_argument('-f', '--prefilter', help=prefilter_help)
+
+    args = ap.parse_args()
+    scan_kwargs = {'window': args.window, 'stride': args.stride,
+                   'batch_size': args.batch, 'mean': args.mean,
+                   'std': args.std, 'processes': args.processes}
+    if args.prefilter:
+        with open(args.prefilter) as fin:
+            scan_kwargs['prefilter_threshold'] = json.load(fin)['threshold']
+    if args.benchmark:
+        benchmark(args.model, num_tiles = args.benchmark, **scan_kwargs)
+    else:
+        tile_paths = sorted(set(path for pattern in args.tiles
+                                for path in glob.glob(pattern)))
+        scan_tiles(args.model, tile_paths, out_dir = args.outpath, **scan_kwargs)
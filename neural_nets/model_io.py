@@ -0,0 +1,278 @@
+"""
+Weight only export of trained nets, and a fast numpy loader for scoring.
+
+A model directory holds spec.json, the layer list with each layer's settings
+and parameter shapes, and params.bin, all parameter arrays back to back as
+raw fp32. Loading memory maps params.bin and runs the forward pass in numpy,
+so scoring workers start without theano, lasagne or nolearn, and without
+unpickling the training object.
+
+Supports the layer types used in nolearn.py: InputLayer, Conv2DLayer,
+MaxPool2DLayer, DenseLayer and DropoutLayer (a no-op when scoring).
+
+example usage:
+python model_io.py poolnet.pkl -o poolnet_model
+"""
+import argparse
+import json
+import numpy as np
+import os
+import pickle as pkl
+import sys
+
+FORMAT_VERSION = 1
+
+#settings saved for each layer type, read off the lasagne layer objects
+LAYER_SETTINGS = {'InputLayer': ['shape'],
+                  'Conv2DLayer': ['num_filters', 'filter_size', 'stride', 'pad',
+                                  'flip_filters', 'untie_biases'],
+                  'MaxPool2DLayer': ['pool_size', 'stride', 'pad',
+                                     'ignore_border'],
+                  'DenseLayer': ['num_units'],
+                  'DropoutLayer': ['p']}
+
+
+def export_model(net, out_dir):
+    """
+    Save the layer spec and parameters of a trained nolearn NeuralNet (or
+    the output layer of a chain of lasagne layers).
+
+    INPUT:
+    net: trained NeuralNet, or lasagne output layer.
+    out_dir: (str) directory to write spec.json and params.bin to.
+    """
+    from lasagne.layers import get_all_layers
+
+    output_layer = net.layers_.values()[-1] if hasattr(net, 'layers_') else net
+    layers = get_all_layers(output_layer)
+    if not os.path.isdir(out_dir):
+        os.makedirs(out_dir)
+
+    spec = {'format_version': FORMAT_VERSION, 'layers': []}
+    offset = 0
+    with open(os.path.join(out_dir, 'params.bin'), 'wb') as fout:
+        for i, layer in enumerate(layers):
+            layer_type = type(layer).__name__
+            if layer_type not in LAYER_SETTINGS:
+                raise Exception("Can't export layer type: {0}".format(layer_type))
+            if (i > 0) and (layer.input_layer is not layers[i - 1]):
+                raise Exception("Only chains of layers can be exported.")
+
+            layer_spec = {'type': layer_type, 'name': layer.name, 'params': []}
+            for setting in LAYER_SETTINGS[layer_type]:
+                value = getattr(layer, setting)
+                layer_spec[setting] = list(value) if isinstance(value, tuple) else value
+            if hasattr(layer, 'nonlinearity'):
+                layer_spec['nonlinearity'] = _nonlinearity_name(layer.nonlinearity)
+
+            for param in layer.get_params():
+                arr = np.ascontiguousarray(param.get_value(), dtype = '<f4')
+                fout.write(arr.tostring())
+                layer_spec['params'].append({'name': param.name,
+                                             'shape': list(arr.shape),
+                                             'offset': offset})
+                offset += arr.nbytes
+            spec['layers'].append(layer_spec)
+
+    spec['params_bytes'] = offset
+    with open(os.path.join(out_dir, 'spec.json'), 'w') as fout:
+        json.dump(spec, fout, indent = 1)
+
+
+def _nonlinearity_name(nonlinearity):
+    if nonlinearity is None:
+        return 'linear'
+    #leaky_rectify is an instance of LeakyRectify
+    name = getattr(nonlinearity, '__name__', type(nonlinearity).__name__)
+    if name == 'LeakyRectify':
+        return 'leaky_rectify:{0!r}'.format(nonlinearity.leakiness)
+    if name not in NONLINEARITIES:
+        raise Exception("Can't export nonlinearity: {0}".format(name))
+    return name
+
+
+class NumpyNet(object):
+    """
+    Forward pass of an exported net in numpy, over memory mapped parameters.
+    Has predict_proba/predict like a nolearn NeuralNet, so it can stand in
+    for one in detect_tiles.scan_images.
+    """
+
+    def __init__(self, model_dir, chunk_size = 32):
+        """
+        INPUT:
+        model_dir: (str) directory written by export_model.
+        chunk_size: (int) samples per forward pass, bounding the memory of
+                    the unrolled convolution windows.
+        """
+        with open(os.path.join(model_dir, 'spec.json')) as fin:
+            self.spec = json.load(fin)
+        if self.spec['format_version'] > FORMAT_VERSION:
+            raise Exception("Unknown model format version: {0}".format(
+                                self.spec['format_version']))
+        self.chunk_size = chunk_size
+        #pages of the parameters are only read as the layers use them
+        params = np.memmap(os.path.join(model_dir, 'params.bin'), dtype = '<f4',
+                           mode = 'r', shape = (self.spec['params_bytes'] // 4,))
+        self.layer_params = []
+        for layer_spec in self.spec['layers']:
+            arrays = []
+            for param in layer_spec['params']:
+                start = param['offset'] // 4
+                size = int(np.prod(param['shape']))
+                arrays.append(params[start:start + size].reshape(param['shape']))
+            self.layer_params.append(arrays)
+
+
+    def predict_proba(self, X):
+        """(array) output of the net for a bc01 batch X."""
+        X = np.asarray(X, dtype = np.float32)
+        return np.concatenate([self._forward(X[start:start + self.chunk_size])
+                               for start in xrange(0, len(X), self.chunk_size)])
+
+
+    def predict(self, X):
+        return self.predict_proba(X).argmax(axis = 1)
+
+
+    def _forward(self, X):
+        for layer_spec, arrays in zip(self.spec['layers'], self.layer_params):
+            layer_type = layer_spec['type']
+            if layer_type == 'Conv2DLayer':
+                X = _conv2d(X, arrays[0], arrays[1] if len(arrays) > 1 else None,
+                            layer_spec)
+            elif layer_type == 'MaxPool2DLayer':
+                X = _max_pool(X, layer_spec)
+            elif layer_type == 'DenseLayer':
+                X = X.reshape(len(X), -1).dot(arrays[0])
+                if len(arrays) > 1:
+                    X += arrays[1]
+            if 'nonlinearity' in layer_spec:
+                X = _apply_nonlinearity(X, layer_spec['nonlinearity'])
+        return X
+
+
+def load_model(model_dir, chunk_size = 32):
+    """(NumpyNet) exported net, ready to score."""
+    return NumpyNet(model_dir, chunk_size = chunk_size)
+
+
+def load_lasagne_layers(model_dir):
+    """
+    Rebuild an exported net as lasagne layers, with its parameters set, e.g.
+    to fine tune it.
+
+    OUTPUT:
+    the output layer.
+    """
+    import lasagne.layers
+    import lasagne.nonlinearities
+
+    net = NumpyNet(model_dir)
+    layer = None
+    for layer_spec, arrays in zip(net.spec['layers'], net.layer_params):
+        layer_cls = getattr(lasagne.layers, layer_spec['type'])
+        kwargs = dict((setting, _to_tuple(layer_spec[setting]))
+                      for setting in LAYER_SETTINGS[layer_spec['type']])
+        if 'nonlinearity' in layer_spec:
+            name = layer_spec['nonlinearity'].split(':')
+            if name[0] == 'leaky_rectify':
+                kwargs['nonlinearity'] = lasagne.nonlinearities.LeakyRectify(float(name[1]))
+            else:
+                kwargs['nonlinearity'] = getattr(lasagne.nonlinearities, name[0])
+        if layer is None:
+            layer = layer_cls(name = layer_spec['name'], **kwargs)
+        else:
+            layer = layer_cls(layer, name = layer_spec['name'], **kwargs)
+        for param, arr in zip(layer.get_params(), arrays):
+            param.set_value(np.array(arr))
+    return layer
+
+
+def _to_tuple(value):
+    return tuple(value) if isinstance(value, list) else value
+
+
+def _pad_amounts(pad, filter_size):
+    if pad == 'valid':
+        return (0, 0)
+    if pad == 'same':
+        return tuple(size // 2 for size in filter_size)
+    if pad == 'full':
+        return tuple(size - 1 for size in filter_size)
+    return tuple(pad) if isinstance(pad, (list, tuple)) else (pad, pad)
+
+
+def _windows(X, window, stride):
+    """(N, C, out rows, out cols, window rows, window cols) strided view of X."""
+    n, c, rows, cols = X.shape
+    s_n, s_c, s_r, s_col = X.strides
+    out_rows = (rows - window[0]) // stride[0] + 1
+    out_cols = (cols - window[1]) // stride[1] + 1
+    return np.lib.stride_tricks.as_strided(X,
+                shape = (n, c, out_rows, out_cols, window[0], window[1]),
+                strides = (s_n, s_c, s_r * stride[0], s_col * stride[1], s_r, s_col))
+
+
+def _conv2d(X, W, b, layer_spec):
+    filter_size = tuple(layer_spec['filter_size'])
+    pad_r, pad_c = _pad_amounts(layer_spec['pad'], filter_size)
+    if pad_r or pad_c:
+        X = np.pad(X, ((0, 0), (0, 0), (pad_r, pad_r), (pad_c, pad_c)),
+                   mode = 'constant')
+    if layer_spec['flip_filters']:
+        #lasagne's default is a true convolution, i.e. flipped filters
+        W = W[:, :, ::-1, ::-1]
+    windows = _windows(X, filter_size, tuple(layer_spec['stride']))
+    out = np.tensordot(windows, W, axes = ((1, 4, 5), (1, 2, 3)))
+    out = out.transpose(0, 3, 1, 2)
+    if b is not None:
+        #untied biases have one per output pixel
+        out += b if layer_spec['untie_biases'] else b[:, np.newaxis, np.newaxis]
+    return np.ascontiguousarray(out, dtype = np.float32)
+
+
+def _max_pool(X, layer_spec):
+    pool_size = tuple(layer_spec['pool_size'])
+    stride = tuple(layer_spec['stride'] or pool_size)
+    pad_r, pad_c = tuple(layer_spec['pad'])
+    if not layer_spec['ignore_border']:
+        raise Exception("Only pooling with ignore_border = True is supported.")
+    if pad_r or pad_c:
+        X = np.pad(X, ((0, 0), (0, 0), (pad_r, pad_r), (pad_c, pad_c)),
+                   mode = 'constant', constant_values = -np.inf)
+    return _windows(X, pool_size, stride).max(axis = (4, 5))
+
+
+def _softmax(X):
+    e_X = np.exp(X - X.max(axis = 1, keepdims = True))
+    return e_X / e_X.sum(axis = 1, keepdims = True)
+
+
+NONLINEARITIES = {'rectify': lambda X: np.maximum(X, 0),
+                  'softmax': _softmax,
+                  'sigmoid': lambda X: 1.0 / (1.0 + np.exp(-X)),
+                  'tanh': np.tanh,
+                  'linear': lambda X: X,
+                  'identity': lambda X: X}
+
+
+def _apply_nonlinearity(X, name):
+    name = name.split(':')
+    if name[0] == 'leaky_rectify':
+        leakiness = float(name[1])
+        return np.where(X > 0, X, leakiness * X)
+    return NONLINEARITIES[name[0]](X)
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument('model', help="Pickled trained net, as saved by nolearn.py.")
+    ap.add_argument('-o', '--outpath', required=True, help="Directory to export to.")
+
+    args = ap.parse_args()
+    sys.setrecursionlimit(10000)
+    with open(args.model, 'rb') as fin:
+        net = pkl.load(fin)
+    export_model(net, args.outpath)
+    print "Exported {0} to {1}".format(args.model, args.outpath)
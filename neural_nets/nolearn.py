@@ -1,6 +1,4 @@
 import pickle as pkl
-from matplotlib.image import imread
-from skimage.color import rgb2gray
 import glob
 import os
 import numpy as np
@@ -13,64 +11,295 @@ from lasagne.layers import MaxPool2DLayer
 from lasagne.nonlinearities import softmax
 from lasagne.updates import adam
 from lasagne.layers import get_all_params
+from nolearn.lasagne import BatchIterator
 from nolearn.lasagne import NeuralNet
 from nolearn.lasagne import TrainSplit
 from nolearn.lasagne import objective
 from nolearn.lasagne import PrintLayerInfo
+from augment import BatchAugmenter
+from model_io import export_model
 
+#shared data formats live with the image prep code
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 
+                                os.pardir, 'image_prep'))
+from image_io import read_gray, read_many, read_rgb
+import metrics
+from phash import duplicate_groups, hash_rois
+from roi_store import RoiStore
+from streaming import prefetch
 
-def load_roi_images(path_to_samples_dir, normalize = False, convert2gray = False):
+
+def load_roi_images(path_to_samples_dir, normalize = False, convert2gray = False,
+                    workers = 4):
     """
+    Load the ROI images in the positive_samples/negative_samples directories
+    written by cut_and_save_rois.py into one uint8 bc01 array (samples x 
+    colors x rows x cols), with the image shape taken from the data. Images 
+    are decoded by a pool of threads, with any alpha channel dropped at read, 
+    straight into a preallocated array, so there is one 1 byte per pixel copy
+    of the dataset in memory. Convert to fp32 and normalize per mini-batch, 
+    e.g. with roi_stats and PrefetchBatchIterator.
+
+    normalize = True instead returns the whole dataset as normalized fp32, 
+    4 times the memory.
+
     Modified from:
     http://nbviewer.ipython.org/github/dnouri/nolearn/blob/master/docs/notebooks/CNN_tutorial.ipynb#
     """
-    X = []
-    y = []
     pos_paths = glob.glob(os.path.join(path_to_samples_dir,'positive_samples/*.png'))
     neg_paths = glob.glob(os.path.join(path_to_samples_dir,'negative_samples/*.png'))
+    img_paths = pos_paths + neg_paths
+    if not img_paths:
+        raise Exception("No sample images found in: {0}".format(path_to_samples_dir))
 
-    for posneg in [pos_paths, neg_paths]:
-        for img_path in posneg:
-            img = imread(img_path)
-            if convert2gray:
-                img = rgb2gray(img)
+    y = np.array([1] * len(pos_paths) + [0] * len(neg_paths), dtype = np.int32)
+    X = None
 
-            X.append(img)
-            y.append(1 if 'positive' in img_path else 0)
+    reader = read_gray if convert2gray else read_rgb
+    with metrics.timer('roi_images_decode'):
+        for i, img in enumerate(read_many(img_paths, workers = workers, 
+                                            reader = reader)):
+            if img.ndim == 2:
+                img = img[:, :, np.newaxis]
+            if X is None:
+                # For convolutional layers, the default shape of data is bc01,
+                # i.e. batch size x color channels x image dimension 1 x image dimension 2.
+                X = np.empty((len(img_paths), img.shape[2], img.shape[0], 
+                                img.shape[1]), dtype = np.uint8)
+            X[i] = img.transpose(2, 0, 1)
 
-    # Theano works with fp32 precision
-    X = np.array(X).astype(np.float32)
-    y = np.array(y).astype(np.int32)
+    if normalize:
+        # Theano works with fp32 precision
+        mean, std = roi_stats(X)
+        X = X.astype(np.float32)
+        X -= mean
+        X /= std
 
-    #drop alpha channel if exists (generally always = 1)
-    if (len(np.shape(X)) == 4) and (np.shape(X)[-1] == 4):
-        X = X[:,:,:,:3]  #dims: num_samps, pix_x, pix_y, rgb(a)
+    print np.shape(X)
+    metrics.incr('samples_loaded', len(X))
 
-    if normalize:
-        X -= X.mean()
-        X /= X.std()
+    return X, y
 
 
-    numcolors = 1 if convert2gray else 3
-    print np.shape(X)
+def roi_stats(X, batch_size = 1024):
+    """
+    Mean and standard deviation of all pixel values of a (possibly memory 
+    mapped) dataset, in one pass over batch_size samples at a time, merging
+    per batch statistics (Chan et al.'s parallel variance update).
 
-    # For convolutional layers, the default shape of data is bc01,
-    # i.e. batch size x color channels x image dimension 1 x image dimension 2.
-    # Therefore, we reshape the X data to -1, 1, 28, 28.
-    X = X.reshape(
-        -1,  # number of samples, -1 makes it so that this number is determined automatically
-        numcolors,   # 3 color channel or 1 for grays, 
-        28,  # first image dimension (vertical)
-        28,  # second image dimension (horizontal)
-    )
+    OUTPUT:
+    (pair of floats) mean, std.
+    """
+    count = 0
+    mean = 0.0
+    sq_dev_sum = 0.0
+    for start in xrange(0, len(X), batch_size):
+        Xb = np.asarray(X[start:start + batch_size], dtype = np.float64)
+        b_count = Xb.size
+        b_mean = Xb.mean()
+        b_sq_dev_sum = ((Xb - b_mean) ** 2).sum()
 
-    return X, y
+        delta = b_mean - mean
+        total = count + b_count
+        mean += delta * b_count / total
+        sq_dev_sum += b_sq_dev_sum + delta ** 2 * count * b_count / total
+        count = total
+
+    return mean, np.sqrt(sq_dev_sum / count)
+
+
+class RowSubset(object):
+    """
+    Lazy view of some rows of an array (e.g. a memory mapped ROI store), so 
+    train/validation splits don't load the data. Slicing reads only the 
+    selected rows.
+    """
+
+    def __init__(self, X, indices):
+        self.X = X
+        self.indices = np.asarray(indices)
+        self.shape = (len(self.indices),) + tuple(X.shape[1:])
+        self.dtype = X.dtype
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, key):
+        rows = self.indices[key]
+        if np.isscalar(rows):
+            return self.X[rows]
+        #reading rows in file order is much faster on memory maps
+        order = np.argsort(rows)
+        out = np.empty((len(rows),) + self.shape[1:], dtype = self.dtype)
+        out[order] = self.X[rows[order]]
+        return out
+
+
+class StreamingTrainSplit(object):
+    """
+    Stratified train/validation split for NeuralNet(train_split=...) that 
+    returns RowSubset views instead of copies, so datasets larger than RAM 
+    can be split.
+
+    Given groups (e.g. of near-duplicate ROIs, from phash.duplicate_groups),
+    whole groups go to one side of the split, so no sample is validated 
+    against a near copy of itself that was trained on. Groups are 
+    stratified by the label of their first sample.
+    """
+
+    def __init__(self, eval_size, random_state = 42, groups = None):
+        self.eval_size = eval_size
+        self.random_state = random_state
+        self.groups = groups
+
+    def __call__(self, X, y, net):
+        y = np.asarray(y)
+        if not self.eval_size:
+            return X, X[:0], y, y[:0]
+
+        rng = np.random.RandomState(self.random_state)
+        if self.groups is not None:
+            valid_mask = self._group_valid_mask(y, np.asarray(self.groups), rng)
+        else:
+            valid_mask = np.zeros(len(y), dtype = bool)
+            for label in np.unique(y):
+                label_idx = np.flatnonzero(y == label)
+                num_valid = int(round(self.eval_size * len(label_idx)))
+                valid_mask[rng.choice(label_idx, num_valid, replace = False)] = True
+
+        train_idx = np.flatnonzero(~valid_mask)
+        valid_idx = np.flatnonzero(valid_mask)
+        return (RowSubset(X, train_idx), RowSubset(X, valid_idx), 
+                y[train_idx], y[valid_idx])
+
+    def _group_valid_mask(self, y, groups, rng):
+        if len(groups) != len(y):
+            raise Exception("Got {0} groups for {1} samples.".format(
+                                len(groups), len(y)))
+        group_ids, first_idx, group_of, sizes = np.unique(
+                groups, return_index = True, return_inverse = True,
+                return_counts = True)
+        group_labels = y[first_idx]
+        valid_groups = np.zeros(len(group_ids), dtype = bool)
+        for label in np.unique(group_labels):
+            label_groups = rng.permutation(np.flatnonzero(group_labels == label))
+            #shuffled groups are taken until they hold eval_size of the samples
+            target = self.eval_size * sizes[label_groups].sum()
+            num_groups = np.searchsorted(np.cumsum(sizes[label_groups]), target,
+                                         side = 'right')
+            valid_groups[label_groups[:num_groups]] = True
+        return valid_groups[group_of]
+
+
+class PrefetchBatchIterator(BatchIterator):
+    """
+    Mini-batch iterator that reads each batch from (possibly memory mapped 
+    or RowSubset) data in a background thread while the net trains on the 
+    previous one. Batches are converted to fp32 and normalized with the 
+    given mean/std one at a time, so the full dataset is never converted.
+    Shuffling draws each batch from a fresh row permutation every epoch, 
+    gathered from the (memory mapped) data.
+    If augment is given (e.g. augment.BatchAugmenter, for the training 
+    iterator only), each fp32 batch is passed through it before being
+    normalized.
+    """
+
+    def __init__(self, batch_size, mean = 0.0, std = 1.0, shuffle = False, 
+                    prefetch = 2, seed = 42, augment = None):
+        super(PrefetchBatchIterator, self).__init__(batch_size)
+        self.mean = mean
+        self.std = std
+        self.augment = augment
+        self.shuffle_rows = shuffle
+        self.prefetch = prefetch
+        self.rng = np.random.RandomState(seed)
+
+    def __call__(self, X, y = None):
+        self.X, self.y = X, y
+        return self
+
+    def __iter__(self):
+        return prefetch(self._batches(), max_queued = self.prefetch)
+
+    def _batches(self):
+        n_samples = len(self.X)
+        if self.shuffle_rows:
+            rows = self.rng.permutation(n_samples)
+        else:
+            rows = np.arange(n_samples)
+
+        bs = self.batch_size
+        for start in xrange(0, n_samples, bs):
+            batch_rows = rows[start:start + bs]
+            if self.shuffle_rows:
+                Xb = RowSubset(self.X, batch_rows)[:]
+            else:
+                Xb = self.X[start:start + bs]
+            yb = self.y[batch_rows] if self.y is not None else None
+            with metrics.timer('batch_prepare'):
+                batch = self.transform(Xb, yb)
+            metrics.incr('batches')
+            metrics.incr('batch_samples', len(batch_rows))
+            yield batch
+
+    def transform(self, Xb, yb):
+        Xb = np.asarray(Xb, dtype = np.float32)
+        if self.augment is not None:
+            Xb = self.augment(Xb)
+        Xb = (Xb - np.float32(self.mean)) / np.float32(self.std)
+        if yb is not None:
+            yb = np.asarray(yb, dtype = np.int32)
+        return Xb, yb
+
+
+def load_roi_store(path_to_store):
+    """
+    Open a RoiStore written by cut_and_save_rois.py (with --store) without 
+    decoding or copying any images.
+
+    INPUT:
+    path_to_store: (str) directory of the store.
+
+    OUTPUT:
+    X: (array) read only bc01 view (samples x colors x rows x cols) of the 
+       memory mapped ROIs. Theano wants fp32, so convert per mini-batch.
+    y: (array) int32 labels, 1 for positive samples.
+    """
+    X, y = RoiStore(path_to_store).arrays()
+
+    #drop alpha channel if exists (generally always = 1)
+    if X.shape[-1] == 4:
+        X = X[:, :, :, :3]
+
+    #transposing only changes strides, nothing is read from disk here
+    return X.transpose(0, 3, 1, 2), y.astype(np.int32)
 
 
 
 if __name__ == '__main__':
 
-    X, y = load_roi_images('path/to/roi/directories', normalize=True, convert2gray=False)
+    samples_path = 'path/to/roi/directories'
+    #sample loading and batch times, written next to the model
+    metrics.enable()
+    if os.path.exists(os.path.join(samples_path, 'meta.json')):
+        #an ROI store: leave it on disk
+        X, y = load_roi_store(samples_path)
+    else:
+        X, y = load_roi_images(samples_path, convert2gray=False)
+    #pixels stay uint8, mini-batches are converted to fp32 and normalized 
+    #as they are fed to the net
+    mean, std = roi_stats(X)
+    print "Normalization: --mean {0} --std {1} (for detect_tiles.py)".format(mean, std)
+    #near-duplicate ROIs (overlapping tiles, repeated clicks) stay on one 
+    #side of the train/validation split
+    groups = duplicate_groups(hash_rois(X.transpose(0, 2, 3, 1)), max_distance=4)
+    print "{0} samples in {1} near-duplicate groups".format(len(groups), len(np.unique(groups)))
+    data_kwargs = {
+        'batch_iterator_train': PrefetchBatchIterator(128, mean, std, 
+                                                        shuffle=True, 
+                                                        augment=BatchAugmenter()),
+        'batch_iterator_test': PrefetchBatchIterator(128, mean, std),
+        'train_split': StreamingTrainSplit(eval_size=0.25, groups=groups)}
     
     #copied from layers4 definition in
     #https://github.com/dnouri/nolearn/blob/master/docs/notebooks/CNN_tutorial.ipynb
@@ -103,13 +332,15 @@ if __name__ == '__main__':
 
 
     poolnet = NeuralNet(layers=poollayers1, max_epochs=400, update=adam,
-                    update_learning_rate=0.0002, verbose=2,
-                    train_split=TrainSplit(eval_size=0.25))
+                    update_learning_rate=0.0002, verbose=2, **data_kwargs)
 
     poolnet.fit(X, y)
+    metrics.export('poolnet_metrics.json')
 
     
     #upping recursion depth (sorta arbitrarily to 10k) to avoid pickling error
     sys.setrecursionlimit(10000)
     pkl.dump(poolnet, open('poolnet.pkl','wb'))
+    #weights only, for scoring workers (see model_io.py and detect_tiles.py)
+    export_model(poolnet, 'poolnet_model')
 